@@ -23,6 +23,13 @@ Released under BSD 3-Clause License. See LICENSE for more details.
 
 import platform
 
+if platform.python_version().startswith('2'):
+    PY3 = False
+elif platform.python_version().startswith('3'):
+    PY3 = True
+else:
+    raise NotImplementedError('Only writtend for python2 or python3')
+
 # Set constants/properties of ImageMetaTag (before any of it is imported)
 # see release_process for details on incrementing the version
 __version__ = '0.8.1'
@@ -49,16 +56,15 @@ import ImageMetaTag.db
 # but only specfic parts of savefig and img_dict:
 from ImageMetaTag.savefig import savefig
 from ImageMetaTag.savefig import image_file_postproc
+from ImageMetaTag.savefig import savefig_many
+from ImageMetaTag.savefig import set_series_palette
+from ImageMetaTag.savefig import set_png_profile
+from ImageMetaTag.savefig import reoptimise_pngs
+from ImageMetaTag.savefig import PostprocQueue
+from ImageMetaTag.savefig import SavefigMetrics
 from ImageMetaTag.img_dict import ImageDict
 from ImageMetaTag.img_dict import readmeta_from_image
 from ImageMetaTag.img_dict import dict_heirachy_from_list
 from ImageMetaTag.img_dict import dict_split
 from ImageMetaTag.img_dict import simple_dict_filter
 from ImageMetaTag.img_dict import check_for_required_keys
-
-if platform.python_version().startswith('2'):
-    PY3 = False
-elif platform.python_version().startswith('3'):
-    PY3 = True
-else:
-    raise NotImplementedError('Only writtend for python2 or python3')
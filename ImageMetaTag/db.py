@@ -11,10 +11,14 @@ Released under BSD 3-Clause License. See LICENSE for more details.
 '''
 
 import os
+import sys
 import sqlite3
-import fnmatch
+import socket
 import time
 import errno
+import atexit
+import threading
+import multiprocessing.util
 import pdb
 
 from datetime import datetime
@@ -24,12 +28,22 @@ import numpy as np
 from ImageMetaTag import META_IMG_FORMATS
 from ImageMetaTag import DEFAULT_DB_TIMEOUT
 from ImageMetaTag import DEFAULT_DB_ATTEMPTS
+from ImageMetaTag import PY3
 from ImageMetaTag.img_dict import readmeta_from_image
 from ImageMetaTag.img_dict import check_for_required_keys
 
 # the name of the database table that holds the plot metadata
 SQLITE_IMG_INFO_TABLE = 'img_info'
 SQLITE_IMG_INFO_FNAME = 'fname'
+# the name of the table that holds a hash of the inputs used to create each image,
+# (kept apart from the metadata) so savefig can skip images that have not changed:
+SQLITE_IMG_HASH_TABLE = 'img_hash'
+SQLITE_IMG_HASH = 'hash'
+# the prefix for the names of indexes on the image metadata table:
+SQLITE_IMG_INDEX_PREFIX = 'imt_idx_'
+# how long (in seconds) select_dbfile_by_tags waits for a locked database,
+# to add indexes with auto_index, before leaving them for another time:
+AUTO_INDEX_TIMEOUT = 0.1
 
 
 def info_key_to_db_name(in_str):
@@ -45,7 +59,7 @@ def db_name_to_info_key(in_str):
 
 def write_img_to_dbfile(db_file, img_filename, img_info, add_strict=False,
                         attempt_replace=False,
-                        timeout=DEFAULT_DB_TIMEOUT):
+                        timeout=DEFAULT_DB_TIMEOUT, img_hash=None):
     '''
     Writes image metadata to a database.
 
@@ -65,6 +79,9 @@ def write_img_to_dbfile(db_file, img_filename, img_info, add_strict=False,
     * add_strict - passed into :func:`ImageMetaTag.db.write_img_to_open_db`
     * attempt_replace - passed to :func:`ImageMetaTag.db.write_img_to_open_db`
     * timeout - default timeout to try and write to the database.
+    * img_hash - if supplied, this hash of the inputs used to create the \
+                 image is also stored, in the same transaction, using \
+                 :func:`ImageMetaTag.db.write_img_hash_to_open_db`.
 
     This is commonly used in :func:`ImageMetaTag.savefig`
     '''
@@ -80,26 +97,71 @@ def write_img_to_dbfile(db_file, img_filename, img_info, add_strict=False,
         write_img_to_open_db(dbcr, img_filename, img_info,
                              add_strict=add_strict,
                              attempt_replace=attempt_replace)
+        if img_hash is not None:
+            write_img_hash_to_open_db(dbcr, img_filename, img_hash)
         # now commit that databasde entry and close:
         dbcn.commit()
         dbcn.close()
 
 
+def write_imgs_to_dbfile(db_file, img_infos, add_strict=False,
+                         attempt_replace=False,
+                         timeout=DEFAULT_DB_TIMEOUT, img_hashes=None):
+    '''
+    Writes the metadata of many images to a database, in a single transaction.
+    This is much quicker than calling :func:`ImageMetaTag.db.write_img_to_dbfile`
+    for each image, so is the best way to build or rebuild a large database.
+
+    Arguments:
+
+    * db_file - the database file to write to. If it does not exist, it will \
+                be created.
+    * img_infos - a dictionary of {img_filename: img_info}, where each \
+                  img_info is a dictionary of {tag_name: value} pairs, as \
+                  :func:`ImageMetaTag.db.write_img_to_dbfile`.
+
+    Options:
+
+    * add_strict - passed into :func:`ImageMetaTag.db.write_imgs_to_open_db`
+    * attempt_replace - passed to :func:`ImageMetaTag.db.write_imgs_to_open_db`
+    * timeout - default timeout to try and write to the database.
+    * img_hashes - passed to :func:`ImageMetaTag.db.write_imgs_to_open_db`
+    '''
+    if db_file is None or len(img_infos) == 0:
+        return
+    first_info = next(iter(img_infos.values()))
+    dbcn, dbcr = open_or_create_db_file(db_file, first_info, timeout=timeout)
+    try:
+        write_imgs_to_open_db(dbcr, img_infos, add_strict=add_strict,
+                              attempt_replace=attempt_replace,
+                              img_hashes=img_hashes)
+        dbcn.commit()
+    finally:
+        dbcn.close()
+
+
 def read(db_file, required_tags=None, tag_strings=None,
          db_timeout=DEFAULT_DB_TIMEOUT,
          db_attempts=DEFAULT_DB_ATTEMPTS,
-         n_samples=None):
+         n_samples=None, select_tags=None):
     '''
     reads in the database written by write_img_to_dbfile
 
     Options:
      * required_tags - a list of image tags to return, and to fail if not all are \
-                       present
+                       present. Only these tags are read from the database, \
+                       which is quicker than reading them all.
      * tag_strings - an input list that will be populated with the unique values of \
-                     the image tags.
+                     the image tags. For large databases, use a \
+                     :class:`ImageMetaTag.db.TagStrings`, which is much quicker \
+                     than a plain list, and can be reused for several reads.
      * n_samples - if provided, only the given number of entries will be loaded \
                    from the database, at random. \
                    Must be an integer or None (default None)
+     * select_tags - if provided, only the images whose tags match these are \
+                     read, as :func:`ImageMetaTag.db.select_dbcr_by_tags`. \
+                     The selection is done by the database, so this is much \
+                     quicker than reading everything and filtering it.
 
     Returns:
      * a list of filenames (payloads for the :class:`ImageMetaTag.ImageDict` class )
@@ -133,7 +195,8 @@ def read(db_file, required_tags=None, tag_strings=None,
             f_list, out_dict = read_img_info_from_dbcursor(dbcr,
                                                            required_tags=required_tags,
                                                            tag_strings=tag_strings,
-                                                           n_samples=n_samples)
+                                                           n_samples=n_samples,
+                                                           select_tags=select_tags)
             # close connection:
             dbcn.close()
             read_db = True
@@ -143,6 +206,7 @@ def read(db_file, required_tags=None, tag_strings=None,
                 print('%s database timeout reading from file "%s", %s s' \
                         % (dt_now_str(), db_file, n_tries * db_timeout))
                 n_tries += 1
+                last_err = op_err
             elif 'no such table: {}'.format(SQLITE_IMG_INFO_TABLE) in repr(op_err):
                 # the db file exists, but it doesn't have anything in it:
                 return None, None
@@ -153,7 +217,7 @@ def read(db_file, required_tags=None, tag_strings=None,
 
     # if we went through all the attempts then it is time to raise the error:
     if n_tries > db_attempts:
-        msg = '{} for file {}'.format(op_err, db_file)
+        msg = '{} for file {}'.format(last_err, db_file)
         raise sqlite3.OperationalError(msg)
 
     # close connection:
@@ -163,70 +227,378 @@ def read(db_file, required_tags=None, tag_strings=None,
 read_img_info_from_dbfile = read
 
 
+def read_columnar(db_file, required_tags=None, select_tags=None, chunk_size=10000,
+                  db_timeout=DEFAULT_DB_TIMEOUT,
+                  db_attempts=DEFAULT_DB_ATTEMPTS):
+    '''
+    Reads in the database written by write_img_to_dbfile, as columns rather
+    than as a dictionary per image. Each tag is dictionary encoded: an array of
+    integer codes, one per image, and the list of unique values that the codes
+    index. For large databases, this uses a small fraction of the memory of
+    :func:`ImageMetaTag.db.read`, and the images can be filtered and grouped
+    with numpy. For example, to get the images where tag 'model' is 'ukv'::
+
+        fnames, columns = read_columnar(db_file)
+        codes, values = columns['model']
+        ukv_fnames = fnames[codes == values.index('ukv')]
+
+    Options:
+     * required_tags - a list of image tags to return, and to fail if not all are \
+                       present. Only these tags are read from the database.
+     * select_tags - if provided, only the images whose tags match these are \
+                     read, as :func:`ImageMetaTag.db.select_dbcr_by_tags`.
+     * chunk_size - the number of rows to fetch from the database at a time. \
+                    (default 10000)
+
+    Returns:
+     * a numpy array of filenames
+     * a dictionary, by tag name, of (codes, values) where codes is a numpy \
+       integer array, the same length as the filenames, and values is the \
+       list of unique tag values.
+
+    Will return None, None if there is a problem.
+    '''
+    if db_file is None:
+        return None, None
+    if not os.path.isfile(db_file):
+        return None, None
+
+    n_tries = 1
+    read_db = False
+    while not read_db and n_tries <= db_attempts:
+        try:
+            dbcn, dbcr = open_db_file(db_file, timeout=db_timeout)
+            fnames, columns = read_columnar_from_dbcursor(dbcr,
+                                                          required_tags=required_tags,
+                                                          select_tags=select_tags,
+                                                          chunk_size=chunk_size)
+            dbcn.close()
+            read_db = True
+        except sqlite3.OperationalError as op_err:
+            if 'database is locked' in repr(op_err):
+                print('%s database timeout reading from file "%s", %s s' \
+                        % (dt_now_str(), db_file, n_tries * db_timeout))
+                n_tries += 1
+                last_err = op_err
+            elif 'no such table: {}'.format(SQLITE_IMG_INFO_TABLE) in repr(op_err):
+                return None, None
+            else:
+                msg = '{} for file {}'.format(op_err, db_file)
+                raise sqlite3.OperationalError(msg)
+
+    if n_tries > db_attempts:
+        msg = '{} for file {}'.format(last_err, db_file)
+        raise sqlite3.OperationalError(msg)
+
+    return fnames, columns
+
+
+def iter_rows(db_file, required_tags=None, select_tags=None, batch_size=10000,
+              tag_strings=None, as_batches=False,
+              db_timeout=DEFAULT_DB_TIMEOUT,
+              db_attempts=DEFAULT_DB_ATTEMPTS):
+    '''
+    A generator over the images in the database written by write_img_to_dbfile,
+    which yields (filename, img_info) for each image, as it is read.
+    Unlike :func:`ImageMetaTag.db.read`, the whole database is never held in
+    memory, so this can be used to stream through very large databases::
+
+        for img_file, img_info in iter_rows(db_file, select_tags={'model': 'ukv'}):
+            ...
+
+    The database is kept open until the iteration is complete.
+
+    Options:
+     * required_tags - a list of image tags to return, and to fail if not all are \
+                       present. Only these tags are read from the database.
+     * select_tags - if provided, only the images whose tags match these are \
+                     read, as :func:`ImageMetaTag.db.select_dbcr_by_tags`.
+     * batch_size - the number of rows to fetch from the database at a time. \
+                    (default 10000)
+     * tag_strings - an input list that will be populated with the unique values of \
+                     the image tags, as :func:`ImageMetaTag.db.read`.
+     * as_batches - if True, a list of (filename, img_info) is yielded for each \
+                    batch of rows, rather than one image at a time.
+
+    Yields nothing if the database file does not exist or is empty.
+    '''
+    if db_file is None or not os.path.isfile(db_file):
+        return
+
+    # retry the select, before anything has been yielded:
+    n_tries = 1
+    started = False
+    while not started and n_tries <= db_attempts:
+        dbcn = None
+        try:
+            dbcn, dbcr = open_db_file(db_file, timeout=db_timeout)
+            tag_keys = _execute_iter_select(dbcr, required_tags, select_tags)
+            rows = dbcr.fetchmany(batch_size)
+            started = True
+        except sqlite3.OperationalError as op_err:
+            if dbcn is not None:
+                dbcn.close()
+            if 'database is locked' in repr(op_err):
+                print('%s database timeout reading from file "%s", %s s' \
+                        % (dt_now_str(), db_file, n_tries * db_timeout))
+                n_tries += 1
+                last_err = op_err
+            elif 'no such table: {}'.format(SQLITE_IMG_INFO_TABLE) in repr(op_err):
+                return
+            else:
+                msg = '{} for file {}'.format(op_err, db_file)
+                raise sqlite3.OperationalError(msg)
+
+    if n_tries > db_attempts:
+        msg = '{} for file {}'.format(last_err, db_file)
+        raise sqlite3.OperationalError(msg)
+
+    try:
+        for out in _iter_img_info(dbcr, tag_keys, rows, batch_size,
+                                  tag_strings, as_batches):
+            yield out
+    finally:
+        dbcn.close()
+
+
 def merge_db_files(main_db_file, add_db_file, delete_add_db=False,
                    delete_added_entries=False, attempt_replace=False,
                    add_strict=False,
                    db_timeout=DEFAULT_DB_TIMEOUT,
-                   db_attempts=DEFAULT_DB_ATTEMPTS):
+                   db_attempts=DEFAULT_DB_ATTEMPTS,
+                   verbose=False):
     '''
-    Merges two ImageMetaTag database files, with the contents of add_db_file
-    added to the main_db_file. The databases should have the same tags within
-    them for the merge to work.
+    Merges ImageMetaTag database files, with the contents of add_db_file
+    added to the main_db_file. add_db_file can be a single file, or a list
+    of files to add.
+
+    The files are attached to the main database, so the images are copied by
+    sqlite with one INSERT ... SELECT per file, rather than being read into
+    python. As many files as sqlite can attach at once (usually 10) are added
+    in a single transaction. Tags that are in the added files but not in the
+    main database are added to it, and images in the main database are given
+    the value 'None' for tags that an added file does not have.
 
     Options:
 
-    * add_strict - passed into :func:`ImageMetaTag.db.write_img_to_open_db`
-    * attempt_replace - passed to :func:`ImageMetaTag.db.write_img_to_open_db`
-    * delete_add_db - if True, the added file will be deleted afterwards
+    * add_strict - if True, a ValueError is raised if an added file has tags \
+                   that are not in the main database, as \
+                   :func:`ImageMetaTag.db.write_img_to_open_db`.
+    * attempt_replace - if True, images already in the main database are \
+                        replaced by those added, otherwise they are ignored, \
+                        as :func:`ImageMetaTag.db.write_img_to_open_db`. \
+                        Images with a hash (from :func:`ImageMetaTag.savefig` \
+                        with skip_unchanged) always replace.
+    * delete_add_db - if True, the added files will be deleted afterwards
     * delete_added_entries - if delete_add_db is False, this will keep the \
                              add_db_file but remove the entries from it which \
-                             were added to the main_db_file. This is useful \
+                             were added to the main_db_file. This is done in \
+                             the same transaction as the merge, so is safe \
                              if parallel processes are writing to the \
                              databases. Ignored if delete_add_db is True.
+    * db_timeout - the database timeout (in seconds).
+    * db_attempts - the number of attempts to lock the databases.
+    * verbose - verbose output.
+
+    Returns the number of images in the added files (including any that
+    were ignored, as they were already in the main database).
     '''
+    if isinstance(add_db_file, (list, tuple)):
+        add_db_files = list(add_db_file)
+    else:
+        add_db_files = [add_db_file]
+    # attaching a file that doesn't exist would create it:
+    src_files = [x for x in add_db_files if os.path.isfile(x)
+                 and os.path.abspath(x) != os.path.abspath(main_db_file)]
 
-    # read what we want to add in:
-    add_filelist, add_tags = read(add_db_file, db_timeout=db_timeout, db_attempts=db_attempts)
-    if add_filelist is not None:
-        if len(add_filelist) > 0:
-            n_tries = 1
-            wrote_db = False
-            while not wrote_db and n_tries <= db_attempts:
-                try:
-                    # open the main database
-                    dbcn, dbcr = open_db_file(main_db_file, timeout=db_timeout)
-                    # and add in the new contents:
-                    for add_file, add_info in add_tags.items():
-                        write_img_to_open_db(dbcr, add_file, add_info,
-                                             add_strict=add_strict,
-                                             attempt_replace=attempt_replace)
-                    dbcn.commit()
-                    # if we got here, then we're good!
-                    wrote_db = True
-                    # finally close:
-                    dbcn.close()
-                except sqlite3.OperationalError as op_err:
-                    if 'database is locked' in repr(op_err):
-                        # database being locked is what the retries and timeouts are for:
-                        print('%s database timeout writing to file "%s", %s s' \
-                                        % (dt_now_str(), main_db_file, n_tries * db_timeout))
-                        n_tries += 1
-                    else:
-                        # everything else needs to be reported and raised immediately:
-                        msg = '{} for file {}'.format(op_err, main_db_file)
-                        raise sqlite3.OperationalError(msg)
-
-            # if we went through all the attempts then it is time to raise the error:
-            if n_tries > db_attempts:
-                msg = '{} for file {}'.format(op_err, main_db_file)
-                raise sqlite3.OperationalError(msg)
+    truncate = delete_added_entries and not delete_add_db
+    n_merged = _merge_db_files(main_db_file, src_files, attempt_replace, add_strict,
+                               truncate, db_timeout, db_attempts, verbose)
 
-    # delete or tidy:
     if delete_add_db:
-        rmfile(add_db_file)
-    elif delete_added_entries:
-        del_plots_from_dbfile(add_db_file, add_filelist, do_vacuum=False,
-                              allow_retries=True, skip_warning=True)
+        for src_file in src_files:
+            rmfile(src_file)
+    return n_merged
+
+
+def _merge_db_files(db_file, src_files, attempt_replace, add_strict, truncate,
+                    db_timeout, db_attempts, verbose):
+    '''
+    Copies the images from a list of database files (src_files) into db_file,
+    attaching as many of them at once as sqlite allows. Returns the number of
+    images in the src_files.
+    '''
+    if not src_files:
+        return 0
+
+    dbcn = _connect(db_file, timeout=db_timeout)
+    try:
+        n_attach = _max_attached(dbcn)
+        n_merged = 0
+        for i_st in range(0, len(src_files), n_attach):
+            group = src_files[i_st:i_st + n_attach]
+            n_merged += _attach_and_merge_retry(dbcn, group, attempt_replace,
+                                                add_strict, truncate, db_file,
+                                                db_timeout, db_attempts)
+            if verbose:
+                msg = '{} merged {} of {} database files, {} images so far'
+                print(msg.format(dt_now_str(), i_st + len(group), len(src_files), n_merged))
+        journal_mode = dbcn.execute('PRAGMA journal_mode').fetchone()[0]
+        if journal_mode.lower() == 'wal':
+            # that could have been a lot of pages, so get them out of the log:
+            dbcn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+    finally:
+        dbcn.close()
+    return n_merged
+
+
+class DbConfig(object):
+    '''
+    The sqlite settings (pragmas) used whenever :mod:`ImageMetaTag.db` opens a
+    database file. The configuration in use is set by
+    :func:`ImageMetaTag.db.set_db_config`. Any setting that is None is left as
+    the sqlite default, which is what ImageMetaTag has always used.
+
+    Options:
+
+    * journal_mode - the sqlite journal mode. 'WAL' (write-ahead logging) lets \
+                     processes read the database (such as when building web \
+                     pages) while others are writing to it, without blocking \
+                     each other. WAL is stored in the database file, so once \
+                     set, it is used by everything that opens it. It does \
+                     not work on network file systems (e.g. NFS), and \
+                     anything reading the database needs to be able to write \
+                     to its directory.
+    * synchronous - how carefully sqlite waits for data to reach the disk: \
+                    'OFF', 'NORMAL' or 'FULL'. 'NORMAL' is safe, and much \
+                    quicker, with WAL.
+    * cache_size - the sqlite page cache size. Positive values are a number \
+                   of pages, negative values a number of KiB.
+    * mmap_size - the maximum number of bytes of the database file to access \
+                  through memory mapping, which can speed up reads.
+    * busy_timeout - how long, in seconds, to wait for a locked database \
+                     before giving up. If None, the timeout argument of the \
+                     function opening the database is used (as before).
+    * wal_autocheckpoint - in WAL mode, the number of pages the write-ahead \
+                           log can reach before it is checkpointed (copied \
+                           back into the database file) automatically. \
+                           See also :func:`ImageMetaTag.db.checkpoint`.
+    '''
+
+    def __init__(self, journal_mode=None, synchronous=None, cache_size=None,
+                 mmap_size=None, busy_timeout=None, wal_autocheckpoint=None):
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.busy_timeout = busy_timeout
+        self.wal_autocheckpoint = wal_autocheckpoint
+
+    def __repr__(self):
+        settings = ['{}={!r}'.format(key, val) for key, val in sorted(self.__dict__.items())]
+        return 'DbConfig({})'.format(', '.join(settings))
+
+    def pragmas(self):
+        'Returns the list of PRAGMA statements that apply this configuration'
+        pragmas = []
+        if self.journal_mode is not None:
+            pragmas.append('PRAGMA journal_mode={}'.format(self.journal_mode))
+        if self.synchronous is not None:
+            pragmas.append('PRAGMA synchronous={}'.format(self.synchronous))
+        if self.cache_size is not None:
+            pragmas.append('PRAGMA cache_size={:d}'.format(self.cache_size))
+        if self.mmap_size is not None:
+            pragmas.append('PRAGMA mmap_size={:d}'.format(self.mmap_size))
+        if self.busy_timeout is not None:
+            pragmas.append('PRAGMA busy_timeout={:d}'.format(int(1000 * self.busy_timeout)))
+        if self.wal_autocheckpoint is not None:
+            pragmas.append('PRAGMA wal_autocheckpoint={:d}'.format(self.wal_autocheckpoint))
+        return pragmas
+
+    def apply(self, dbcn):
+        'Applies the configuration to an open database connection'
+        for pragma in self.pragmas():
+            dbcn.execute(pragma)
+
+
+# the configuration used when opening database files, set by set_db_config:
+_DB_CONFIG = DbConfig()
+
+
+def set_db_config(db_config=None, **kwargs):
+    '''
+    Sets the :class:`ImageMetaTag.db.DbConfig` used by all of the functions in
+    :mod:`ImageMetaTag.db` when they open a database file, either as a DbConfig
+    or as keyword arguments to create one. For example, to let web pages be
+    built while plots are still being added to the database::
+
+        ImageMetaTag.db.set_db_config(journal_mode='WAL', synchronous='NORMAL')
+
+    With no arguments, the sqlite defaults are restored.
+    Returns the previous configuration.
+    '''
+    global _DB_CONFIG
+    if db_config is None:
+        db_config = DbConfig(**kwargs)
+    elif kwargs:
+        raise ValueError('Supply either a DbConfig or keyword arguments, not both')
+    elif not isinstance(db_config, DbConfig):
+        raise ValueError('db_config must be an ImageMetaTag.db.DbConfig')
+    prev_config = _DB_CONFIG
+    _DB_CONFIG = db_config
+    return prev_config
+
+
+def get_db_config():
+    'Returns the :class:`ImageMetaTag.db.DbConfig` currently in use'
+    return _DB_CONFIG
+
+
+def _connect(db_file, timeout=DEFAULT_DB_TIMEOUT, **kwargs):
+    'opens a connection to a database file, with the current DbConfig applied'
+    new_file = not os.path.isfile(db_file) or os.path.getsize(db_file) == 0
+    dbcn = sqlite3.connect(db_file, timeout=timeout, **kwargs)
+    try:
+        if new_file:
+            # new databases can give back the space of deleted images without a full
+            # VACUUM, which has to be set before anything (even WAL) is written:
+            dbcn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        _DB_CONFIG.apply(dbcn)
+    except:
+        dbcn.close()
+        raise
+    return dbcn
+
+
+def checkpoint(db_file, mode='PASSIVE', timeout=DEFAULT_DB_TIMEOUT):
+    '''
+    Checkpoints a database file that is in WAL journal mode (see
+    :class:`ImageMetaTag.db.DbConfig`), copying the contents of its
+    write-ahead log back into the database file. sqlite does this
+    automatically as the log grows, but an explicit checkpoint is useful
+    after writing a lot of images, or before copying the database file.
+
+    Options:
+
+    * mode - the checkpoint mode: 'PASSIVE' does as much as it can without \
+             waiting for anything, 'FULL' and 'RESTART' wait for writers to \
+             finish, and 'TRUNCATE' also empties the write-ahead log file.
+    * timeout - the database timeout (in seconds).
+
+    Returns a tuple of (busy, log pages, checkpointed pages) as reported by
+    sqlite; busy is 1 if the checkpoint could not be completed. For a
+    database that is not in WAL mode, this does nothing and returns
+    (0, -1, -1).
+    '''
+    if mode.upper() not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+        msg = 'Invalid checkpoint mode "{}"'
+        raise ValueError(msg.format(mode))
+    dbcn = _connect(db_file, timeout=timeout)
+    try:
+        result = dbcn.execute('PRAGMA wal_checkpoint({})'.format(mode.upper())).fetchone()
+    finally:
+        dbcn.close()
+    return tuple(result)
 
 
 def open_or_create_db_file(db_file, img_info, restart_db=False, timeout=DEFAULT_DB_TIMEOUT):
@@ -248,7 +620,7 @@ def open_or_create_db_file(db_file, img_info, restart_db=False, timeout=DEFAULT_
         if os.path.isfile(db_file):
             os.remove(db_file)
         # create a new database file:
-        dbcn = sqlite3.connect(db_file)
+        dbcn = _connect(db_file, timeout=timeout)
         dbcr = dbcn.cursor()
         # and create the table:
         create_table_for_img_info(dbcr, img_info)
@@ -293,43 +665,71 @@ def create_table_for_img_info(dbcr, img_info):
 def open_db_file(db_file, timeout=DEFAULT_DB_TIMEOUT):
     '''
     Just opens an existing db_file, using timeouts but no retries.
+    The sqlite settings set by :func:`ImageMetaTag.db.set_db_config` are applied.
 
     Returns an open database connection (dbcn) and cursor (dbcr)
     '''
 
-    dbcn = sqlite3.connect(db_file, timeout=timeout)
+    dbcn = _connect(db_file, timeout=timeout)
     dbcr = dbcn.cursor()
 
     return dbcn, dbcr
 
 
-def read_db_file_to_mem(db_file, timeout=DEFAULT_DB_TIMEOUT):
+def read_db_file_to_mem(db_file, timeout=DEFAULT_DB_TIMEOUT, read_only=False):
     '''
     Opens a pre-existing database file into a copy held in memory. This can be accessed much
     faster when doing extenstive work (a lot of select operations, for instance).
 
-    There is a time cost in doing this; it takes a few seconds to read in a large database,
-    so it is only worth doing when doing a lot of operations.
+    The copy is made page by page with the sqlite backup API, in a single read of the
+    database file, so it is a consistent snapshot of the database even if it is being
+    written to at the time. This takes milliseconds, even for large databases (250k rows).
 
-    Tests on selects on a large-ish database (250k rows) suggested it was worth doing
-    for > 100 selects.
+    Options:
+     * timeout - the timeout for reading the database file
+     * read_only - if True, the copy in memory cannot be modified, and the connection \
+                   can be used from several threads, so one snapshot can be used by \
+                   all of the selects (:func:`ImageMetaTag.db.select_dbcr_by_tags`) \
+                   needed to build a set of pages.
 
     Returns an open database connection (dbcn) and cursor (dbcr)
+
+    A cursor must not be shared between threads, even with read_only. Each thread
+    should make its own from the connection, with dbcn.cursor()::
+
+        dbcn, _ = ImageMetaTag.db.read_db_file_to_mem(db_file, read_only=True)
+
+        def select_page(select_tags):
+            # run by each thread, with its own cursor:
+            dbcr = dbcn.cursor()
+            return ImageMetaTag.db.select_dbcr_by_tags(dbcr, select_tags)
     '''
 
-    # read the database into an in-memory file object:
-    #dbcn = sqlite3.connect(db_file)
-    dbcn, _ = open_db_file(db_file, timeout=timeout)
-    memfile = StringIO()
-    for line in dbcn.iterdump():
-        memfile.write(u'{}\n'.format(line))
-    dbcn.close()
-    memfile.seek(0)
+    src_dbcn, _ = open_db_file(db_file, timeout=timeout)
+    # a read only snapshot is never written to, so the connection can be used by several
+    # threads (each with their own cursor):
+    dbcn = sqlite3.connect(":memory:", check_same_thread=not read_only)
+    try:
+        if hasattr(src_dbcn, 'backup'):
+            # copy the database pages straight into memory:
+            src_dbcn.backup(dbcn)
+        else:
+            # without the backup API (python < 3.7), dump the database to SQL and
+            # execute that in memory, which is much slower:
+            memfile = StringIO()
+            for line in src_dbcn.iterdump():
+                memfile.write(u'{}\n'.format(line))
+            memfile.seek(0)
+            dbcn.cursor().executescript(memfile.read())
+            dbcn.commit()
+    except:
+        dbcn.close()
+        raise
+    finally:
+        src_dbcn.close()
 
-    # Create a database in memory and import from memfile
-    dbcn = sqlite3.connect(":memory:")
-    dbcn.cursor().executescript(memfile.read())
-    dbcn.commit()
+    if read_only:
+        dbcn.execute('PRAGMA query_only = ON')
     dbcr = dbcn.cursor()
 
     return dbcn, dbcr
@@ -344,15 +744,10 @@ def write_img_to_open_db(dbcr, filename, img_info,
     * add_strict: if True then it will report a ValueError if you \
                   try and include fields that aren't defined in the table. \
                   If False, then adding a new metadata tag to the \
-                  database will cause it be rewritten with the new item \
-                  as a new column using \
-                  :func:`ImageMetaTag.db.recrete_table_new_cols` \
+                  database will add it to the table as a new column using \
+                  :func:`ImageMetaTag.db.add_table_cols` \
                   All pre-existing images will have \
-                  the new tag set to 'None'. It is best to avoid using \
-                  this functionality as it can be slow for large \
-                  databases. Instead, all images should be ideally have \
-                  all expected metadata tags included from the start \
-                  but set to 'None' where they are not used.
+                  the new tag set to 'None'.
     * attempt_replace: if True, then it will attempt to replace a database \
                   entry if the image is already present. \
                   Otherwise it will ignore it.
@@ -383,9 +778,8 @@ def write_img_to_open_db(dbcr, filename, img_info,
                    'include fields not present in the database: {}')
             raise ValueError(msg.format(invalid_fieldnames))
         else:
-            # need to recreate the database table afresh, because if we
-            # don't then it won't be correctly labelled by column:
-            recrete_table_new_cols(dbcr, field_names, invalid_fieldnames)
+            # add the new columns to the table:
+            _add_new_cols(dbcr, field_names, invalid_fieldnames)
 
     # add in the right number of ?
     add_command = add_command[0:-1] + ') VALUES(' + '?,'*(len(add_list)-1) + '?)'
@@ -416,6 +810,567 @@ def write_img_to_open_db(dbcr, filename, img_info,
         pass
 
 
+def write_imgs_to_open_db(dbcr, img_infos, add_strict=False,
+                          attempt_replace=False, img_hashes=None):
+    '''
+    Adds the metadata of many images to an open database cursor (dbcr), as
+    :func:`ImageMetaTag.db.write_img_to_open_db` but much quicker: the table
+    is checked, and if necessary given new columns, once for all the images,
+    then the images are grouped by the tags they have and each group is
+    inserted with a single executemany.
+
+    Arguments:
+
+    * img_infos - a dictionary of {img_filename: img_info}, where each \
+                  img_info is a dictionary of {tag_name: value} pairs.
+
+    Options:
+
+    * add_strict - if True then it will report a ValueError if any of the \
+                   images include tags that aren't defined in the table. \
+                   If False, then the table is recreated with the new \
+                   tags as new columns (see \
+                   :func:`ImageMetaTag.db.add_table_cols`).
+    * attempt_replace - if True, images already in the database are \
+                        replaced, otherwise they are ignored.
+    * img_hashes - a dictionary of {img_filename: hash} to be stored, as \
+                   :func:`ImageMetaTag.db.write_img_hash_to_open_db`.
+
+    Returns the number of images written.
+    '''
+    # the hashes are written even without any images, as the images they
+    # belong to can be written by another call:
+    if img_hashes:
+        create_command = 'CREATE TABLE IF NOT EXISTS {}({} TEXT PRIMARY KEY, {} TEXT)'
+        dbcr.execute(create_command.format(SQLITE_IMG_HASH_TABLE, SQLITE_IMG_INFO_FNAME,
+                                           SQLITE_IMG_HASH))
+        add_command = 'INSERT OR REPLACE INTO {}({}, {}) VALUES(?, ?)'
+        dbcr.executemany(add_command.format(SQLITE_IMG_HASH_TABLE, SQLITE_IMG_INFO_FNAME,
+                                            SQLITE_IMG_HASH), img_hashes.items())
+
+    if len(img_infos) == 0:
+        return 0
+
+    # group the images by the tags they have, keeping the order of the tags
+    # as they were first seen, for new table columns:
+    groups = {}
+    all_keys = []
+    for filename, img_info in img_infos.items():
+        keys = tuple(img_info.keys())
+        group = groups.get(keys)
+        if group is None:
+            groups[keys] = group = []
+            all_keys.extend([x for x in keys if x not in all_keys])
+        group.append(filename)
+
+    if SQLITE_IMG_INFO_TABLE not in list_tables(dbcr):
+        create_table_for_img_info(dbcr, dict([(x, '') for x in all_keys]))
+    field_names = [db_name_to_info_key(x) for x in
+                   _table_cols(dbcr, 'main', SQLITE_IMG_INFO_TABLE)]
+    invalid_fieldnames = [x for x in all_keys if x not in field_names]
+    if invalid_fieldnames:
+        if add_strict:
+            msg = ('Attempting to add lines to the database that '
+                   'include fields not present in the database: {}')
+            raise ValueError(msg.format(invalid_fieldnames))
+        else:
+            _add_new_cols(dbcr, field_names, invalid_fieldnames)
+
+    or_cmd = 'REPLACE' if attempt_replace else 'IGNORE'
+    for keys, filenames in groups.items():
+        add_command = 'INSERT OR {} INTO {}({}{}) VALUES(?{})'.format(
+            or_cmd, SQLITE_IMG_INFO_TABLE, SQLITE_IMG_INFO_FNAME,
+            ''.join([', "{}"'.format(info_key_to_db_name(x)) for x in keys]),
+            ', ?' * len(keys))
+        dbcr.executemany(add_command,
+                         ([fname] + [img_infos[fname][x] for x in keys]
+                          for fname in filenames))
+
+    return len(img_infos)
+
+
+def write_img_hash_to_open_db(dbcr, filename, img_hash):
+    '''
+    Stores a hash of the inputs used to create an image in an open database cursor
+    (dbcr), so that :func:`ImageMetaTag.savefig` can tell whether the image needs
+    to be created again. The hashes are held in a separate table to the image
+    metadata, so they are never read as an image tag.
+    '''
+    create_command = 'CREATE TABLE IF NOT EXISTS {}({} TEXT PRIMARY KEY, {} TEXT)'
+    dbcr.execute(create_command.format(SQLITE_IMG_HASH_TABLE, SQLITE_IMG_INFO_FNAME,
+                                       SQLITE_IMG_HASH))
+    add_command = 'INSERT OR REPLACE INTO {}({}, {}) VALUES(?, ?)'
+    dbcr.execute(add_command.format(SQLITE_IMG_HASH_TABLE, SQLITE_IMG_INFO_FNAME,
+                                    SQLITE_IMG_HASH), (filename, img_hash))
+
+
+def read_img_hash(db_file, img_filename, timeout=DEFAULT_DB_TIMEOUT):
+    '''
+    Returns the hash stored by :func:`ImageMetaTag.db.write_img_hash_to_open_db`
+    for an image in a database file. Returns None if the image, or its hash, is not
+    in the database, or if the database could not be read in time.
+    '''
+    if db_file is None or not os.path.isfile(db_file):
+        return None
+
+    # join to the metadata, so an image that has been deleted has no hash:
+    sel_command = ('SELECT h.{2} FROM {0} h JOIN {1} i ON h.{3} = i.{3} '
+                   'WHERE h.{3} = ?').format(SQLITE_IMG_HASH_TABLE, SQLITE_IMG_INFO_TABLE,
+                                             SQLITE_IMG_HASH, SQLITE_IMG_INFO_FNAME)
+    dbcn, dbcr = open_db_file(db_file, timeout=timeout)
+    try:
+        result = dbcr.execute(sel_command, (img_filename,)).fetchone()
+    except sqlite3.OperationalError as op_err:
+        if 'no such table' in repr(op_err) or 'database is locked' in repr(op_err):
+            # no hashes, or can't tell, so the image will need to be created:
+            result = None
+        else:
+            msg = '{} for file {}'.format(op_err, db_file)
+            raise sqlite3.OperationalError(msg)
+    finally:
+        dbcn.close()
+
+    if result is None:
+        return None
+    return result[0]
+
+
+class DbWriter(object):
+    '''
+    Writes image metadata to a database file, like
+    :func:`ImageMetaTag.db.write_img_to_dbfile`, but keeps the database
+    open and buffers the images, committing them in batches. This avoids
+    opening, reading the table structure, locking and committing the
+    database for every image, which is slow when lots of processes are
+    writing to the same database.
+
+    The buffered images are committed when there are commit_rows of them,
+    or when an image is written more than commit_seconds after the last
+    commit, and also by :func:`flush` or :func:`close`. Until then, they
+    are not seen by anything reading the database.
+
+    Usually, a DbWriter is obtained using
+    :func:`ImageMetaTag.db.get_db_writer`, which keeps one per database
+    file in each process and flushes them when the process exits. This is
+    what :func:`ImageMetaTag.savefig` does when db_buffered=True.
+
+    Arguments:
+
+    * db_file - the database file to write to. If it does not exist, it \
+                will be created.
+
+    Options:
+
+    * commit_rows - the number of images to buffer before committing.
+    * commit_seconds - the longest time, in seconds, to wait before \
+                       committing buffered images, when another is written.
+    * timeout - the database timeout (in seconds).
+    * attempts - the number of attempts to commit, if the database is \
+                 locked.
+    * add_strict - passed into :func:`ImageMetaTag.db.write_img_to_open_db`
+    * attempt_replace - passed to \
+                        :func:`ImageMetaTag.db.write_img_to_open_db`, unless \
+                        it is set for an image in :func:`write`.
+
+    A DbWriter can be shared between threads, but not between processes.
+    If a commit fails for any reason other than the database being locked,
+    the buffered images are discarded and the error is raised.
+    '''
+
+    def __init__(self, db_file, commit_rows=100, commit_seconds=5.0,
+                 timeout=DEFAULT_DB_TIMEOUT, attempts=DEFAULT_DB_ATTEMPTS,
+                 add_strict=False, attempt_replace=False):
+        self.db_file = db_file
+        self.commit_rows = commit_rows
+        self.commit_seconds = commit_seconds
+        self.timeout = timeout
+        self.attempts = attempts
+        self.add_strict = add_strict
+        self.attempt_replace = attempt_replace
+        self.pid = os.getpid()
+        self._lock = threading.RLock()
+        self._rows = []
+        self._last_commit = time.time()
+        self._dbcn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def write(self, img_filename, img_info, attempt_replace=None,
+              img_hash=None):
+        '''
+        Adds an image's metadata to the buffer, committing the buffer if it
+        is full or it is time to do so. The arguments are as
+        :func:`ImageMetaTag.db.write_img_to_dbfile`.
+        '''
+        if len(img_info) == 0:
+            raise ValueError('Size of image info dict is zero')
+        if attempt_replace is None:
+            attempt_replace = self.attempt_replace
+        with self._lock:
+            self._rows.append((img_filename, img_info, attempt_replace,
+                               img_hash))
+            if (len(self._rows) >= self.commit_rows or
+                    time.time() - self._last_commit >= self.commit_seconds):
+                self.flush()
+
+    def flush(self):
+        'Commits all of the buffered images to the database'
+        with self._lock:
+            if self._rows:
+                self._commit_rows()
+            self._last_commit = time.time()
+
+    def close(self):
+        'Commits all of the buffered images, then closes the database'
+        with self._lock:
+            try:
+                self.flush()
+            finally:
+                if self._dbcn is not None:
+                    self._dbcn.close()
+                    self._dbcn = None
+
+    def _commit_rows(self):
+        'writes and commits the buffer, with retries if the database is locked'
+        # the images that are ignored if already present, then those that
+        # replace, which gives the same result as writing them one by one:
+        ignore_infos = {}
+        replace_infos = {}
+        img_hashes = {}
+        for img_filename, img_info, attempt_replace, img_hash in self._rows:
+            if attempt_replace:
+                replace_infos[img_filename] = img_info
+            elif img_filename not in ignore_infos:
+                ignore_infos[img_filename] = img_info
+            if img_hash is not None:
+                img_hashes[img_filename] = img_hash
+
+        n_tries = 1
+        wrote_db = False
+        while not wrote_db and n_tries <= self.attempts:
+            try:
+                if self._dbcn is None:
+                    self._open(self._rows[0][1])
+                dbcr = self._dbcn.cursor()
+                write_imgs_to_open_db(dbcr, ignore_infos, add_strict=self.add_strict,
+                                      attempt_replace=False, img_hashes=img_hashes)
+                write_imgs_to_open_db(dbcr, replace_infos, add_strict=self.add_strict,
+                                      attempt_replace=True)
+                self._dbcn.commit()
+                wrote_db = True
+            except sqlite3.OperationalError as op_err:
+                self._rollback()
+                if 'database is locked' in repr(op_err):
+                    # database being locked is what the retries and timeouts are for:
+                    print('%s database timeout writing to file "%s", %s s'
+                          % (dt_now_str(), self.db_file, n_tries * self.timeout))
+                    n_tries += 1
+                    last_err = op_err
+                else:
+                    self._rows = []
+                    msg = '{} for file {}'.format(op_err, self.db_file)
+                    raise sqlite3.OperationalError(msg)
+            except Exception:
+                self._rollback()
+                self._rows = []
+                raise
+
+        # if we went through all the attempts then it is time to raise the error:
+        if not wrote_db:
+            msg = '{} for file {}'.format(last_err, self.db_file)
+            raise sqlite3.OperationalError(msg)
+        self._rows = []
+
+    def _open(self, img_info):
+        'opens the database, creating it if needed'
+        self._dbcn = _connect(self.db_file, timeout=self.timeout,
+                              check_same_thread=False)
+        dbcr = self._dbcn.cursor()
+        if SQLITE_IMG_INFO_TABLE not in list_tables(dbcr):
+            create_table_for_img_info(dbcr, img_info)
+
+    def _rollback(self):
+        'rolls back an uncommitted transaction'
+        if self._dbcn is not None:
+            try:
+                self._dbcn.rollback()
+            except sqlite3.Error:
+                # the connection is no good, so start again next time:
+                self._dbcn.close()
+                self._dbcn = None
+
+
+# the DbWriters used by get_db_writer, by (process id, db file):
+_DB_WRITERS = {}
+_DB_WRITERS_LOCK = threading.Lock()
+# the processes that will flush their DbWriters on exit:
+_DB_WRITERS_EXIT_PIDS = set()
+
+
+def get_db_writer(db_file, **kwargs):
+    '''
+    Returns the :class:`ImageMetaTag.db.DbWriter` for a database file in
+    the current process, creating it (with any keyword arguments given)
+    if there isn't one already.
+
+    The DbWriters are flushed by :func:`ImageMetaTag.db.flush_db_writers`,
+    which is also called automatically when the process exits, including
+    the worker processes of a multiprocessing.Pool that is closed and
+    joined (but not one that is terminated).
+    '''
+    key = (os.getpid(), os.path.abspath(db_file))
+    with _DB_WRITERS_LOCK:
+        writer = _DB_WRITERS.get(key)
+        if writer is None:
+            writer = DbWriter(db_file, **kwargs)
+            _DB_WRITERS[key] = writer
+            if key[0] not in _DB_WRITERS_EXIT_PIDS:
+                # multiprocessing worker processes do not run atexit
+                # functions, but do run their finalizers:
+                atexit.register(flush_db_writers)
+                multiprocessing.util.Finalize(None, flush_db_writers,
+                                              exitpriority=10)
+                _DB_WRITERS_EXIT_PIDS.add(key[0])
+    return writer
+
+
+def flush_db_writers(close=False):
+    '''
+    Flushes all of the :class:`ImageMetaTag.db.DbWriter` objects created by
+    :func:`ImageMetaTag.db.get_db_writer` in this process, so that their
+    images are in the database. If close is True, the DbWriters are also
+    closed and forgotten.
+    '''
+    pid = os.getpid()
+    with _DB_WRITERS_LOCK:
+        writers = [(key, writer) for key, writer in _DB_WRITERS.items()
+                   if key[0] == pid]
+        if close:
+            for key, _ in writers:
+                del _DB_WRITERS[key]
+    for _, writer in writers:
+        if close:
+            writer.close()
+        else:
+            writer.flush()
+
+
+def shard_db_file(db_file):
+    '''
+    Returns the name of the shard database file, for the current process,
+    that is used instead of db_file by :func:`ImageMetaTag.savefig` when
+    db_sharded=True. Shards are kept in the same directory as the db_file,
+    and are named after it, the host and the process id, so every process
+    has its own shard and never waits for another to unlock it.
+
+    The shards are added to the db_file by
+    :func:`ImageMetaTag.db.consolidate_shards`.
+    '''
+    root, ext = os.path.splitext(db_file)
+    return '{}.shard_{}_{}{}'.format(root, socket.gethostname(), os.getpid(), ext)
+
+
+def list_db_shards(db_file):
+    'Lists the shard files of a db_file, see :func:`ImageMetaTag.db.shard_db_file`'
+    db_dir, db_name = os.path.split(db_file)
+    root, ext = os.path.splitext(db_name)
+    prefix = '{}.shard_'.format(root)
+    # matched by name, rather than glob, so the db_file can contain anything:
+    shard_files = [os.path.join(db_dir, x) for x in os.listdir(db_dir or os.curdir)
+                   if x.startswith(prefix) and x.endswith(ext)]
+    # not the sqlite journal files:
+    return sorted([x for x in shard_files
+                   if not x.endswith(('-journal', '-wal', '-shm'))])
+
+
+def consolidate_shards(db_file, attempt_replace=False, add_strict=False,
+                       delete_shards=False, db_timeout=DEFAULT_DB_TIMEOUT,
+                       db_attempts=DEFAULT_DB_ATTEMPTS, verbose=False):
+    '''
+    Moves the images from all of the shards of a database file (see
+    :func:`ImageMetaTag.db.shard_db_file`) into the database file itself.
+
+    The shards are attached to the database, so the images are copied by
+    sqlite with INSERT ... SELECT statements rather than being read into
+    python. As many shards as sqlite can attach at once (usually 10) are
+    done in a single transaction, which also removes the images from the
+    shards, so this is safe to run while processes are still writing to
+    their shards: they just wait for the shard to be unlocked, as usual.
+
+    Options:
+
+    * attempt_replace - if True, images already in the database are \
+                        replaced by those in the shards, otherwise they \
+                        are ignored (as :func:`ImageMetaTag.db.write_img_to_open_db`). \
+                        Images with a hash (from :func:`ImageMetaTag.savefig` \
+                        with skip_unchanged) always replace, as savefig \
+                        only writes them when they have changed.
+    * add_strict - if True, a ValueError is raised if a shard has tags \
+                   that are not in the database. If False, they are added \
+                   to the database.
+    * delete_shards - if True, the (now empty) shard files are deleted. \
+                      Only use this when nothing is writing to the shards, \
+                      as a process with a shard open would carry on \
+                      writing to the deleted file.
+    * db_timeout - the database timeout (in seconds).
+    * db_attempts - the number of attempts to lock the database and shards.
+    * verbose - verbose output.
+
+    Returns the number of images taken from the shards (including any that
+    were ignored, as they were already in the database).
+    '''
+    shard_files = list_db_shards(db_file)
+    n_moved = _merge_db_files(db_file, shard_files, attempt_replace, add_strict,
+                              True, db_timeout, db_attempts, verbose)
+
+    if delete_shards:
+        for shard_file in shard_files:
+            rmfile(shard_file)
+    return n_moved
+
+
+def _max_attached(dbcn):
+    'the number of databases that can be attached to a connection'
+    try:
+        return dbcn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    except AttributeError:
+        # older pythons can't ask, so use the sqlite default:
+        return 10
+
+
+def _attach_and_merge_retry(dbcn, src_files, attempt_replace, add_strict,
+                            truncate, db_file, db_timeout, db_attempts):
+    '''
+    Calls :func:`_attach_and_merge`, with retries if the database (or any
+    of the source files) is locked.
+    '''
+    n_tries = 1
+    merged = False
+    while not merged and n_tries <= db_attempts:
+        try:
+            n_merged = _attach_and_merge(dbcn, src_files, attempt_replace,
+                                         add_strict, truncate)
+            merged = True
+        except sqlite3.OperationalError as op_err:
+            if 'database is locked' in repr(op_err):
+                # database being locked is what the retries and timeouts are for:
+                print('%s database timeout writing to file "%s", %s s'
+                      % (dt_now_str(), db_file, n_tries * db_timeout))
+                n_tries += 1
+                last_err = op_err
+            else:
+                msg = '{} for file {}'.format(op_err, db_file)
+                raise sqlite3.OperationalError(msg)
+
+    # if we went through all the attempts then it is time to raise the error:
+    if not merged:
+        msg = '{} for file {}'.format(last_err, db_file)
+        raise sqlite3.OperationalError(msg)
+    return n_merged
+
+
+def _attach_and_merge(dbcn, src_files, attempt_replace=False, add_strict=False,
+                      truncate=False):
+    '''
+    Attaches some ImageMetaTag database files to an open database connection
+    (dbcn) and copies their images into its main database, in a single
+    transaction. If truncate is True, the images are also deleted from the
+    source files in the same transaction.
+
+    Returns the number of images in the source files.
+    '''
+    aliases = ['imt_src{}'.format(i) for i in range(len(src_files))]
+    dbcr = dbcn.cursor()
+    for src_file, alias in zip(src_files, aliases):
+        dbcr.execute('ATTACH DATABASE ? AS {}'.format(alias), (src_file,))
+    try:
+        # lock the main database and all of the sources, before looking at
+        # what is in them:
+        dbcr.execute('BEGIN IMMEDIATE')
+        try:
+            n_merged = 0
+            for alias in aliases:
+                n_merged += _merge_attached(dbcr, alias, attempt_replace,
+                                            add_strict, truncate)
+            dbcn.commit()
+        except:
+            dbcn.rollback()
+            raise
+    finally:
+        for alias in aliases:
+            dbcr.execute('DETACH DATABASE {}'.format(alias))
+    return n_merged
+
+
+def _merge_attached(dbcr, alias, attempt_replace, add_strict, truncate):
+    'copies the tables of an attached database into the main database'
+    src_tables = [x[0] for x in dbcr.execute(
+        "SELECT name FROM {}.sqlite_master WHERE type='table'".format(alias))]
+    if SQLITE_IMG_INFO_TABLE not in src_tables:
+        return 0
+    n_src = dbcr.execute('SELECT COUNT(*) FROM {}.{}'.format(
+        alias, SQLITE_IMG_INFO_TABLE)).fetchone()[0]
+    if n_src == 0:
+        return 0
+
+    src_cols = _table_cols(dbcr, alias, SQLITE_IMG_INFO_TABLE)
+    if SQLITE_IMG_INFO_TABLE not in list_tables(dbcr):
+        create_table_for_img_info(dbcr, dict([(db_name_to_info_key(x), '')
+                                              for x in src_cols[1:]]))
+    main_cols = _table_cols(dbcr, 'main', SQLITE_IMG_INFO_TABLE)
+    new_cols = [x for x in src_cols if x not in main_cols]
+    if new_cols:
+        if add_strict:
+            msg = ('Attempting to add images to the database that '
+                   'include fields not present in the database: {}')
+            raise ValueError(msg.format([db_name_to_info_key(x) for x in new_cols]))
+        _add_new_cols(dbcr, [db_name_to_info_key(x) for x in main_cols],
+                      [db_name_to_info_key(x) for x in new_cols])
+        main_cols = _table_cols(dbcr, 'main', SQLITE_IMG_INFO_TABLE)
+
+    # tags that the source doesn't have are set to 'None':
+    sel_cols = ['"{}"'.format(x) if x in src_cols else "'None'" for x in main_cols]
+    or_cmd = 'REPLACE' if attempt_replace else 'IGNORE'
+    ins_into = 'INTO main.{}({}) SELECT {} FROM {}.{}'.format(
+        SQLITE_IMG_INFO_TABLE, ', '.join(['"{}"'.format(x) for x in main_cols]),
+        ', '.join(sel_cols), alias, SQLITE_IMG_INFO_TABLE)
+    if SQLITE_IMG_HASH_TABLE in src_tables:
+        # images with a hash were written by savefig with skip_unchanged, because
+        # they had changed, so they always replace what is in the main database:
+        hashed = '{} IN (SELECT {} FROM {}.{})'.format(SQLITE_IMG_INFO_FNAME,
+                                                       SQLITE_IMG_INFO_FNAME, alias,
+                                                       SQLITE_IMG_HASH_TABLE)
+        dbcr.execute('INSERT OR REPLACE {} WHERE {}'.format(ins_into, hashed))
+        dbcr.execute('INSERT OR {} {} WHERE NOT {}'.format(or_cmd, ins_into, hashed))
+
+        create_command = 'CREATE TABLE IF NOT EXISTS main.{}({} TEXT PRIMARY KEY, {} TEXT)'
+        dbcr.execute(create_command.format(SQLITE_IMG_HASH_TABLE, SQLITE_IMG_INFO_FNAME,
+                                           SQLITE_IMG_HASH))
+        ins_hash = 'INSERT OR REPLACE INTO main.{0}({1}, {2}) SELECT {1}, {2} FROM {3}.{0}'
+        dbcr.execute(ins_hash.format(SQLITE_IMG_HASH_TABLE, SQLITE_IMG_INFO_FNAME,
+                                     SQLITE_IMG_HASH, alias))
+    else:
+        dbcr.execute('INSERT OR {} {}'.format(or_cmd, ins_into))
+
+    if truncate:
+        dbcr.execute('DELETE FROM {}.{}'.format(alias, SQLITE_IMG_INFO_TABLE))
+        if SQLITE_IMG_HASH_TABLE in src_tables:
+            dbcr.execute('DELETE FROM {}.{}'.format(alias, SQLITE_IMG_HASH_TABLE))
+    return n_src
+
+
+def _table_cols(dbcr, schema, table):
+    'lists the column names of a table, in a schema (main, or an attached database)'
+    return [x[1] for x in dbcr.execute('PRAGMA {}.table_info({})'.format(schema, table))]
+
+
 def list_tables(dbcr):
     'lists the tables present, from a database cursor'
     result = dbcr.execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()
@@ -424,7 +1379,7 @@ def list_tables(dbcr):
 
 
 def read_img_info_from_dbcursor(dbcr, required_tags=None, tag_strings=None,
-                                n_samples=None):
+                                n_samples=None, select_tags=None):
     '''
     Reads from an open database cursor (dbcr) for
     :func:`ImageMetaTag.db.read` and other routines.
@@ -437,29 +1392,399 @@ def read_img_info_from_dbcursor(dbcr, required_tags=None, tag_strings=None,
      * n_samples - if provided, only the given number of entries will be \
                    loaded from the database, at random. Must be an integer \
                    or None (default None)
+     * select_tags - if provided, only the entries that match these are read, \
+                     as :func:`ImageMetaTag.db.select_dbcr_by_tags`.
     '''
-    # read in the data from the database:
+    # read in the data from the database, only the required columns, and rows:
     if n_samples is None:
-        sel_com = 'SELECT * FROM {}'.format(SQLITE_IMG_INFO_TABLE)
-        db_contents = dbcr.execute(sel_com).fetchall()
+        sel_com, sel_values = _select_sql(dbcr, required_tags, select_tags)
+        dbcr.execute(sel_com, sel_values)
     else:
+        sel_cols = _select_columns(dbcr, required_tags)
+        sel_where, sel_values = _select_where(dbcr, select_tags)
         if not isinstance(n_samples, int):
             raise ValueError('n_samples must be an integer')
         elif n_samples < 1:
             raise ValueError('n_samples must be > 1')
         # read only a sample of lines:
-        read_cmd = ('SELECT * FROM {0} WHERE {1} IN (SELECT {1} FROM {0} '
+        read_cmd = ('SELECT {3} FROM {0} WHERE {1} IN (SELECT {1} FROM {0}{4} '
                     'ORDER BY RANDOM() LIMIT {2})')
         read_cmd = read_cmd.format(SQLITE_IMG_INFO_TABLE,
-                                   SQLITE_IMG_INFO_FNAME, n_samples)
-        db_contents = dbcr.execute(read_cmd).fetchall()
-    # and convert that to a useful dict/list combo:
-    filename_list, out_dict = process_select_star_from(db_contents, dbcr,
-                                                       required_tags=required_tags,
+                                   SQLITE_IMG_INFO_FNAME, n_samples,
+                                   sel_cols, sel_where)
+        dbcr.execute(read_cmd, sel_values)
+    # and convert that to a useful dict/list combo, streaming the rows from the
+    # cursor rather than holding them all in memory as well. The columns are
+    # already just the required_tags, so they don't need checking row by row:
+    filename_list, out_dict = process_select_star_from(_fetch_rows(dbcr), dbcr,
                                                        tag_strings=tag_strings)
     return filename_list, out_dict
 
 
+def _fetch_rows(dbcr, batch_size=10000):
+    'yields the rows from an executed cursor, fetching batch_size rows at a time'
+    rows = dbcr.fetchmany(batch_size)
+    while rows:
+        for row in rows:
+            yield row
+        rows = dbcr.fetchmany(batch_size)
+
+
+def iter_rows_from_dbcursor(dbcr, required_tags=None, select_tags=None,
+                            batch_size=10000, tag_strings=None, as_batches=False):
+    '''
+    Iterates over the images in an open database cursor (dbcr), for
+    :func:`ImageMetaTag.db.iter_rows`, with the same options and outputs.
+    The cursor must not be used for anything else until the iteration is complete.
+    '''
+    tag_keys = _execute_iter_select(dbcr, required_tags, select_tags)
+    rows = dbcr.fetchmany(batch_size)
+    for out in _iter_img_info(dbcr, tag_keys, rows, batch_size,
+                              tag_strings, as_batches):
+        yield out
+
+
+def _execute_iter_select(dbcr, required_tags, select_tags):
+    'executes the select for iter_rows, returning the tag names of the columns'
+    sel_com, sel_values = _select_sql(dbcr, required_tags, select_tags)
+    dbcr.execute(sel_com, sel_values)
+    return [db_name_to_info_key(x[0]) for x in dbcr.description[1:]]
+
+
+def _iter_img_info(dbcr, tag_keys, rows, batch_size, tag_strings, as_batches):
+    'yields (filename, img_info) from rows, and the rest of an executed cursor'
+    if tag_strings is None:
+        intern_str = str
+    else:
+        if not isinstance(tag_strings, list):
+            raise ValueError('Input tag_strings should be a list')
+        interner = _tag_strings_interner(tag_strings)
+        intern_str = lambda tag_val: interner(str(tag_val))
+    while rows:
+        batch = []
+        for row in rows:
+            img_info = {}
+            for tag_key, tag_val in zip(tag_keys, row[1:]):
+                img_info[tag_key] = intern_str(tag_val)
+            batch.append((str(row[0]), img_info))
+        if as_batches:
+            yield batch
+        else:
+            for out in batch:
+                yield out
+        rows = dbcr.fetchmany(batch_size)
+
+
+def read_columnar_from_dbcursor(dbcr, required_tags=None, select_tags=None,
+                                chunk_size=10000):
+    '''
+    Reads from an open database cursor (dbcr) for
+    :func:`ImageMetaTag.db.read_columnar`, with the same options and outputs.
+    '''
+    sel_com, sel_values = _select_sql(dbcr, required_tags, select_tags)
+    dbcr.execute(sel_com, sel_values)
+    tag_names = [db_name_to_info_key(x[0]) for x in dbcr.description[1:]]
+
+    # the codes for each tag, from a dictionary of value: code, are built up a
+    # chunk of rows at a time, so the rows are never all held in memory at once:
+    fname_chunks = []
+    tag_codes = [_ColumnCodes() for _ in tag_names]
+    code_chunks = [[] for _ in tag_names]
+    rows = dbcr.fetchmany(chunk_size)
+    while rows:
+        cols = list(zip(*rows))
+        fname_chunks.append(np.array([str(x) for x in cols[0]], dtype=object))
+        for codes, chunks, col in zip(tag_codes, code_chunks, cols[1:]):
+            chunks.append(np.fromiter(map(codes.__getitem__, map(str, col)),
+                                      dtype=np.int32, count=len(col)))
+        rows = dbcr.fetchmany(chunk_size)
+
+    if fname_chunks:
+        fnames = np.concatenate(fname_chunks)
+    else:
+        fnames = np.array([], dtype=object)
+    columns = {}
+    for tag_name, codes, chunks in zip(tag_names, tag_codes, code_chunks):
+        # use the smallest integer type that can hold the codes:
+        code_dtype = np.min_scalar_type(max(len(codes) - 1, 0))
+        if chunks:
+            code_arr = np.concatenate(chunks).astype(code_dtype)
+        else:
+            code_arr = np.array([], dtype=code_dtype)
+        columns[tag_name] = (code_arr, list(codes))
+    return fnames, columns
+
+
+class _ColumnCodes(dict):
+    'a dictionary of value: code, which gives new values the next code'
+    def __missing__(self, key):
+        code = self[key] = len(self)
+        return code
+
+
+def _select_sql(dbcr, required_tags, select_tags, count_usage=True):
+    'Returns the SELECT command, and its values, for required_tags and select_tags'
+    sel_cols = _select_columns(dbcr, required_tags)
+    sel_where, sel_values = _select_where(dbcr, select_tags, count_usage=count_usage)
+    sel_com = 'SELECT {} FROM {}{}'.format(sel_cols, SQLITE_IMG_INFO_TABLE, sel_where)
+    return sel_com, sel_values
+
+
+def _select_columns(dbcr, required_tags):
+    '''
+    Returns the list of columns to select, as a string, for a list of
+    required_tags (or * if it is None).
+    '''
+    if required_tags is None:
+        return '*'
+    if not isinstance(required_tags, list):
+        raise ValueError('Input required_tags should be a list of strings')
+    for test_str in required_tags:
+        if not isinstance(test_str, str):
+            raise ValueError('Input required_tags should be a list of strings')
+    db_names = [info_key_to_db_name(x) for x in required_tags]
+    table_cols = _table_cols(dbcr, 'main', SQLITE_IMG_INFO_TABLE)
+    if not all([x in table_cols for x in db_names]):
+        raise ValueError('Database entry does not contain all of the required_tags')
+    return ', '.join([SQLITE_IMG_INFO_FNAME] + ['"{}"'.format(x) for x in db_names])
+
+
+def _select_where(dbcr, select_tags, count_usage=True):
+    '''
+    Returns a WHERE clause, and a list of the values to go with it, for a
+    dictionary of select_tags (see :func:`ImageMetaTag.db.select_dbcr_by_tags`).
+    If count_usage, the select is counted for auto_index.
+    '''
+    if not select_tags:
+        return '', []
+
+    # keep a count of the tags used to select, for auto_index:
+    index_tags = _select_index_tags(select_tags)
+    if index_tags and count_usage:
+        _SELECT_TAG_USAGE[index_tags] = _SELECT_TAG_USAGE.get(index_tags, 0) + 1
+
+    table_cols = _table_cols(dbcr, 'main', SQLITE_IMG_INFO_TABLE)
+    conditions = []
+    values = []
+    for tag_name, tag_val in select_tags.items():
+        db_name = info_key_to_db_name(tag_name)
+        if db_name not in table_cols:
+            # quoted, an unknown column would be taken as a string, so
+            # report it as sqlite would if it wasn't quoted:
+            raise sqlite3.OperationalError('no such column: {}'.format(db_name))
+        col = '"{}"'.format(db_name)
+        if isinstance(tag_val, dict):
+            for oper, oper_val in tag_val.items():
+                _select_condition(col, oper, oper_val, conditions, values)
+        elif isinstance(tag_val, (list, tuple)):
+            _select_condition(col, 'in', tag_val, conditions, values)
+        else:
+            _select_condition(col, '=', tag_val, conditions, values)
+    return ' WHERE ' + ' AND '.join(conditions), values
+
+
+def _select_index_tags(select_tags):
+    '''
+    Returns the tags, in order, of an index that can be used to select by
+    select_tags: the tags that are selected as equal to a value, or in a list of
+    values, followed by a tag selected by prefix. Other selections can't use an index.
+    '''
+    equal_tags = []
+    prefix_tags = []
+    for tag_name, tag_val in select_tags.items():
+        if isinstance(tag_val, dict):
+            opers = [x.lower() for x in tag_val]
+            if any([x in ('=', '==', 'in') for x in opers]):
+                equal_tags.append(tag_name)
+            elif 'prefix' in opers:
+                prefix_tags.append(tag_name)
+        else:
+            equal_tags.append(tag_name)
+    return tuple(sorted(equal_tags) + sorted(prefix_tags)[:1])
+
+
+# chr only makes ascii characters in python 2:
+if PY3:
+    _unichr = chr
+else:
+    _unichr = unichr
+
+
+def _select_condition(col, oper, oper_val, conditions, values):
+    'adds the SQL condition, and its values, for one select operator on a column'
+    oper = oper.lower()
+    if oper in ('=', '=='):
+        conditions.append('{} = ?'.format(col))
+        values.append(oper_val)
+    elif oper == '!=':
+        conditions.append('{} != ?'.format(col))
+        values.append(oper_val)
+    elif oper in ('in', 'not in'):
+        conditions.append('{} {} ({})'.format(col, oper.upper(),
+                                              ', '.join(['?'] * len(oper_val))))
+        values.extend(oper_val)
+    elif oper == 'like':
+        conditions.append('{} LIKE ?'.format(col))
+        values.append(oper_val)
+    elif oper == 'prefix':
+        if oper_val and ord(oper_val[-1]) < sys.maxunicode:
+            # as a range of strings, which is case sensitive and can use an index:
+            conditions.append('{0} >= ? AND {0} < ?'.format(col))
+            values.extend([oper_val, oper_val[:-1] + _unichr(ord(oper_val[-1]) + 1)])
+        elif oper_val:
+            # there is no character after the last one, so compare the start:
+            conditions.append('substr({}, 1, ?) = ?'.format(col))
+            values.extend([len(oper_val), oper_val])
+    elif oper == 'range':
+        min_val, max_val = oper_val
+        for bound, compare in ((min_val, '>='), (max_val, '<=')):
+            if bound is None:
+                continue
+            try:
+                bound = float(bound)
+            except (TypeError, ValueError):
+                msg = 'The range for column {} must be two numbers (or None), not {}'
+                raise ValueError(msg.format(col, oper_val))
+            conditions.append('CAST({} AS REAL) {} ?'.format(col, compare))
+            values.append(bound)
+    else:
+        msg = 'Unknown select operator "{}" for column {}'
+        raise ValueError(msg.format(oper, col))
+
+
+# intern is a builtin in python 2:
+if PY3:
+    _intern = sys.intern
+else:
+    _intern = intern
+
+# tag names can be unicode, as well as str, in python 2:
+if PY3:
+    _string_types = str
+else:
+    _string_types = basestring
+
+
+class TagStrings(list):
+    '''
+    A list of unique strings, for the tag_strings option of
+    :func:`ImageMetaTag.db.read` (and the other functions that read from the
+    database). When the metadata is read, each tag value refers to the
+    matching string in the list rather than being a copy of it, which can
+    save a lot of memory.
+
+    A plain list can also be used for this, but a TagStrings also keeps a
+    dictionary of the strings, so finding them is quick however many there
+    are, and that dictionary is kept for the next time it is used. A
+    TagStrings can be shared by any number of reads, so that the metadata
+    of all of them refers to the same strings.
+
+    Options:
+
+    * strings - the strings to start with.
+    * use_sys_intern - if True, the strings are also interned with \
+                       sys.intern, so they are shared with any identical \
+                       strings that python has interned. (With python 2, \
+                       only byte strings can be interned.)
+    '''
+
+    def __init__(self, strings=(), use_sys_intern=False):
+        super(TagStrings, self).__init__()
+        self.use_sys_intern = use_sys_intern
+        self._index = {}
+        self.extend(strings)
+
+    def __reduce__(self):
+        return (TagStrings, (list(self), self.use_sys_intern))
+
+    def intern(self, tag_str):
+        '''
+        Returns the string in the list that is equal to tag_str, adding
+        tag_str to the list if there isn't one.
+        '''
+        if self._index is None:
+            self._reindex()
+        try:
+            return self._index[tag_str]
+        except KeyError:
+            if self.use_sys_intern and isinstance(tag_str, str):
+                tag_str = _intern(tag_str)
+            self._index[tag_str] = tag_str
+            super(TagStrings, self).append(tag_str)
+            return tag_str
+
+    def _reindex(self):
+        'rebuilds the dictionary of strings, from the list'
+        self._index = {}
+        for tag_str in self:
+            self._index.setdefault(tag_str, tag_str)
+
+    def append(self, tag_str):
+        self.intern(tag_str)
+
+    def extend(self, strings):
+        for tag_str in strings:
+            self.intern(tag_str)
+
+    def __iadd__(self, strings):
+        self.extend(strings)
+        return self
+
+    # anything else that changes the list means it needs reindexing:
+    def insert(self, index, tag_str):
+        super(TagStrings, self).insert(index, tag_str)
+        self._index = None
+
+    def remove(self, tag_str):
+        super(TagStrings, self).remove(tag_str)
+        self._index = None
+
+    def pop(self, *args):
+        self._index = None
+        return super(TagStrings, self).pop(*args)
+
+    def clear(self):
+        del self[:]
+
+    def __setitem__(self, key, value):
+        super(TagStrings, self).__setitem__(key, value)
+        self._index = None
+
+    def __delitem__(self, key):
+        super(TagStrings, self).__delitem__(key)
+        self._index = None
+
+
+def _tag_strings_interner(tag_strings):
+    '''
+    Returns a function that returns the string in tag_strings equal to its
+    input, adding it to tag_strings if needed. For a plain list, this uses a
+    temporary dictionary of the strings already in it.
+    '''
+    if isinstance(tag_strings, TagStrings):
+        if tag_strings.use_sys_intern:
+            return tag_strings.intern
+        # nothing else changes the list while it is being used, so go
+        # straight to its dictionary:
+        if tag_strings._index is None:
+            tag_strings._reindex()
+        index = tag_strings._index
+        list_append = super(TagStrings, tag_strings).append
+    else:
+        index = {}
+        for tag_str in tag_strings:
+            index.setdefault(tag_str, tag_str)
+        list_append = tag_strings.append
+    def intern_str(tag_str):
+        try:
+            return index[tag_str]
+        except KeyError:
+            index[tag_str] = tag_str
+            list_append(tag_str)
+            return tag_str
+    return intern_str
+
+
 def process_select_star_from(db_contents, dbcr, required_tags=None,
                              tag_strings=None):
     '''
@@ -471,7 +1796,8 @@ def process_select_star_from(db_contents, dbcr, required_tags=None,
      * required_tags - a list of image tags to return, and to fail if not \
                        all are present
      * tag_strings - an input list that will be populated with the unique \
-                     values of the image tags
+                     values of the image tags. This can be a \
+                     :class:`ImageMetaTag.db.TagStrings`, which is quicker.
 
     Returns:
      * as :func:`ImageMetaTag.db.read`, but filtered according to the select.
@@ -529,49 +1855,32 @@ def process_select_star_from(db_contents, dbcr, required_tags=None,
                 return None, None
     elif required_tags is None and tag_strings is not None:
         # we want all tags, but we want them as referneces to a common list:
+        intern_str = _tag_strings_interner(tag_strings)
+        tag_keys = [db_name_to_info_key(x) for x in field_names[1:]]
         for row in db_contents:
             fname = str(row[0])
             filename_list.append(fname)
             img_info = {}
-            for tag_name, tag_val in zip(field_names[1:], row[1:]):
-                str_tag_val = str(tag_val)
-                try:
-                    # loacate the tag_string in the list:
-                    tag_index = tag_strings.index(str_tag_val)
-                    # and refernece it:
-                    img_info[db_name_to_info_key(tag_name)] = tag_strings[tag_index]
-                except ValueError:
-                    # tag not yet in the tag_strings list, so
-                    # add the new string onto the end:
-                    tag_strings.append(str_tag_val)
-                    # and reference it:
-                    img_info[db_name_to_info_key(tag_name)] = tag_strings[-1]
+            for tag_key, tag_val in zip(tag_keys, row[1:]):
+                # reference the tag_string in the list, adding it if it's new:
+                img_info[tag_key] = intern_str(str(tag_val))
             out_dict[fname] = img_info
             # return None, None if the contents are empty:
             if len(filename_list) == 0 and len(out_dict) == 0:
                 return None, None
     else:
         # we want to filter the tags, and we want them as referneces to a common list:
+        intern_str = _tag_strings_interner(tag_strings)
+        tag_keys = [db_name_to_info_key(x) for x in field_names[1:]]
         for row in db_contents:
             fname = str(row[0])
             filename_list.append(fname)
             img_info = {}
-            for tag_name, tag_val in zip(field_names[1:], row[1:]):
+            for tag_key, tag_val in zip(tag_keys, row[1:]):
                 # test to see if the tag name is required:
-                tag_name_full = db_name_to_info_key(tag_name)
-                if tag_name_full in required_tags:
-                    str_tag_val = str(tag_val)
-                    try:
-                        # loacate the tag_string in the list:
-                        tag_index = tag_strings.index(str_tag_val)
-                        # and refernece it:
-                        img_info[tag_name_full] = tag_strings[tag_index]
-                    except ValueError:
-                        # tag not yet in the tag_strings list, so
-                        # add the new string onto the end:
-                        tag_strings.append(str_tag_val)
-                        # and reference it:
-                        img_info[tag_name_full] = tag_strings[-1]
+                if tag_key in required_tags:
+                    # reference the tag_string in the list, adding it if it's new:
+                    img_info[tag_key] = intern_str(str(tag_val))
             out_dict[fname] = img_info
             # return None, None if the contents are empty:
             if len(filename_list) == 0 and len(out_dict) == 0:
@@ -587,127 +1896,203 @@ def del_plots_from_dbfile(db_file, filenames, do_vacuum=True, allow_retries=True
     '''
     deletes a list of files from a database file created by :mod:`ImageMetaTag.db`
 
-    * do_vacuum - if True, the database will be restructured/cleaned after the delete
+    The filenames are loaded into a temporary table, and deleted from the database
+    a chunk at a time, with one DELETE per chunk. Each chunk is written in its
+    own short transaction, so other processes can use the database in between.
+    The chunk size adapts: it shrinks if the database is locked by other
+    processes, and grows while the deletes are quick.
+
+    * do_vacuum - if True, the space used by the deleted images is given back \
+                  after the delete. For databases with incremental auto-vacuum \
+                  (see :func:`ImageMetaTag.db.enable_incremental_vacuum`), this is \
+                  done a few pages at a time, so the database is never locked for \
+                  long. Space in pages that are only partly emptied is not \
+                  given back, but is reused by images added later. Otherwise, \
+                  a full VACUUM rewrites the database.
     * allow_retries - if True, retries will be allowed if the database is locked.\
-                    If False there are no retries, but sleep commands try to avoid the need\
-                    when doing a large number of deletes.
+                      If False there are no retries.
     * db_timeout - overide default database timeouts, if doing retries
     * db_attempts - overide default number of attempts, if doing retries
     * skip_warning - do not warn if a filename, that has been requested to be deleted,\
                    does not exist in the database
     '''
-    if not isinstance(filenames, list):
-        fn_list = [filenames]
+    if isinstance(filenames, (list, tuple, set)):
+        fn_list = list(filenames)
     else:
-        fn_list = filenames
+        fn_list = [filenames]
 
-    # delete command to use:
-    del_cmd = "DELETE FROM {} WHERE {}=?"
-    if db_file is None:
-        pass
-    else:
-        if not os.path.isfile(db_file) or len(fn_list) == 0:
-            pass
-        else:
-            if allow_retries:
-                # split the list of filenames up into appropciately sized chunks, so that
-                # concurrent delete commands each have a chance to complete:
-                # 200 is arbriatily chosen, but seems to work
-                chunk_size = 200
-                chunks = __gen_chunk_of_list(fn_list, chunk_size)
-                for chunk_o_filenames in chunks:
-                    # within each chunk of files, need to open the db, with time out retries etc:
-                    n_tries = 1
-                    wrote_db = False
-                    while not wrote_db and n_tries <= db_attempts:
-                        try:
-                            # open the database
-                            dbcn, dbcr = open_db_file(db_file, timeout=db_timeout)
-                            # go through the file chunk, one by one, and delete:
-                            for fname in chunk_o_filenames:
-                                try:
-                                    dbcr.execute(del_cmd.format(SQLITE_IMG_INFO_TABLE,
-                                                                SQLITE_IMG_INFO_FNAME), (fname,))
-                                except sqlite3.OperationalError as op_err_file:
-                                    err_check = 'no such table: {}'.format(SQLITE_IMG_INFO_TABLE)
-                                    if err_check in op_err_file:
-                                        # the db file exists, but it doesn't have anything in it:
-                                        if not skip_warning:
-                                            msg = ('WARNING: Unable to delete file entry "{}" from'
-                                                   ' database "{}" as database table is missing')
-                                            print(msg.format(fname, db_file))
-                                        return
-
-                                    if not skip_warning:
-                                        # if this fails, print a warning...
-                                        # need to figure out why this might happen
-                                        msg = ('WARNING: unable to delete file entry:'
-                                               ' "{}", type "{}" from database')
-                                        print(msg.format(fname, type(fname)))
-                            dbcn.commit()
-                            # if we got here, then we're good!
-                            wrote_db = True
-                            # finally close (for this chunk)
-                            dbcn.close()
-                        except sqlite3.OperationalError as op_err:
-                            if 'database is locked' in repr(op_err):
-                                # database being locked is what the retries and timeouts are for:
-                                print('%s database timeout deleting from file "%s", %s s' \
-                                                % (dt_now_str(), db_file, n_tries * db_timeout))
-                                n_tries += 1
-                            elif 'disk I/O error' in repr(op_err):
-                                msg = '{} for file {}'.format(op_err, db_file)
-                                raise IOError(msg)
-                            else:
-                                # everything else needs to be reported and raised immediately:
-                                msg = '{} for file {}'.format(op_err, db_file)
-                                raise ValueError(msg)
-
-                    # if we went through all the attempts then it is time to raise the error:
-                    if n_tries > db_attempts:
-                        msg = '{} for file {}'.format(op_err, db_file)
-                        raise sqlite3.OperationalError(msg)
+    if db_file is None or not os.path.isfile(db_file) or len(fn_list) == 0:
+        return
+    if not allow_retries:
+        db_attempts = 1
 
+    dbcn, dbcr = open_db_file(db_file, timeout=db_timeout)
+    try:
+        try:
+            n_deleted = _del_plots_from_open_db(dbcn, dbcr, fn_list, db_file,
+                                                db_timeout, db_attempts)
+        except sqlite3.OperationalError as op_err:
+            if 'no such table: {}'.format(SQLITE_IMG_INFO_TABLE) in repr(op_err):
+                # the db file exists, but it doesn't have anything in it:
+                if not skip_warning:
+                    msg = ('WARNING: Unable to delete file entries from'
+                           ' database "{}" as database table is missing')
+                    print(msg.format(db_file))
+                return
+            elif 'disk I/O error' in repr(op_err):
+                msg = '{} for file {}'.format(op_err, db_file)
+                raise IOError(msg)
+            raise
+
+        n_missing = len(set(fn_list)) - n_deleted
+        if n_missing > 0 and not skip_warning:
+            msg = 'WARNING: {} of the files to delete were not in database "{}"'
+            print(msg.format(n_missing, db_file))
+
+        if do_vacuum:
+            if _auto_vacuum_mode(dbcr) == 2:
+                _incremental_vacuum(dbcn, db_file, db_timeout, db_attempts)
             else:
-                # just open the database:
-                dbcn, dbcr = open_db_file(db_file)
-                # delete the contents:
-                for i_fn, fname in enumerate(fn_list):
-                    try:
-                        dbcr.execute(del_cmd.format(SQLITE_IMG_INFO_TABLE), (fname,))
-                    except:
-                        if not skip_warning:
-                            # if this fails, print a warning...
-                            # need to figure out why this happens
-                            msg = ('WARNING: unable to delete file entry:'
-                                   ' "{}", type "{}" from database')
-                            print(msg.format(fname, type(fname)))
-                    # commit every 100 to give other processes a chance:
-                    if i_fn % 100 == 0:
-                        dbcn.commit()
-                        time.sleep(1)
-                # commit, and vacuum if required:
-                dbcn.commit()
-
-            if do_vacuum:
-                if allow_retries:
-                    # need to re-open the db, if we allowed retries:
-                    dbcn, dbcr = open_db_file(db_file)
                 dbcn.execute("VACUUM")
-                dbcn.close()
-            elif not allow_retries:
-                dbcn.close()
+    finally:
+        dbcn.close()
 
 
-def __gen_chunk_of_list(in_list, chunk_size):
-    'gnerator that yields a chunk of list, of length chunk size'
-    for ndx in range(0, len(in_list), chunk_size):
-        yield in_list[ndx:min(ndx + chunk_size, len(in_list))]
+# the range, and starting value, of the number of images deleted per transaction:
+DEL_CHUNK_MIN = 50
+DEL_CHUNK_MAX = 50000
+DEL_CHUNK_START = 1000
+# the time to aim for each chunk of deletes to take, in seconds:
+DEL_CHUNK_SECONDS = 0.2
+
+
+def _del_plots_from_open_db(dbcn, dbcr, fn_list, db_file, db_timeout, db_attempts):
+    '''
+    Deletes the images in fn_list from an open database, in chunks, returning
+    the number of images deleted.
+    '''
+    # the filenames to delete go into a temporary table, which is private to
+    # this connection, so loading it doesn't lock the database:
+    dbcr.execute('CREATE TEMP TABLE IF NOT EXISTS imt_del_fnames (fname TEXT PRIMARY KEY)')
+    dbcr.execute('DELETE FROM temp.imt_del_fnames')
+    dbcr.executemany('INSERT OR IGNORE INTO temp.imt_del_fnames VALUES (?)',
+                     [(str(x),) for x in fn_list])
+    dbcn.commit()
+    n_fnames = dbcr.execute('SELECT MAX(rowid) FROM temp.imt_del_fnames').fetchone()[0]
+    has_hash = SQLITE_IMG_HASH_TABLE in list_tables(dbcr)
+
+    del_cmd = ('DELETE FROM main.{0} WHERE {1} IN '
+               '(SELECT fname FROM temp.imt_del_fnames WHERE rowid > ? AND rowid <= ?)')
+    n_deleted = 0
+    chunk_size = DEL_CHUNK_START
+    chunk_start = 0
+    n_tries = 1
+    while chunk_start < n_fnames:
+        chunk_end = chunk_start + chunk_size
+        time_start = time.time()
+        try:
+            dbcr.execute('BEGIN IMMEDIATE')
+            dbcr.execute(del_cmd.format(SQLITE_IMG_INFO_TABLE, SQLITE_IMG_INFO_FNAME),
+                         (chunk_start, chunk_end))
+            n_chunk = dbcr.rowcount
+            if has_hash:
+                dbcr.execute(del_cmd.format(SQLITE_IMG_HASH_TABLE, SQLITE_IMG_INFO_FNAME),
+                             (chunk_start, chunk_end))
+            dbcn.commit()
+        except sqlite3.OperationalError as op_err:
+            # (a rollback with no transaction open does nothing)
+            dbcn.rollback()
+            if 'database is locked' in repr(op_err):
+                print('%s database timeout deleting from file "%s", %s s' \
+                        % (dt_now_str(), db_file, n_tries * db_timeout))
+                n_tries += 1
+                if n_tries > db_attempts:
+                    msg = '{} for file {}'.format(op_err, db_file)
+                    raise sqlite3.OperationalError(msg)
+                # other processes need the database, so hold it for less time:
+                chunk_size = max(DEL_CHUNK_MIN, chunk_size // 4)
+                continue
+            raise
+        n_deleted += n_chunk
+        chunk_start = chunk_end
+        # db_attempts is how many times each chunk can be locked out:
+        n_tries = 1
+        # aim for each chunk to take DEL_CHUNK_SECONDS, changing gradually:
+        chunk_time = max(time.time() - time_start, 1e-3)
+        scale = min(2.0, max(0.5, DEL_CHUNK_SECONDS / chunk_time))
+        chunk_size = int(min(DEL_CHUNK_MAX, max(DEL_CHUNK_MIN, chunk_size * scale)))
+
+    dbcr.execute('DELETE FROM temp.imt_del_fnames')
+    dbcn.commit()
+    return n_deleted
+
+
+def _auto_vacuum_mode(dbcr):
+    'returns the auto_vacuum mode of a database: 0 (none), 1 (full) or 2 (incremental)'
+    return dbcr.execute('PRAGMA auto_vacuum').fetchone()[0]
+
+
+def _incremental_vacuum(dbcn, db_file, db_timeout, db_attempts, step_pages=500):
+    '''
+    Gives back the free pages of a database with incremental auto-vacuum,
+    step_pages at a time so it is never locked for long. Returns the number of
+    pages freed.
+    '''
+    n_freed = 0
+    n_tries = 1
+    n_free = dbcn.execute('PRAGMA freelist_count').fetchone()[0]
+    while n_free > 0:
+        try:
+            # executescript runs the pragma to completion (execute only does one page):
+            dbcn.executescript('PRAGMA incremental_vacuum({:d})'.format(step_pages))
+        except sqlite3.OperationalError as op_err:
+            if 'database is locked' in repr(op_err):
+                print('%s database timeout vacuuming file "%s", %s s' \
+                        % (dt_now_str(), db_file, n_tries * db_timeout))
+                n_tries += 1
+                if n_tries > db_attempts:
+                    msg = '{} for file {}'.format(op_err, db_file)
+                    raise sqlite3.OperationalError(msg)
+                continue
+            raise
+        prev_free = n_free
+        n_free = dbcn.execute('PRAGMA freelist_count').fetchone()[0]
+        n_freed += prev_free - n_free
+        if n_free >= prev_free:
+            break
+    return n_freed
+
+
+def enable_incremental_vacuum(db_file, timeout=DEFAULT_DB_TIMEOUT):
+    '''
+    Switches an existing database file to incremental auto-vacuum, so that
+    :func:`ImageMetaTag.db.del_plots_from_dbfile` can give back the space of
+    deleted images a little at a time, without rewriting the whole database.
+    Databases created by this version of ImageMetaTag already use it.
+
+    Switching needs one full VACUUM, which locks the database while it is
+    rewritten, so this should be done when nothing else is using it.
+    Does nothing if the database already uses incremental auto-vacuum.
+    '''
+    dbcn, dbcr = open_db_file(db_file, timeout=timeout)
+    try:
+        if _auto_vacuum_mode(dbcr) != 2:
+            dbcn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            dbcn.execute('VACUUM')
+    finally:
+        dbcn.close()
 
 
-def select_dbfile_by_tags(db_file, select_tags):
+def select_dbfile_by_tags(db_file, select_tags, required_tags=None, tag_strings=None,
+                          auto_index=False):
     '''
     Selects from a database file the entries that match a dict of field names/acceptable values.
+    See :func:`ImageMetaTag.db.select_dbcr_by_tags` for the options, and also:
+
+    * auto_index - if True, after the select, indexes are added to the database for \
+                   the tags that have been used most in selects, as \
+                   :func:`ImageMetaTag.db.auto_index`. If the database is locked \
+                   for more than AUTO_INDEX_TIMEOUT seconds, this is skipped.
 
     Returns the output, processed by :func:`ImageMetaTag.db.process_select_star_from`
     '''
@@ -720,52 +2105,281 @@ def select_dbfile_by_tags(db_file, select_tags):
             # just open the database:
             dbcn, dbcr = open_db_file(db_file)
             # do the select:
-            sel_results = select_dbcr_by_tags(dbcr, select_tags)
+            sel_results = select_dbcr_by_tags(dbcr, select_tags,
+                                              required_tags=required_tags,
+                                              tag_strings=tag_strings)
+            if auto_index:
+                # the indexes are only there to speed things up, so don't wait long
+                # for the database to be unlocked:
+                dbcr.execute('PRAGMA busy_timeout = {:d}'.format(int(1000 * AUTO_INDEX_TIMEOUT)))
+                try:
+                    auto_index_dbcr(dbcr)
+                    dbcn.commit()
+                except sqlite3.OperationalError as op_err:
+                    # the indexes are only there to speed things up, so can wait:
+                    if 'database is locked' not in repr(op_err):
+                        raise
             dbcn.close()
     return sel_results
 
 
-def select_dbcr_by_tags(dbcr, select_tags):
+def select_dbcr_by_tags(dbcr, select_tags, required_tags=None, tag_strings=None):
     '''
     Selects from an open database cursor (dbcr) the entries that match a dict of field
-    names & acceptable values.
+    names & acceptable values. The acceptable values for each field can be:
+
+    * a single value, for an exact match
+    * a list or tuple of values, any of which match
+    * a dictionary of {operator: value} pairs, all of which must match, where \
+      the operators are:
+
+      * '=' or '!=' - the field is, or is not, equal to the value
+      * 'in' or 'not in' - the field is, or is not, in a list of values
+      * 'like' - the field matches an SQL LIKE pattern, such as 'T+%'
+      * 'prefix' - the field starts with the value (case sensitive)
+      * 'range' - the field, as a number, is within (min, max), inclusive. \
+                  Either can be None, for no limit. A ValueError is raised \
+                  if they are not numbers. Fields that are not numbers \
+                  are treated as 0.
+
+    For example::
+
+        select_dbcr_by_tags(dbcr, {'model': ['global', 'regional'],
+                                   'lead time': {'range': (0, 48)},
+                                   'plot type': {'not in': ['test']}})
+
+    Options:
+
+    * required_tags - a list of image tags to return, as :func:`ImageMetaTag.db.read`
+    * tag_strings - as :func:`ImageMetaTag.db.read`
 
     Returns the output, processed by :func:`ImageMetaTag.db.process_select_star_from`
     '''
-    if len(select_tags) == 0:
-        # just read and return the whole thing:
-        return read_img_info_from_dbcursor(dbcr)
-    else:
-        # convert these to lists:
-        tag_names = list(select_tags.keys())
-        tag_values = [select_tags[x] for x in tag_names]
-        # Right... this is where I need to understand how to do a select!
-        #select_command = 'SELECT * FROM %s WHERE symbol=?' % SQLITE_IMG_INFO_TABLE
-        select_command = 'SELECT * FROM %s WHERE ' % SQLITE_IMG_INFO_TABLE
-        n_tags = len(tag_names)
-
-        use_tag_values = []
-        for i_tag, tag_name, tag_val in zip(list(range(n_tags)), tag_names, tag_values):
-            if isinstance(tag_val, (list, tuple)):
-                # if a list or tuple, then use IN:
-                select_command += '%s IN (' % info_key_to_db_name(tag_name)
-                select_command += ', '.join(['?']*len(tag_val))
-                select_command += ')'
-                if i_tag+1 < n_tags:
-                    select_command += ' AND '
-                use_tag_values.extend(tag_val)
+    return read_img_info_from_dbcursor(dbcr, required_tags=required_tags,
+                                       tag_strings=tag_strings,
+                                       select_tags=select_tags)
+
+
+# the number of times each set of tags has been used to select, for auto_index:
+_SELECT_TAG_USAGE = {}
+
+
+def select_tag_usage(reset=False):
+    '''
+    Returns a dictionary of the number of times each tuple of tags (in the order
+    they would be indexed) has been used to select from a database, by this process.
+
+    Options:
+     * reset - if True, the counts are reset to zero.
+    '''
+    usage = dict(_SELECT_TAG_USAGE)
+    if reset:
+        _SELECT_TAG_USAGE.clear()
+    return usage
+
+
+def create_index(dbcr, tags, index_name=None):
+    '''
+    For a given database cursor (dbcr), creates an index on one or more image
+    tags. An index on several tags (a composite index) can be used by selects on
+    all of them, or on the first of them. Selects by tags that are indexed do not
+    need to read every row of the table, so are much quicker for large databases.
+    If the index already exists, nothing is done.
+
+    The caller is responsible for committing any pending transaction. The index
+    is part of a transaction only if one is already open (python's sqlite3 does
+    not start one for CREATE INDEX), otherwise it takes effect straight away.
+
+    Options:
+     * index_name - the name of the index. The default is made from the tags.
+
+    Returns the name of the index.
+    '''
+    if isinstance(tags, _string_types):
+        tags = [tags]
+    db_names = [info_key_to_db_name(x) for x in tags]
+    table_cols = _table_cols(dbcr, 'main', SQLITE_IMG_INFO_TABLE)
+    for db_name in db_names:
+        if db_name not in table_cols:
+            raise ValueError('Cannot index tag "{}" as it is not in the database'.format(db_name))
+    if index_name is None:
+        index_name = _index_name(tags)
+    idx_cmd = 'CREATE INDEX IF NOT EXISTS "{}" ON {} ({})'
+    idx_cmd = idx_cmd.format(index_name, SQLITE_IMG_INFO_TABLE,
+                             ', '.join(['"{}"'.format(x) for x in db_names]))
+    dbcr.execute(idx_cmd)
+    return index_name
+
+
+def drop_index(dbcr, tags=None, index_name=None):
+    '''
+    For a given database cursor (dbcr), drops an index created by
+    :func:`ImageMetaTag.db.create_index`, given either the tags or the name of the
+    index. If the index does not exist, nothing is done.
+
+    The caller is responsible for committing any pending transaction. The drop
+    is part of a transaction only if one is already open (python's sqlite3 does
+    not start one for DROP INDEX), otherwise it takes effect straight away.
+    '''
+    if index_name is None:
+        if tags is None:
+            raise ValueError('Either tags or index_name must be given to drop an index')
+        if isinstance(tags, _string_types):
+            tags = [tags]
+        index_name = _index_name(tags)
+    dbcr.execute('DROP INDEX IF EXISTS "{}"'.format(index_name))
+
+
+def list_indexes(dbcr):
+    '''
+    For a given database cursor (dbcr), returns a dictionary of the indexes
+    on the image metadata table, as index name: list of tags.
+    This does not include the index on the filenames, which is always there.
+    '''
+    indexes = {}
+    idx_list = dbcr.execute('PRAGMA index_list({})'.format(SQLITE_IMG_INFO_TABLE)).fetchall()
+    for idx in idx_list:
+        # only the indexes that were created, not the primary key:
+        if idx[3] == 'c':
+            idx_info = dbcr.execute('PRAGMA index_info("{}")'.format(idx[1])).fetchall()
+            indexes[idx[1]] = [db_name_to_info_key(x[2]) for x in sorted(idx_info)]
+    return indexes
+
+
+def auto_index_dbcr(dbcr, min_uses=5, max_indexes=5):
+    '''
+    For a given database cursor (dbcr), creates indexes for the sets of tags that
+    have been used most often to select from databases by this process
+    (see :func:`ImageMetaTag.db.select_tag_usage`). Sets of tags that can already
+    use an existing index are skipped, as are tags that are not in the database.
+
+    The caller is responsible for committing any pending transaction. As with
+    :func:`ImageMetaTag.db.create_index`, indexes created outside an open
+    transaction take effect straight away.
+
+    Options:
+     * min_uses - only index sets of tags that have been used at least this many times.
+     * max_indexes - the maximum number of indexes to have on the table.
+
+    Returns a list of the names of the new indexes.
+    '''
+    indexes = list(list_indexes(dbcr).values())
+    table_cols = _table_cols(dbcr, 'main', SQLITE_IMG_INFO_TABLE)
+    usage = sorted(_SELECT_TAG_USAGE.items(), key=lambda x: x[1], reverse=True)
+    new_indexes = []
+    for tags, n_uses in usage:
+        if n_uses < min_uses or len(indexes) >= max_indexes:
+            break
+        if not all([info_key_to_db_name(x) in table_cols for x in tags]):
+            continue
+        # an index can be used if its first tag is one of the selected tags:
+        if any([x[0] in tags for x in indexes]):
+            continue
+        new_indexes.append(create_index(dbcr, tags))
+        indexes.append(list(tags))
+    return new_indexes
+
+
+def auto_index(db_file, min_uses=5, max_indexes=5, db_timeout=DEFAULT_DB_TIMEOUT,
+               db_attempts=DEFAULT_DB_ATTEMPTS):
+    '''
+    Adds indexes to a database file, for the sets of tags that have been used most
+    often to select by this process, as :func:`ImageMetaTag.db.auto_index_dbcr`.
+
+    Returns a list of the names of the new indexes.
+    '''
+    n_tries = 1
+    wrote_db = False
+    while not wrote_db and n_tries <= db_attempts:
+        dbcn = None
+        try:
+            dbcn, dbcr = open_db_file(db_file, timeout=db_timeout)
+            new_indexes = auto_index_dbcr(dbcr, min_uses=min_uses,
+                                          max_indexes=max_indexes)
+            dbcn.commit()
+            dbcn.close()
+            wrote_db = True
+        except sqlite3.OperationalError as op_err:
+            if dbcn is not None:
+                dbcn.close()
+            if 'database is locked' in repr(op_err):
+                print('%s database timeout indexing file "%s", %s s' \
+                        % (dt_now_str(), db_file, n_tries * db_timeout))
+                n_tries += 1
+                last_err = op_err
             else:
-                # do an exact match:
-                if i_tag+1 < n_tags:
-                    select_command += '%s = ? AND ' % info_key_to_db_name(tag_name)
-                else:
-                    select_command += '%s = ?' % info_key_to_db_name(tag_name)
-                use_tag_values.append(tag_val)
-        db_contents = dbcr.execute(select_command, use_tag_values).fetchall()
-        # and convert that to a useful dict/list combo:
-        filename_list, out_dict = process_select_star_from(db_contents, dbcr)
+                msg = '{} for file {}'.format(op_err, db_file)
+                raise sqlite3.OperationalError(msg)
 
-    return filename_list, out_dict
+    if n_tries > db_attempts:
+        msg = '{} for file {}'.format(last_err, db_file)
+        raise sqlite3.OperationalError(msg)
+
+    return new_indexes
+
+
+def explain_select(dbcr, select_tags, required_tags=None):
+    '''
+    For a given database cursor (dbcr), returns the query plan that the database
+    would use to select by select_tags, as :func:`ImageMetaTag.db.select_dbcr_by_tags`.
+    This is a list of strings, one per step of the plan, for example::
+
+        ['SEARCH img_info USING INDEX imt_idx_model (model=?)']
+
+    where 'SCAN img_info' would mean that every row of the table is read.
+    '''
+    # this isn't a real select, so isn't counted for auto_index:
+    sel_com, sel_values = _select_sql(dbcr, required_tags, select_tags, count_usage=False)
+    plan = dbcr.execute('EXPLAIN QUERY PLAN ' + sel_com, sel_values).fetchall()
+    return [str(x[-1]) for x in plan]
+
+
+def _index_name(tags):
+    'the default name of the index on a list of tags'
+    return SQLITE_IMG_INDEX_PREFIX + '_'.join([info_key_to_db_name(x) for x in tags])
+
+
+def add_table_cols(dbcr, new_cols):
+    '''
+    For a given database cursor (dbcr) this adds new columns, for new image
+    tags, to the ImageMetaTag database table. The new columns are added in
+    place, with ALTER TABLE, and have a default value of 'None' for all of
+    the images already in the table. This is quick, however large the table.
+
+    If another process adds the same column first (between this process
+    reading the table's columns and adding them) then that column is left
+    as it is.
+
+    The caller is responsible for committing any pending transaction. The new
+    columns are part of a transaction only if one is already open (python's sqlite3
+    does not start one for ALTER TABLE), otherwise they take effect straight away.
+    '''
+    alter_command = 'ALTER TABLE {} ADD COLUMN "{}" TEXT DEFAULT \'None\''
+    for new_col in new_cols:
+        try:
+            dbcr.execute(alter_command.format(SQLITE_IMG_INFO_TABLE,
+                                              info_key_to_db_name(new_col)))
+        except sqlite3.OperationalError as op_err:
+            if 'duplicate column name' in repr(op_err):
+                # another process got there first, which is fine:
+                pass
+            else:
+                raise
+
+
+def _add_new_cols(dbcr, current_cols, new_cols):
+    '''
+    Adds new columns to the ImageMetaTag database table, using
+    :func:`add_table_cols`, or :func:`recrete_table_new_cols` if that fails.
+    '''
+    try:
+        add_table_cols(dbcr, new_cols)
+    except sqlite3.OperationalError as op_err:
+        if 'database is locked' in repr(op_err):
+            raise
+        msg = 'WARNING: unable to add new columns to database table ({})'
+        print(msg.format(op_err))
+        recrete_table_new_cols(dbcr, current_cols, new_cols)
 
 
 def recrete_table_new_cols(dbcr, current_cols, new_cols):
@@ -778,7 +2392,9 @@ def recrete_table_new_cols(dbcr, current_cols, new_cols):
     connections/processes will see an intermediate/incorrect database).
 
     Because of this, this process is slow and should be avoided if at all
-    possible.
+    possible. New columns are normally added with
+    :func:`ImageMetaTag.db.add_table_cols` instead, and this is only used
+    if that fails.
     '''
     msg = 'WARNING: recreating database table with new image tags: {}'
     print(msg.format(new_cols))
@@ -841,7 +2457,8 @@ def recrete_table_new_cols(dbcr, current_cols, new_cols):
 
 def scan_dir_for_db(basedir, db_file, img_tag_req=None, add_strict=False,
                     subdir_excl_list=None, known_file_tags=None, verbose=False,
-                    no_file_ext=False, return_timings=False, restart_db=False):
+                    no_file_ext=False, return_timings=False, restart_db=False,
+                    n_readers=4, reader_processes=False, batch_size=1000):
     '''
     A useful utility that scans a directory on disk for images that can go into a database.
     This should only be used to build a database from a directory of tagged images that
@@ -851,6 +2468,10 @@ def scan_dir_for_db(basedir, db_file, img_tag_req=None, add_strict=False,
     For optimal performance, build the database as the plots are created (or do not delete
     the database by accident).
 
+    The metadata is read from the images by a pool of readers, and written to the
+    database in batches. The working directory is not changed, so several scans can
+    run at once.
+
     Arguments:
      * basedir - the directory to start scanning.
      * db_file - the database file to save the image metadata to. A pre-existing database file\
@@ -872,100 +2493,203 @@ def scan_dir_for_db(basedir, db_file, img_tag_req=None, add_strict=False,
                          from the files themselves as that is slow). This can be useful \
                          if you have a old backup of a database file that needs updating.
      * restart_db - if True, the db_file will be restarted from an empty database.
-     * verbose - verbose output.
+     * verbose - verbose output, reporting progress and throughput after each batch.
+     * return_timings - if True, returns a list of the number of images added, and a list \
+                        of the time taken per image added, for each batch.
+     * n_readers - the number of threads (or processes) reading metadata from the images. \
+                   With python 2, this needs the futures package (a backport of \
+                   concurrent.futures), without which the images are read one at a time.
+     * reader_processes - if True, the readers are processes rather than threads.
+     * batch_size - the number of images written to the database in each transaction.
     '''
 
     if os.path.isfile(db_file) and not restart_db:
         raise ValueError('''scan_dir_for_db will not work on a pre-existing file unless restart_db
 is True, in which case the database file will be restarted as empty. Use with care.''')
 
-    if known_file_tags is not None:
-        known_files = list(known_file_tags.keys())
-    else:
-        known_files = []
+    if known_file_tags is None:
+        known_file_tags = {}
+    if subdir_excl_list is None:
+        subdir_excl_list = []
 
-    if return_timings:
-        prev_time = datetime.now()
-        add_interval = 1
-        # total number of entries added
-        n_added = 0
-        # number of entries added since last timer
-        n_add_this_timer = 0
-        # and this is the list to return:
-        n_adds = []
-        timings_per_add = []
-
-    os.chdir(basedir)
-    first_img = True
-    for root, dirs, files in os.walk('./', followlinks=True, topdown=True):
-        if not subdir_excl_list is None:
-            dirs[:] = [d for d in dirs if not d in subdir_excl_list]
-
-        for meta_img_format in META_IMG_FORMATS:
-            for filename in fnmatch.filter(files, '*%s' % meta_img_format):
-                # append to the list, taking off the preceeding './' and the file extension:
-                if root == './':
-                    img_path = filename
-                else:
-                    img_path = '%s/%s' % (root[2:], filename)
-                if no_file_ext:
-                    img_name = os.path.splitext(img_path)[0]
-                else:
-                    img_name = img_path
-
-                # read the metadata:
-                if img_name in known_files:
-                    # if we know this file details, then get it:
-                    known_files.remove(img_name)
-                    img_info = known_file_tags.pop(img_name)
-                    read_ok = True
-                else:
-                    # otherwise read from disk:
-                    (read_ok, img_info) = readmeta_from_image(img_path)
-
-                if read_ok:
-                    if img_tag_req and add_strict:
-                        # check to see if an image is needed:
-                        use_img = check_for_required_keys(img_info, img_tag_req)
-                    elif img_tag_req:
-                        use_img = any([x in img_tag_req for x in img_info.keys()])
-                    else:
-                        use_img = True
-                    if use_img:
-                        if first_img:
-                            dbcn, dbcr = open_or_create_db_file(db_file, img_info,
-                                                                restart_db=True)
-                            first_img = False
-                        write_img_to_open_db(dbcr, img_name, img_info,
-                                             add_strict=add_strict)
-                        if verbose:
-                            print(img_name)
-
-                        if return_timings:
-                            n_added += 1
-                            n_add_this_timer += 1
-                            if n_add_this_timer % add_interval == 0:
-                                time_interval_s = (datetime.now()- prev_time).total_seconds()
-                                timings_per_add.append(time_interval_s / add_interval)
-                                n_adds.append(n_added)
-                                # increase the add_interval so we don't swamp
-                                # the processing with timings!
-                                add_interval = np.ceil(np.sqrt(n_added))
-                                n_add_this_timer = 0
-                                if verbose:
-                                    print('len(n_adds)=%s, currently every %s' \
-                                            % (len(n_adds), add_interval))
-
-    # commit and close, and we are done:
-    if not first_img:
-        dbcn.commit()
-        dbcn.close()
+    scan = _DirScanWriter(db_file, img_tag_req, add_strict, batch_size, verbose)
+    # a few chunks of images per reader are read at once, so the readers are kept busy
+    # without the whole directory tree being queued up in memory:
+    read_chunk = 100
+    max_pending = 4 * n_readers
+    try:
+        # imported here, so python 2 only needs it to read with several readers:
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+        from concurrent.futures import wait, FIRST_COMPLETED
+    except ImportError:
+        executor = None
+    else:
+        if reader_processes:
+            executor = ProcessPoolExecutor(max_workers=n_readers)
+        else:
+            executor = ThreadPoolExecutor(max_workers=n_readers)
+    try:
+        pending = set()
+        to_read = []
+        for img_path in _scan_dir_images(basedir, subdir_excl_list):
+            scan.n_scanned += 1
+            if no_file_ext:
+                img_name = os.path.splitext(img_path)[0]
+            else:
+                img_name = img_path
+            if img_name in known_file_tags:
+                # if we know this file details, then get it:
+                scan.add(img_name, known_file_tags.pop(img_name))
+                continue
+            to_read.append((img_name, img_path))
+            if executor is None:
+                if len(to_read) == read_chunk:
+                    scan.add_results(_scan_read_imgs(basedir, to_read))
+                    to_read = []
+            elif len(to_read) == read_chunk:
+                pending.add(executor.submit(_scan_read_imgs, basedir, to_read))
+                to_read = []
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    scan.add_read(done)
+        if executor is None:
+            scan.add_results(_scan_read_imgs(basedir, to_read))
+        else:
+            if to_read:
+                pending.add(executor.submit(_scan_read_imgs, basedir, to_read))
+            scan.add_read(wait(pending)[0])
+        scan.flush()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        scan.close()
 
     if return_timings:
-        return n_adds, timings_per_add
+        return scan.n_adds, scan.timings_per_add
     return None
 
 
+def _scan_dir_images(basedir, subdir_excl_list):
+    '''
+    Yields the paths, relative to basedir, of the images in a directory tree that
+    can hold metadata, following links but not excluded subdirectories
+    '''
+    img_exts = tuple(META_IMG_FORMATS)
+    # the directories to scan, with the real paths of the directories above them:
+    to_scan = [('', ())]
+    while to_scan:
+        rel_dir, parents = to_scan.pop()
+        scan_dir = os.path.join(basedir, rel_dir) if rel_dir else basedir
+        # don't go round in circles through links back up the tree:
+        real_dir = os.path.realpath(scan_dir)
+        if real_dir in parents:
+            continue
+        parents = parents + (real_dir,)
+        sub_dirs = []
+        for name, is_dir in _list_dir(scan_dir):
+            rel_path = '{}/{}'.format(rel_dir, name) if rel_dir else name
+            if is_dir:
+                if name not in subdir_excl_list:
+                    sub_dirs.append((rel_path, parents))
+            elif name.endswith(img_exts):
+                yield rel_path
+        # walk the directories in order, top down:
+        to_scan.extend(sorted(sub_dirs, reverse=True))
+
+
+def _list_dir(scan_dir):
+    'yields the (name, is_dir) of the entries in a directory, following links'
+    if PY3:
+        for entry in os.scandir(scan_dir):
+            yield entry.name, entry.is_dir()
+    else:
+        # os.scandir is new in python 3.5:
+        for name in os.listdir(scan_dir):
+            yield name, os.path.isdir(os.path.join(scan_dir, name))
+
+
+def _scan_read_imgs(basedir, imgs):
+    'reads the metadata from a list of (img_name, img_path) images, for scan_dir_for_db'
+    return [(img_name,) + readmeta_from_image(os.path.join(basedir, img_path))
+            for img_name, img_path in imgs]
+
+
+class _DirScanWriter(object):
+    '''
+    Writes the images found by :func:`ImageMetaTag.db.scan_dir_for_db` to the
+    database, in batches, recording the progress
+    '''
+    def __init__(self, db_file, img_tag_req, add_strict, batch_size, verbose):
+        self.db_file = db_file
+        self.img_tag_req = img_tag_req
+        self.add_strict = add_strict
+        self.batch_size = batch_size
+        self.verbose = verbose
+        self.dbcn = None
+        self.dbcr = None
+        self.batch = {}
+        self.n_scanned = 0
+        self.n_added = 0
+        self.n_adds = []
+        self.timings_per_add = []
+        self.start_time = time.time()
+        self.batch_time = self.start_time
+
+    def add_read(self, done):
+        'adds the images from a set of completed _scan_read_imgs futures'
+        for future in done:
+            self.add_results(future.result())
+
+    def add_results(self, results):
+        'adds the images read by _scan_read_imgs'
+        for img_name, read_ok, img_info in results:
+            if read_ok:
+                self.add(img_name, img_info)
+
+    def add(self, img_name, img_info):
+        'adds an image, if it has the required tags'
+        if self.img_tag_req and self.add_strict:
+            # check to see if an image is needed:
+            use_img = check_for_required_keys(img_info, self.img_tag_req)
+        elif self.img_tag_req:
+            use_img = any([x in self.img_tag_req for x in img_info.keys()])
+        else:
+            use_img = True
+        if use_img:
+            self.batch[img_name] = img_info
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        'writes the current batch of images to the database'
+        if not self.batch:
+            return
+        if self.dbcn is None:
+            first_info = next(iter(self.batch.values()))
+            self.dbcn, self.dbcr = open_or_create_db_file(self.db_file, first_info,
+                                                          restart_db=True)
+        write_imgs_to_open_db(self.dbcr, self.batch, add_strict=self.add_strict)
+        self.dbcn.commit()
+
+        now = time.time()
+        n_batch = len(self.batch)
+        self.n_added += n_batch
+        self.n_adds.append(self.n_added)
+        self.timings_per_add.append((now - self.batch_time) / n_batch)
+        if self.verbose:
+            msg = '{} scanned {} files, added {} images, {:.1f} images/s'
+            print(msg.format(dt_now_str(), self.n_scanned, self.n_added,
+                             self.n_added / max(now - self.start_time, 1e-6)))
+        self.batch = {}
+        self.batch_time = now
+
+    def close(self):
+        'closes the database'
+        if self.dbcn is not None:
+            self.dbcn.close()
+            self.dbcn = None
+
+
 def rmfile(path):
     """
     os.remove, but does not complain if the file has already been
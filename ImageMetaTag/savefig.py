@@ -15,32 +15,63 @@ Released under BSD 3-Clause License. See LICENSE for more details.
 '''
 
 import os
-import sys
 import io
 import sqlite3
+import hashlib
 import pdb
+import time
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from multiprocessing import Pool
 from datetime import datetime
 import matplotlib.pyplot as plt
+import matplotlib.colors as mcolors
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 from ImageMetaTag import db, META_IMG_FORMATS, RESERVED_TAGS
 from ImageMetaTag import POSTPROC_IMG_FORMATS, DPI_IMG_FORMATS
-from ImageMetaTag import DEFAULT_DB_TIMEOUT, DEFAULT_DB_ATTEMPTS
+from ImageMetaTag import DEFAULT_DB_TIMEOUT, DEFAULT_DB_ATTEMPTS, PY3
 
 # image manipulations:
-from PIL import Image, ImageChops, PngImagePlugin
+from PIL import Image, PngImagePlugin
 import numpy as np
 
 THUMB_DEFAULT_IMG_SIZE = 150, 150
 THUMB_DEFAULT_DIR_NAME = 'thumbnail'
+# the default trim tolerance, of older versions (see _im_trim_rule):
+TRIM_DEFAULT_TOLERANCE = 50
+# maximum number of loaded/resized/merged logo images to keep in memory:
+LOGO_CACHE_SIZE = 32
+# maximum number of trim bounding boxes to keep, by trim_key:
+TRIM_CACHE_SIZE = 256
+# maximum number of image series palettes to keep, by palette_key:
+PALETTE_CACHE_SIZE = 64
+# png encoder options, by profile name, from quickest to smallest files:
+PNG_PROFILES = {'fast': {'compress_level': 1, 'optimize': False},
+                'balanced': {'compress_level': 6, 'optimize': False},
+                'smallest': {'compress_level': 9, 'optimize': True}}
+# the default profile, which can be changed by set_png_profile:
+_DEFAULT_PNG_PROFILE = 'smallest'
+# the clock used to time the stages of savefig (perf_counter is python 3 only):
+if PY3:
+    _perf_counter = time.perf_counter
+else:
+    _perf_counter = time.time
+
 
 def savefig(filename, fig=None, img_tags=None, img_format=None, img_converter=0,
-            do_trim=False, trim_border=0,
+            do_trim=False, trim_border=0, trim_tolerance=None,
+            trim_key=None, trim_check=True, palette_key=None,
+            png_profile=None,
             do_thumb=False, keep_open=False, dpi=None,
             logo_file=None, logo_width=None, logo_height=None,
             logo_padding=0, logo_pos=0,
             db_file=None, db_timeout=DEFAULT_DB_TIMEOUT,
             db_attempts=DEFAULT_DB_ATTEMPTS,
             db_replace=False, db_add_strict=False, db_full_paths=False,
+            db_buffered=False, db_sharded=False, agg_buffer=False, postproc_queue=None,
+            skip_unchanged=False, data_fingerprint=None, metrics=None,
             verbose=False):
     '''
     A wrapper around matplotlib.pyplot.savefig, to include file size
@@ -80,21 +111,67 @@ def savefig(filename, fig=None, img_tags=None, img_format=None, img_converter=0,
                        tag_names are not present in a pre-existing database \
                        will result in a ValueError being raised. \
                        If False, then adding a new metadata tag to the \
-                       database will cause it be rewritten with the new item \
-                       as a new column. All pre-existing images will have \
-                       the new tag set to 'None'. It is best to avoid using \
-                       this functionality as it can be slow for large \
-                       databases. Instead, all images should be ideally have \
-                       all expected metadata tags included from the start \
-                       but set to 'None' where they are not used.
+                       database will add it to the table as a new column. \
+                       All pre-existing images will have the new tag set \
+                       to 'None'.
+     * db_buffered - if True, the metadata is written by the \
+                     :class:`ImageMetaTag.db.DbWriter` for the db_file in \
+                     this process (see :func:`ImageMetaTag.db.get_db_writer`)\
+                     which keeps the database open and commits the images \
+                     in batches. This is much quicker when lots of \
+                     processes are writing to the same database, but the \
+                     images are not in the database until they are \
+                     committed, by :func:`ImageMetaTag.db.flush_db_writers` \
+                     or when the process exits. The db_timeout, db_attempts \
+                     and db_add_strict options are only used when the \
+                     DbWriter is created.
+     * db_sharded - if True, the metadata is written to a shard of the \
+                    db_file that is only used by this process (see \
+                    :func:`ImageMetaTag.db.shard_db_file`), so it never \
+                    has to wait for other processes to unlock the \
+                    database. The shards must then be added to the db_file \
+                    with :func:`ImageMetaTag.db.consolidate_shards`. This \
+                    can be combined with db_buffered.
      * dpi - change the image resolution passed into matplotlib.savefig.
      * keep_open - by default, this savefig wrapper closes the figure after \
                    use, except if keep_open is True.
+     * agg_buffer - if True, and the image is going to be post-processed, \
+                    the figure is drawn directly onto a matplotlib Agg \
+                    canvas and its pixel buffer is passed straight to \
+                    :func:`ImageMetaTag.image_file_postproc`. This avoids \
+                    encoding the figure to a png in memory, only to decode \
+                    it again, so is faster. Any savefig specific rcParams \
+                    (e.g. savefig.facecolor) are not used in this mode; \
+                    the figure's own settings are used instead.
+     * postproc_queue - a :class:`ImageMetaTag.PostprocQueue`. If \
+                        supplied, savefig returns as soon as the figure is \
+                        rendered and the post-processing and database \
+                        write are done by the queue's workers.
+     * skip_unchanged - if True, a hash of the img_tags, data_fingerprint, \
+                        dpi and post-processing options is stored in the \
+                        database alongside the image metadata. When savefig \
+                        is called again for the same file, with the same \
+                        hash, and the file exists, it returns straight away \
+                        without drawing, post-processing or writing to the \
+                        database. Requires db_file and img_tags. When the \
+                        image is saved, its database entry is replaced \
+                        (as db_replace=True) as its metadata may have changed.
+     * data_fingerprint - anything identifying the data that is plotted, \
+                          (such as a file modification time, or a checksum \
+                          as bytes) to be included in the skip_unchanged hash.
+     * metrics - a :class:`ImageMetaTag.SavefigMetrics` to record the time \
+                 taken by each stage of saving the image, and the image \
+                 sizes.
      * verbose - switch for verbose output (reports file sizes before/after \
                  conversion)
      * img_converter - see :func:`ImageMetaTag.image_file_postproc`.
      * do_trim - see :func:`ImageMetaTag.image_file_postproc`.
      * trim_border - see :func:`ImageMetaTag.image_file_postproc`.
+     * trim_tolerance - see :func:`ImageMetaTag.image_file_postproc`.
+     * trim_key - see :func:`ImageMetaTag.image_file_postproc`.
+     * trim_check - see :func:`ImageMetaTag.image_file_postproc`.
+     * palette_key - see :func:`ImageMetaTag.image_file_postproc`.
+     * png_profile - see :func:`ImageMetaTag.image_file_postproc`.
      * logo_file - see :func:`ImageMetaTag.image_file_postproc`.
      * logo_width - see :func:`ImageMetaTag.image_file_postproc`.
      * logo_height - see :func:`ImageMetaTag.image_file_postproc`.
@@ -127,11 +204,48 @@ def savefig(filename, fig=None, img_tags=None, img_format=None, img_converter=0,
             img_format = img_format[1:]
         write_file = '%s.%s' % (filename, img_format)
 
+    postproc_opts = {'img_converter': img_converter,
+                     'do_trim': do_trim, 'trim_border': trim_border,
+                     'trim_tolerance': trim_tolerance,
+                     'trim_key': trim_key, 'trim_check': trim_check,
+                     'palette_key': palette_key, 'png_profile': png_profile,
+                     'logo_file': logo_file, 'logo_width': logo_width,
+                     'logo_height': logo_height,
+                     'logo_padding': logo_padding, 'logo_pos': logo_pos,
+                     'do_thumb': do_thumb}
+    db_opts = {'db_file': db_file, 'db_timeout': db_timeout,
+               'db_attempts': db_attempts, 'db_replace': db_replace,
+               'db_add_strict': db_add_strict, 'db_full_paths': db_full_paths,
+               'db_buffered': db_buffered, 'db_sharded': db_sharded}
+
+    if skip_unchanged:
+        if db_file is None or img_tags is None:
+            raise ValueError('skip_unchanged requires both db_file and img_tags')
+        img_hash = _savefig_hash(img_tags, data_fingerprint, dpi,
+                                 postproc_opts)
+        if _savefig_unchanged(filename, write_file, img_hash, do_thumb,
+                              db_file, db_timeout, db_full_paths,
+                              db_sharded):
+            if verbose:
+                print('Unchanged, so not saving: {}'.format(write_file))
+            if not keep_open:
+                close_fn()
+            return
+        # the image has changed, so its metadata might have too:
+        db_opts['db_replace'] = True
+        db_opts['img_hash'] = img_hash
+
     # Where to save the figure to? If we're going to postprocess it, save to
     # memory for speed and to cut down on IO load:
     do_any_postproc = (img_format in META_IMG_FORMATS or
                        img_format in POSTPROC_IMG_FORMATS)
-    if do_any_postproc:
+    im_obj = None
+    if do_any_postproc and agg_buffer:
+        # draw the figure and use its pixels directly, with no file at all:
+        buf = None
+        with _metrics_stage(metrics, 'render'):
+            im_obj = _fig_to_im_obj(fig, dpi=dpi)
+    elif do_any_postproc:
         buf = io.BytesIO()
         savefig_file = buf
     else:
@@ -139,40 +253,74 @@ def savefig(filename, fig=None, img_tags=None, img_format=None, img_converter=0,
         buf = None
 
     # should probably add lots of other args, or use **kwargs
-    if dpi:
-        savefig_fn(savefig_file, dpi=dpi)
-    else:
-        savefig_fn(savefig_file)
+    if im_obj is None:
+        with _metrics_stage(metrics, 'render'):
+            if dpi:
+                savefig_fn(savefig_file, dpi=dpi)
+            else:
+                savefig_fn(savefig_file)
     if not keep_open:
         close_fn()
     if buf:
         # need to go to the start of the buffer, if that's where it went:
         buf.seek(0)
 
-    if img_format in META_IMG_FORMATS:
-        use_img_tags = img_tags
-    else:
-        use_img_tags = None
-
-    if verbose:
-        postproc_st = datetime.now()
-
     if img_format in POSTPROC_IMG_FORMATS:
         if dpi is None or img_format not in DPI_IMG_FORMATS:
             img_dpi = None
         else:
             img_dpi = (dpi, dpi)
-        image_file_postproc(write_file, img_buf=buf, img_dpi=img_dpi,
-                            img_converter=img_converter, do_trim=do_trim,
-                            trim_border=trim_border, logo_file=logo_file,
-                            logo_width=logo_width, logo_height=logo_height,
-                            logo_padding=logo_padding, logo_pos=logo_pos,
-                            do_thumb=do_thumb, img_tags=use_img_tags,
-                            verbose=verbose)
     else:
         msg = 'Currently, ImageMetaTag does not support "{}" format images'
         raise NotImplementedError(msg.format(img_format))
 
+    if postproc_queue is None:
+        _savefig_postproc_and_db(filename, write_file, img_format, buf,
+                                 im_obj, img_dpi, img_tags, postproc_opts,
+                                 db_opts, metrics, verbose)
+    else:
+        # the pixels and tags are handed over to another thread/process,
+        # so they must not be shared with anything the caller might change
+        # (an agg_buffer image is a view of the figure's canvas):
+        if im_obj is not None:
+            im_obj = im_obj.copy()
+        if img_tags is not None:
+            img_tags = dict(img_tags)
+        job_args = (filename, write_file, img_format, buf, im_obj, img_dpi,
+                    img_tags, postproc_opts, db_opts)
+        if metrics is not None and postproc_queue.use_processes:
+            # another process can't add to the metrics, so the job records
+            # its own, which are merged in when it is done:
+            postproc_queue._submit(_savefig_postproc_job, (job_args, verbose),
+                                   merge_metrics=metrics)
+        else:
+            postproc_queue.submit(_savefig_postproc_and_db,
+                                  *(job_args + (metrics, verbose)))
+
+
+def _savefig_postproc_and_db(filename, write_file, img_format, buf, im_obj,
+                             img_dpi, img_tags, postproc_opts, db_opts,
+                             metrics, verbose):
+    '''
+    Does the work of :func:`ImageMetaTag.savefig` after the figure has been
+    rendered: the image post-processing and then the database write.
+
+    This is a separate function so it can be run by a
+    :class:`ImageMetaTag.PostprocQueue`.
+    '''
+
+    if img_format in META_IMG_FORMATS:
+        use_img_tags = img_tags
+    else:
+        use_img_tags = None
+
+    if verbose:
+        postproc_st = datetime.now()
+
+    image_file_postproc(write_file, img_buf=buf, img_obj=im_obj,
+                        img_dpi=img_dpi, img_tags=use_img_tags,
+                        metrics=metrics, verbose=verbose, **postproc_opts)
+
     # image post-processing completed, so close the buffer if we opened it:
     if buf:
         buf.close()
@@ -181,58 +329,613 @@ def savefig(filename, fig=None, img_tags=None, img_format=None, img_converter=0,
         print(msg.format(str(datetime.now() - postproc_st)))
 
     # now write to the database, if it is specifed:
-    if not (db_file is None or img_tags is None):
+    if not (db_opts['db_file'] is None or img_tags is None):
+        _savefig_db_write(filename, write_file, img_tags, metrics=metrics,
+                          verbose=verbose, **db_opts)
+
+
+def _savefig_postproc_job(job_args, verbose):
+    '''
+    Runs :func:`_savefig_postproc_and_db` in a PostprocQueue process,
+    returning the SavefigMetrics it recorded.
+    '''
+    job_metrics = SavefigMetrics()
+    _savefig_postproc_and_db(*(job_args + (job_metrics, verbose)))
+    return job_metrics
+
+
+def _savefig_hash(img_tags, data_fingerprint, dpi, postproc_opts):
+    'returns a hash of everything that determines the output of savefig'
+    hasher = hashlib.sha1()
+    hasher.update(repr(sorted(img_tags.items())).encode('utf-8'))
+    hasher.update(repr(dpi).encode('utf-8'))
+    hasher.update(repr(sorted(postproc_opts.items())).encode('utf-8'))
+    if isinstance(data_fingerprint, bytes):
+        hasher.update(data_fingerprint)
+    else:
+        hasher.update(repr(data_fingerprint).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def _savefig_unchanged(filename, write_file, img_hash, do_thumb, db_file,
+                       db_timeout, db_full_paths, db_sharded=False):
+    '''
+    Tests whether an image saved by savefig, with skip_unchanged, is already
+    on disk and in the database with the same hash.
+    '''
+    if not os.path.isfile(write_file):
+        return False
+    if do_thumb:
+        thumb_file = os.path.join(os.path.split(write_file)[0],
+                                  THUMB_DEFAULT_DIR_NAME,
+                                  os.path.split(write_file)[1])
+        if not os.path.isfile(thumb_file):
+            return False
+    db_filename = _db_filename(filename, db_file, db_full_paths)
+    if db_sharded:
+        # it might not have been consolidated yet:
+        shard_file = db.shard_db_file(db_file)
+        if db.read_img_hash(shard_file, db_filename,
+                            timeout=db_timeout) == img_hash:
+            return True
+    return db.read_img_hash(db_file, db_filename,
+                            timeout=db_timeout) == img_hash
+
+
+def _savefig_db_write(filename, write_file, img_tags, db_file=None,
+                      db_timeout=DEFAULT_DB_TIMEOUT,
+                      db_attempts=DEFAULT_DB_ATTEMPTS, db_replace=False,
+                      db_add_strict=False, db_full_paths=False,
+                      db_buffered=False, db_sharded=False, img_hash=None,
+                      metrics=None, verbose=False):
+    'Writes the metadata of an image saved by savefig to the database'
+
+    if verbose:
+        db_st = datetime.now()
+    if metrics is not None:
+        db_perf_st = _perf_counter()
+
+    # relative to the db_file, even if it is going to a shard of it:
+    db_filename = _db_filename(filename, db_file, db_full_paths)
+    if db_sharded:
+        db_file = db.shard_db_file(db_file)
+
+    if db_buffered:
+        # the DbWriter does its own retries, when it commits:
+        db_writer = db.get_db_writer(db_file, timeout=db_timeout,
+                                     attempts=db_attempts,
+                                     add_strict=db_add_strict)
+        db_writer.write(db_filename, img_tags, attempt_replace=db_replace,
+                        img_hash=img_hash)
+        if metrics is not None:
+            metrics.add_time('db', _perf_counter() - db_perf_st)
+        if verbose:
+            msg = 'Database write (buffered) took: {}'
+            print(msg.format(str(datetime.now() - db_st)))
+        return
+
+    wrote_db = False
+    n_tries = 1
+    while not wrote_db and n_tries <= db_attempts:
+        try:
+            if metrics is not None:
+                attempt_st = _perf_counter()
+            db.write_img_to_dbfile(db_file, db_filename, img_tags,
+                                   timeout=db_timeout,
+                                   attempt_replace=db_replace,
+                                   add_strict=db_add_strict,
+                                   img_hash=img_hash)
+            wrote_db = True
+        except sqlite3.OperationalError as op_err:
+            if 'database is locked' in repr(op_err):
+                # database being locked is what the retries and timeouts
+                # are for:
+                msg = ('{} database timeout for image "{}", writing to '
+                       'file "{}", {} s')
+                print(msg.format(db.dt_now_str(),
+                                 db_file,
+                                 write_file,
+                                 n_tries * db_timeout))
+                n_tries += 1
+                last_err = op_err
+                if metrics is not None:
+                    metrics.add_db_lock_wait(_perf_counter() - attempt_st)
+            else:
+                # everything else needs to be reported and raised
+                # immediately:
+                msg = '{} for file {}'.format(op_err, db_file)
+                raise sqlite3.OperationalError(msg)
+    if n_tries > db_attempts:
+        msg = '{} for file {}'.format(last_err, db_file)
+        raise sqlite3.OperationalError(msg)
+    if metrics is not None:
+        metrics.add_time('db', _perf_counter() - db_perf_st)
+    if verbose:
+        msg = 'Database write took: {}'
+        print(msg.format(str(datetime.now() - db_st)))
+
+
+def _db_filename(filename, db_file, db_full_paths):
+    '''
+    If the image path can be expressed as a relative path compared to the
+    database file, then do so (unless told otherwise by db_full_paths).
+    '''
+    db_dir = os.path.split(db_file)[0]
+    if filename.startswith(db_dir) and not db_full_paths:
+        return os.path.relpath(filename, db_dir)
+    return filename
+
+
+def savefig_many(jobs, db_file=None, n_proc=4,
+                 db_timeout=DEFAULT_DB_TIMEOUT,
+                 db_attempts=DEFAULT_DB_ATTEMPTS,
+                 db_replace=False, db_add_strict=False, db_full_paths=False,
+                 metrics=None, verbose=False):
+    '''
+    Saves a batch of figures with :func:`ImageMetaTag.savefig`, using a pool
+    of processes, then writes the metadata of all of them to the database
+    in one go. This is much quicker than each image opening, locking and
+    committing to the database separately.
+
+    Arguments:
+
+    * jobs - an iterable of (fig, filename, img_tags, options) tuples, where:
+
+      * fig is either a matplotlib figure, or a function that takes no \
+        arguments, draws a figure and returns it (or returns None if it \
+        drew on the current pyplot figure). With n_proc > 1 this must be \
+        picklable, so a function should be defined at module level.
+      * filename and img_tags are as for :func:`ImageMetaTag.savefig`.
+      * options is a dictionary of any other savefig options (or None). \
+        The database options are set for the whole batch, by savefig_many.
+
+    Options:
+
+    * db_file - the database file to write the image metadata to, as \
+                :func:`ImageMetaTag.savefig`.
+    * n_proc - number of processes to use. If 1 (or None), the jobs are run \
+               in series in this process, which is much easier to debug.
+    * db_timeout, db_attempts, db_replace, db_add_strict, db_full_paths - \
+                as :func:`ImageMetaTag.savefig`.
+    * metrics - a :class:`ImageMetaTag.SavefigMetrics`, to which the \
+                metrics of all the jobs, from all processes, are added.
+    * verbose - switch for verbose output.
+
+    Returns a list, in the same order as the jobs, containing None for each
+    job that succeeded, or the exception raised by a job that failed. A
+    failed job does not stop the rest of the batch.
+    '''
+    jobs = list(jobs)
+    # each job collects its own metrics, as it may be in another process:
+    job_args = [(job, metrics is not None) for job in jobs]
+
+    if n_proc is None or n_proc == 1:
+        results = [_savefig_job(job_arg) for job_arg in job_args]
+    else:
+        proc_pool = Pool(n_proc)
+        try:
+            results = proc_pool.map(_savefig_job, job_args, chunksize=1)
+            proc_pool.close()
+        except BaseException:
+            # don't leave the workers running (after a KeyboardInterrupt, for instance):
+            proc_pool.terminate()
+            raise
+        finally:
+            proc_pool.join()
+
+    errors = [err for _, _, err, _ in results]
+    if metrics is not None:
+        for job_metrics in [x for _, _, _, x in results]:
+            metrics.merge(job_metrics)
+
+    if db_file is not None:
         if verbose:
             db_st = datetime.now()
+        img_infos = {}
+        for filename, img_tags, err, _ in results:
+            if err is None and img_tags is not None:
+                db_filename = _db_filename(filename, db_file, db_full_paths)
+                img_infos[db_filename] = img_tags
+        if img_infos:
+            with _metrics_stage(metrics, 'db'):
+                _savefig_many_db_write(db_file, img_infos, db_timeout,
+                                       db_attempts, db_replace, db_add_strict,
+                                       metrics=metrics)
+        if verbose:
+            msg = 'Database write of {} images took: {}'
+            print(msg.format(len(img_infos), str(datetime.now() - db_st)))
+
+    if verbose:
+        n_fail = len([x for x in errors if x is not None])
+        if n_fail > 0:
+            print('WARNING: {} of {} savefig jobs failed'.format(n_fail,
+                                                                len(jobs)))
 
-        # if the image path can be expressed as a relative path compared
-        # to the database file, then do so (unless told otherwise).
-        db_dir = os.path.split(db_file)[0]
-        if filename.startswith(db_dir) and not db_full_paths:
-            db_filename = os.path.relpath(filename, db_dir)
+    return errors
+
+
+def _savefig_job(job_arg):
+    '''
+    Runs a single job for :func:`ImageMetaTag.savefig_many`, returning
+    the filename, the image tags (as updated by the post-processing), any
+    error and a SavefigMetrics (or None if it was not asked for).
+    '''
+    (fig, filename, img_tags, options), do_metrics = job_arg
+    job_metrics = SavefigMetrics() if do_metrics else None
+    try:
+        if options is None:
+            options = {}
+        else:
+            options = dict(options)
+        for db_opt in ('db_file', 'postproc_queue', 'metrics'):
+            if db_opt in options:
+                msg = 'savefig_many jobs cannot set the "{}" option'
+                raise ValueError(msg.format(db_opt))
+        if img_tags is not None:
+            img_tags = dict(img_tags)
+        if callable(fig):
+            new_fig = fig()
+            if new_fig is None:
+                new_fig = plt.gcf()
+            savefig(filename, fig=new_fig, img_tags=img_tags,
+                    metrics=job_metrics, **options)
+            # the figure was made for this job, so get rid of it entirely:
+            plt.close(new_fig)
         else:
-            db_filename = filename
+            savefig(filename, fig=fig, img_tags=img_tags,
+                    metrics=job_metrics, **options)
+    except Exception as err:
+        return filename, None, err, job_metrics
+    return filename, img_tags, None, job_metrics
 
-        wrote_db = False
-        n_tries = 1
-        while not wrote_db and n_tries <= db_attempts:
+
+def _savefig_many_db_write(db_file, img_infos, db_timeout, db_attempts,
+                           db_replace, db_add_strict, metrics=None):
+    '''
+    Writes a dictionary of {filename: img_info} to a database file for
+    :func:`ImageMetaTag.savefig_many`, in a single transaction.
+    '''
+    first_info = next(iter(img_infos.values()))
+    wrote_db = False
+    n_tries = 1
+    while not wrote_db and n_tries <= db_attempts:
+        attempt_st = _perf_counter()
+        try:
+            dbcn, dbcr = db.open_or_create_db_file(db_file, first_info,
+                                                   timeout=db_timeout)
             try:
-                db.write_img_to_dbfile(db_file, db_filename, img_tags,
-                                       timeout=db_timeout,
-                                       attempt_replace=db_replace,
-                                       add_strict=db_add_strict)
-                wrote_db = True
-            except sqlite3.OperationalError as op_err:
-                if 'database is locked' in repr(op_err):
-                    # database being locked is what the retries and timeouts
-                    # are for:
-                    msg = ('{} database timeout for image "{}", writing to '
-                           'file "{}", {} s')
-                    print(msg.format(db.dt_now_str(),
-                                     db_file,
-                                     write_file,
-                                     n_tries * db_timeout))
-                    n_tries += 1
-                else:
-                    # everything else needs to be reported and raised
-                    # immediately:
-                    msg = '{} for file {}'.format(op_err, db_file)
-                    raise sqlite3.OperationalError(msg)
-            except Exception:
-                raise
-        if n_tries > db_attempts:
-            raise sqlite3.OperationalError(op_err)
-        if verbose:
-            msg = 'Database write took: {}'
-            print(msg.format(str(datetime.now() - db_st)))
+                db.write_imgs_to_open_db(dbcr, img_infos,
+                                         add_strict=db_add_strict,
+                                         attempt_replace=db_replace)
+                dbcn.commit()
+            finally:
+                dbcn.close()
+            wrote_db = True
+        except sqlite3.OperationalError as op_err:
+            if 'database is locked' in repr(op_err):
+                msg = '{} database timeout writing to file "{}", {} s'
+                print(msg.format(db.dt_now_str(), db_file,
+                                 n_tries * db_timeout))
+                n_tries += 1
+                last_err = op_err
+                if metrics is not None:
+                    metrics.add_db_lock_wait(_perf_counter() - attempt_st)
+            else:
+                msg = '{} for file {}'.format(op_err, db_file)
+                raise sqlite3.OperationalError(msg)
+    if n_tries > db_attempts:
+        msg = '{} for file {}'.format(last_err, db_file)
+        raise sqlite3.OperationalError(msg)
+
+
+class PostprocQueue(object):
+    '''
+    A bounded pool of worker threads (or processes) that run the image
+    post-processing and database writes of :func:`ImageMetaTag.savefig`, so
+    that savefig can return as soon as the figure has been rendered. This
+    lets matplotlib get on with drawing the next figure while the previous
+    one is being encoded; Pillow releases the GIL for most of that work so
+    threads are usually sufficient.
+
+    Pass the queue to savefig using the postproc_queue option. The queue
+    should then be flushed with :func:`flush` (or :func:`close`) before the
+    images or database are used. It can also be used as a context manager,
+    which closes the queue on exit::
+
+        with ImageMetaTag.PostprocQueue(n_workers=4) as pp_queue:
+            for ...:
+                ...
+                ImageMetaTag.savefig(filename, img_tags=img_tags,
+                                     postproc_queue=pp_queue)
+
+    Options:
 
+    * n_workers - the number of worker threads/processes (default 2)
+    * max_pending - the maximum number of images that can be waiting to be \
+                    processed. When the queue is full, savefig will wait for \
+                    space rather than keep rendering images into memory. \
+                    Defaults to twice n_workers.
+    * use_processes - if True, use a pool of processes rather than threads.
 
-def image_file_postproc(filename, outfile=None, img_buf=None,
+    If any of the jobs fail, the error is raised by the next call to
+    savefig, :func:`flush` or :func:`close` (once the jobs already in the
+    queue have completed).
+
+    With python 2, this needs the futures package (a backport of
+    concurrent.futures).
+
+    With use_processes, the :class:`ImageMetaTag.SavefigMetrics` of each
+    job are recorded in the worker process, and merged into those passed to
+    savefig when the job is complete.
+    '''
+
+    def __init__(self, n_workers=2, max_pending=None, use_processes=False):
+        # imported here, so python 2 only needs it when there is a queue:
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+        if max_pending is None:
+            max_pending = 2 * n_workers
+        if max_pending < 1:
+            raise ValueError('max_pending must be at least 1')
+        self.use_processes = use_processes
+        if use_processes:
+            self._executor = ProcessPoolExecutor(max_workers=n_workers)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=n_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        # the pending jobs, and the metrics to merge their results into:
+        self._pending = {}
+        self._errors = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # don't hide the original error with any from the queue:
+            self._executor.shutdown(wait=True)
+
+    def submit(self, func, *args, **kwargs):
+        '''
+        Adds a job to the queue, waiting for space if the queue is full.
+        Any error from a previous job is raised here.
+        '''
+        self._submit(func, args, **kwargs)
+
+    def _submit(self, func, args, merge_metrics=None, **kwargs):
+        '''
+        As :func:`submit`, but if merge_metrics is a SavefigMetrics, the job
+        returns a SavefigMetrics which is merged into it.
+        '''
+        self._raise_errors()
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(func, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending[future] = merge_metrics
+        future.add_done_callback(self._job_done)
+
+    def _job_done(self, future):
+        'callback for a completed job'
+        with self._lock:
+            merge_metrics = self._pending.pop(future, None)
+            if not future.cancelled() and future.exception() is not None:
+                self._errors.append(future.exception())
+            elif merge_metrics is not None and not future.cancelled():
+                merge_metrics.merge(future.result())
+        self._slots.release()
+
+    def _raise_errors(self):
+        'raises the first error from any failed job, then forgets them'
+        with self._lock:
+            errors = self._errors
+            self._errors = []
+        if errors:
+            if len(errors) > 1:
+                msg = 'WARNING: {} post-processing jobs failed, raising the first'
+                print(msg.format(len(errors)))
+            raise errors[0]
+
+    def flush(self):
+        'Waits for all of the queued jobs to complete'
+        from concurrent.futures import wait
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending)
+        self._raise_errors()
+
+    def close(self):
+        'Waits for all of the queued jobs to complete, then stops the workers'
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+
+class SavefigMetrics(object):
+    '''
+    Collects timings of each stage of :func:`ImageMetaTag.savefig` and
+    :func:`ImageMetaTag.image_file_postproc`, along with the image sizes
+    before and after post-processing and the time spent waiting for the
+    database to be unlocked. Pass one to savefig, or image_file_postproc,
+    using the metrics option, for as many images as required, and then
+    call :func:`summary` or :func:`report` to see which stages take the
+    time::
+
+        metrics = ImageMetaTag.SavefigMetrics()
+        for ...:
+            ...
+            ImageMetaTag.savefig(filename, img_tags=img_tags,
+                                 metrics=metrics)
+        metrics.report()
+
+    The stages are:
+
+    * render - drawing the figure with matplotlib
+    * decode - loading the rendered image (not needed with agg_buffer)
+    * trim - trimming the image
+    * logo - adding logos
+    * thumbnail - resizing the thumbnail image
+    * quantise - the img_converter colour conversions
+    * encode - writing the image, and thumbnail, files
+    * db - writing to the database, including any waits for it to unlock
+
+    The size before post-processing is that of the png rendered by
+    matplotlib, or of the uncompressed pixels when savefig is used with
+    agg_buffer=True.
+
+    A SavefigMetrics object can be shared between threads. Separate
+    processes each need their own, which can then be combined with
+    :func:`merge` (as :func:`ImageMetaTag.savefig_many`, and a
+    :class:`ImageMetaTag.PostprocQueue` that uses processes, do).
+    '''
+
+    STAGES = ('render', 'decode', 'trim', 'logo', 'thumbnail', 'quantise',
+              'encode', 'db')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def reset(self):
+        'Forgets everything recorded so far'
+        with self._lock:
+            self.times = dict([(stage, []) for stage in self.STAGES])
+            self.bytes_in = []
+            self.bytes_out = []
+            self.db_lock_waits = []
+
+    def add_time(self, stage, seconds):
+        'Records the time, in seconds, taken by a stage for one image'
+        with self._lock:
+            self.times.setdefault(stage, []).append(seconds)
+
+    def add_bytes(self, bytes_in, bytes_out):
+        'Records the size of an image before and after post-processing'
+        with self._lock:
+            self.bytes_in.append(bytes_in)
+            self.bytes_out.append(bytes_out)
+
+    def add_db_lock_wait(self, seconds):
+        'Records the time spent waiting for a locked database'
+        with self._lock:
+            self.db_lock_waits.append(seconds)
+
+    @contextmanager
+    def stage(self, stage):
+        '''
+        A context manager that times the code inside it as a stage::
+
+            with metrics.stage('render'):
+                ...
+        '''
+        start = _perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, _perf_counter() - start)
+
+    def merge(self, other):
+        'Adds everything recorded by another SavefigMetrics object to this one'
+        with other._lock:
+            times = dict([(k, list(v)) for k, v in other.times.items()])
+            bytes_in = list(other.bytes_in)
+            bytes_out = list(other.bytes_out)
+            db_lock_waits = list(other.db_lock_waits)
+        with self._lock:
+            for stage, stage_times in times.items():
+                self.times.setdefault(stage, []).extend(stage_times)
+            self.bytes_in.extend(bytes_in)
+            self.bytes_out.extend(bytes_out)
+            self.db_lock_waits.extend(db_lock_waits)
+
+    def summary(self, percentiles=(50, 90, 99)):
+        '''
+        Returns a dictionary summarising the metrics. For each stage that has
+        been recorded, there is a dictionary of 'count', 'total' and 'mean'
+        times (in seconds), and a 'p<N>' entry for each of the percentiles.
+        There are also summaries of the same form for 'bytes_in',
+        'bytes_out' and 'db_lock_wait', and the overall 'size_ratio'
+        (bytes_out/bytes_in).
+        '''
+        with self._lock:
+            values = dict([(k, list(v)) for k, v in self.times.items() if v])
+            values['bytes_in'] = list(self.bytes_in)
+            values['bytes_out'] = list(self.bytes_out)
+            values['db_lock_wait'] = list(self.db_lock_waits)
+
+        summary = {}
+        for name, vals in values.items():
+            if not vals:
+                continue
+            vals = np.array(vals, dtype=float)
+            summary[name] = {'count': vals.size, 'total': vals.sum(),
+                             'mean': vals.mean()}
+            for pctl in percentiles:
+                summary[name]['p{}'.format(pctl)] = np.percentile(vals, pctl)
+        if 'bytes_in' in summary and summary['bytes_in']['total'] > 0:
+            summary['size_ratio'] = (summary['bytes_out']['total'] /
+                                     summary['bytes_in']['total'])
+        return summary
+
+    def report(self, percentiles=(50, 90, 99)):
+        'Prints a table of the :func:`summary`, with times in milliseconds'
+        summary = self.summary(percentiles=percentiles)
+        cols = ['count', 'mean'] + ['p{}'.format(x) for x in percentiles]
+        print('{:<14}'.format('stage (ms)') +
+              ''.join(['{:>10}'.format(x) for x in cols]))
+        names = [x for x in self.STAGES if x in summary]
+        names += sorted([x for x in summary if x not in self.STAGES and
+                         x not in ('bytes_in', 'bytes_out', 'db_lock_wait',
+                                   'size_ratio')])
+        names += [x for x in ('db_lock_wait',) if x in summary]
+        for name in names:
+            line = '{:<14}{:>10}'.format(name, summary[name]['count'])
+            for col in cols[1:]:
+                line += '{:>10.2f}'.format(1000.0 * summary[name][col])
+            print(line)
+        for name in ('bytes_in', 'bytes_out'):
+            if name in summary:
+                line = '{:<14}{:>10}'.format(name, summary[name]['count'])
+                for col in cols[1:]:
+                    line += '{:>10.0f}'.format(summary[name][col])
+                print(line)
+        if 'size_ratio' in summary:
+            print('size ratio: {:.3f}'.format(summary['size_ratio']))
+
+
+@contextmanager
+def _metrics_stage(metrics, stage):
+    'times a stage, if there is a SavefigMetrics to record it in'
+    if metrics is None:
+        yield
+    else:
+        with metrics.stage(stage):
+            yield
+
+
+def image_file_postproc(filename, outfile=None, img_buf=None, img_obj=None,
                         img_dpi=None, img_converter=0,
-                        do_trim=False, trim_border=0,
-                        logo_file=None, logo_width=None, logo_height=None,
+                        do_trim=False, trim_border=0, trim_tolerance=None,
+                        trim_key=None, trim_check=True, palette_key=None,
+                        png_profile=None, logo_file=None, logo_width=None, logo_height=None,
                         logo_padding=0, logo_pos=0,
-                        do_thumb=False, img_tags=None, verbose=False):
+                        do_thumb=False, img_tags=None, metrics=None,
+                        verbose=False):
     '''
     Does the image post-processing for :func:`ImageMetaTag.savefig`.
 
@@ -246,6 +949,10 @@ def image_file_postproc(filename, outfile=None, img_buf=None,
     * img_buf - If the image has been saved to an in-memory buffer, then \
                 supply the image buffer here. This will speed up the \
                 post-processing.
+    * img_obj - If the image is already loaded, as a PIL Image object (as \
+                it is when :func:`ImageMetaTag.savefig` is used with \
+                agg_buffer=True), then supply it here. This is the fastest \
+                option as there is nothing to decode.
     * img_dpi - output image dpi (if available for the image format) \
                 as a tuple for horizontal/vertical values eg: (72, 72)
     * img_converter - an integer switch controlling the level of file size \
@@ -256,9 +963,43 @@ def image_file_postproc(filename, outfile=None, img_buf=None,
                           adaptive 256 colour palette.
                     * 3 - heavy compression, from RGBA to RGB, then to 8-bit \
                           web standard palette.
+                    * 4 - automatic, from RGBA to RGB, then to an exact \
+                          palette if the image has 256 colours or fewer, \
+                          so there is no loss of quality at all. Images \
+                          with more colours are treated as option 2.
+    * palette_key - for img_converter 2 or 4, a key (any hashable value) \
+                    identifying a series of images that should all use the \
+                    same palette, such as maps drawn with the same colormap. \
+                    The adaptive palette is worked out for the first image \
+                    of the series (unless it has been set up already with \
+                    :func:`ImageMetaTag.set_series_palette`) and the rest \
+                    are mapped onto it, which is quicker and also stops \
+                    animated images from flickering.
+    * png_profile - the png encoding profile: 'fast', 'balanced' or \
+                    'smallest'. If None, the default set by \
+                    :func:`ImageMetaTag.set_png_profile` is used, which is \
+                    initially 'smallest'.
     * do_trim - switch to trim whitespace from the edge of the image
     * trim_border - if do_trim then this can be used to define an integer \
                     number of pixels as a border around the trim.
+    * trim_tolerance - if do_trim, pixels whose colour differs from the \
+                       background (top left) colour by no more than this, \
+                       in every channel, are trimmed as background. \
+                       0 is an exact match. The default (None) trims as \
+                       older versions did: differences of up to 50 are \
+                       background, and images with an alpha channel are \
+                       trimmed by their alpha channel (or, if that is the \
+                       same as the background everywhere, by an exact \
+                       match of the colour).
+    * trim_key - if do_trim, a key (any hashable value, such as a string \
+                 naming the figure layout) identifying a series of images \
+                 that all trim to the same bounding box. The bounding box \
+                 is worked out for the first image of that size with the \
+                 key, and then reused for the rest of the series.
+    * trim_check - if True (default), a reused trim_key bounding box is \
+                   checked by looking only at the rows and columns either \
+                   side of its edges. If that shows the content has moved, \
+                   the bounding box is worked out again.
     * logo_file - a file, or list of image files, to be added as logo(s) to \
                   the image. When multiple files are added to the same \
                   logo_pos then they are grouped horizontally from left to \
@@ -285,6 +1026,9 @@ def image_file_postproc(filename, outfile=None, img_buf=None,
     * do_thumb - switch to produce default sized thumbnail, or integer/tuple \
                  to define the maximum size in pixels
     * img_tags: a dictionary of tags to be added to the image metadata
+    * metrics: a :class:`ImageMetaTag.SavefigMetrics` to record the time \
+               taken by each stage of the post-processing, and the image \
+               sizes before/after.
     * verbose: switch for verbose output (reports file sizes before/after \
                conversion)
 
@@ -306,18 +1050,24 @@ def image_file_postproc(filename, outfile=None, img_buf=None,
     if not outfile:
         outfile = filename
 
-    if verbose:
-        if img_buf:
-            st_fsize = int(sys.getsizeof(img_buf))
+    if verbose or metrics is not None:
+        if img_obj is not None:
+            # uncompressed size of the pixels:
+            st_fsize = (img_obj.size[0] * img_obj.size[1] *
+                        len(img_obj.getbands()))
+        elif img_buf:
+            st_fsize = _buf_size(img_buf)
         else:
             st_fsize = os.path.getsize(filename)
 
     if not (img_tags is None or isinstance(img_tags, dict)):
         raise ValueError('Image tags must be supplied as a dictionary')
 
-    if img_converter not in range(4):
+    if img_converter not in range(5):
         raise ValueError('Unavailable method for image conversion')
 
+    png_opts = _png_save_opts(png_profile)
+
     # do_thumb should equate to integer type or be a tuple of integers
     #
     # this test is taking advantage of the isinstance(do_thumb, tutple) being
@@ -332,24 +1082,40 @@ def image_file_postproc(filename, outfile=None, img_buf=None,
     modify = (do_trim or do_thumb or img_tags or img_converter > 0 or
               logo_file is not None)
 
-    if img_buf:
+    if img_obj is not None:
+        # the image is already loaded, so there is nothing to decode:
+        im_obj = img_obj
+        if not modify:
+            with _metrics_stage(metrics, 'encode'):
+                im_obj.save(outfile, dpi=img_dpi, **png_opts)
+    elif img_buf:
         # if the image is in a buffer, then load it now
-        im_obj = Image.open(img_buf)
+        with _metrics_stage(metrics, 'decode'):
+            im_obj = Image.open(img_buf)
+            if modify:
+                im_obj.load()
         if not modify:
             # if we're not doing anyhting, then save it:
-            im_obj.save(outfile, dpi=img_dpi, optimize=True)
+            with _metrics_stage(metrics, 'encode'):
+                im_obj.save(outfile, dpi=img_dpi, **png_opts)
     else:
         if modify:
             # use the image library to open the file:
-            im_obj = Image.open(filename)
+            with _metrics_stage(metrics, 'decode'):
+                im_obj = Image.open(filename)
+                im_obj.load()
 
     if do_trim:
         # call the _im_trim routine defined above:
-        im_obj = _im_trim(im_obj, border=trim_border)
+        with _metrics_stage(metrics, 'trim'):
+            im_obj = _im_trim(im_obj, border=trim_border,
+                              tolerance=trim_tolerance, trim_key=trim_key,
+                              trim_check=trim_check)
 
     if logo_file is not None:
-        im_obj = _im_logos(im_obj, logo_file, logo_size,
-                           logo_padding, logo_pos)
+        with _metrics_stage(metrics, 'logo'):
+            im_obj = _im_logos(im_obj, logo_file, logo_size,
+                               logo_padding, logo_pos)
 
     if do_thumb:
         # make a thumbnail image here, if required. It is important to do this
@@ -373,8 +1139,12 @@ def image_file_postproc(filename, outfile=None, img_buf=None,
         elif not isinstance(do_thumb, tuple):
             do_thumb = (do_thumb, do_thumb)
         # create the thumbnail
-        im_thumb = im_obj.copy()
-        im_thumb.thumbnail(do_thumb, Image.ANTIALIAS)
+        with _metrics_stage(metrics, 'thumbnail'):
+            im_thumb = im_obj.copy()
+            im_thumb.thumbnail(do_thumb, Image.ANTIALIAS)
+
+    if metrics is not None and img_converter > 0:
+        quantise_st = _perf_counter()
 
     # images start out as RGBA, strip out the alpha channel first by
     # converting to RGB,then you convert to the next format
@@ -387,14 +1157,24 @@ def image_file_postproc(filename, outfile=None, img_buf=None,
     elif img_converter == 2:
         # second conversion to 8-bit 'P', palette mode with an adaptive
         # palette. works well for line plots.
-        im_obj = _im_P256(im_obj)
+        im_obj = _im_P256(im_obj, palette_key=palette_key)
         if do_thumb:
-            im_thumb = _im_P256(im_thumb)
+            im_thumb = _im_P256(im_thumb, palette_key=palette_key)
     elif img_converter == 3:
         # this is VERY strong optimisation and the result can be speckly.
         im_obj = _im_PWEB(im_obj)
         if do_thumb:
             im_thumb = _im_PWEB(im_thumb)
+    elif img_converter == 4:
+        # lossless where possible, which is quicker too:
+        im_obj = _im_P256_auto(im_obj, palette_key=palette_key)
+        if do_thumb:
+            im_thumb = _im_P256_auto(im_thumb, palette_key=palette_key)
+
+    if metrics is not None:
+        if img_converter > 0:
+            metrics.add_time('quantise', _perf_counter() - quantise_st)
+        encode_st = _perf_counter()
 
     if do_thumb:
         # now save the thumbnail:
@@ -403,12 +1183,12 @@ def image_file_postproc(filename, outfile=None, img_buf=None,
             im_thumb = _im_add_png_tags(im_thumb, img_tags)
             # and save with metadata
             _im_pngsave_addmeta(im_thumb, thumb_full_path,
-                                optimize=True, verbose=verbose)
+                                png_profile=png_profile, verbose=verbose)
             # set a thumbnail directory tag for the main image
             img_tags.update({'thumbnail directory': thumb_dir_name})
         else:
             # simple save
-            im_thumb.save(thumb_full_path, optimize=True)
+            im_thumb.save(thumb_full_path, **png_opts)
 
     # now save the main image:n
     if img_tags:
@@ -416,10 +1196,15 @@ def image_file_postproc(filename, outfile=None, img_buf=None,
         im_obj = _im_add_png_tags(im_obj, img_tags)
         # and save with metadata
         _im_pngsave_addmeta(im_obj, outfile, img_dpi=img_dpi,
-                            optimize=True, verbose=verbose)
+                            png_profile=png_profile, verbose=verbose)
     elif modify:
         # simple save
-        im_obj.save(outfile, dpi=img_dpi, optimize=True)
+        im_obj.save(outfile, dpi=img_dpi, **png_opts)
+
+    if metrics is not None:
+        if modify:
+            metrics.add_time('encode', _perf_counter() - encode_st)
+        metrics.add_bytes(st_fsize, os.path.getsize(outfile))
 
     if verbose:
         # now report the file size change:
@@ -429,28 +1214,168 @@ def image_file_postproc(filename, outfile=None, img_buf=None,
         print(msg.format(filename, st_fsize, en_fsize, relative_size))
 
 
-def _im_P256(im_obj):
-    'Converts an image object to "P" pallette mode with 256 colours (8-bit)'
+def _buf_size(img_buf):
+    'returns the size, in bytes, of the contents of a file-like buffer'
+    pos = img_buf.tell()
+    img_buf.seek(0, io.SEEK_END)
+    size = img_buf.tell()
+    img_buf.seek(pos)
+    return size
+
+
+def _fig_to_im_obj(fig, dpi=None):
+    '''
+    Draws a matplotlib figure on an Agg canvas and returns its pixels as an
+    RGBA PIL Image object, which shares memory with the canvas buffer.
+    '''
+    if fig is None:
+        fig = plt.gcf()
+    orig_canvas = fig.canvas
+    orig_dpi = fig.dpi
+    if isinstance(orig_canvas, FigureCanvasAgg):
+        canvas = orig_canvas
+    else:
+        # this attaches itself to the figure, so is put back afterwards:
+        canvas = FigureCanvasAgg(fig)
+    try:
+        if dpi:
+            fig.set_dpi(dpi)
+        canvas.draw()
+        # the buffer is (height, width, 4), so the array is just a view of
+        # it, and so is the image created from that array:
+        im_obj = Image.fromarray(np.asarray(canvas.buffer_rgba()), 'RGBA')
+    finally:
+        if dpi:
+            fig.set_dpi(orig_dpi)
+        if canvas is not orig_canvas:
+            fig.set_canvas(orig_canvas)
+
+    return im_obj
+
+
+def _im_P256(im_obj, palette_key=None):
+    '''
+    Converts an image object to "P" pallette mode with 256 colours (8-bit).
+    If palette_key is given, the palette is shared with the other images
+    using that key.
+    '''
     # convert to RGB first to get rid of alpha channel:
     tmp_im = im_obj.convert('RGB')
+    if palette_key is not None:
+        return _im_series_palette(tmp_im, palette_key)
     # then return that, converted to 8bit P:
     return tmp_im.convert('P', palette=Image.ADAPTIVE, colors=256)
 
 
+def _im_series_palette(rgb_im, palette_key):
+    '''
+    Converts an RGB image object to "P" pallette mode using the palette
+    stored for palette_key. If there isn't one, the adaptive palette of this
+    image is used and stored for the next image.
+    '''
+    palette_im = _PALETTE_CACHE.get(palette_key)
+    if palette_im is None:
+        p_im = rgb_im.convert('P', palette=Image.ADAPTIVE, colors=256)
+        palette_im = Image.new('P', (1, 1))
+        palette_im.putpalette(p_im.getpalette())
+        _PALETTE_CACHE.put(palette_key, palette_im)
+        return p_im
+    return rgb_im.quantize(palette=palette_im, dither=Image.NONE)
+
+
+def set_series_palette(palette_key, cmap=None, extra_colours=('white', 'black'),
+                       n_colours=256):
+    '''
+    Sets the palette to be used by :func:`ImageMetaTag.savefig` and
+    :func:`ImageMetaTag.image_file_postproc` for images saved with the
+    given palette_key (with img_converter 2 or 4), from a matplotlib
+    colormap. Without this, the palette comes from the first image saved
+    with the palette_key.
+
+    Arguments:
+
+    * palette_key - the key for the series of images.
+
+    Options:
+
+    * cmap - a matplotlib colormap, or the name of one, that the images \
+             are plotted with. If None, the palette is just the extra_colours.
+    * extra_colours - a list of other matplotlib colours to include in the \
+                      palette, for the text, lines and background etc. \
+                      Defaults to white and black.
+    * n_colours - the total number of colours in the palette, up to 256.
+    '''
+    if n_colours > 256:
+        raise ValueError('A palette can have no more than 256 colours')
+    colours = [mcolors.to_rgb(x) for x in extra_colours]
+    if len(colours) > n_colours:
+        raise ValueError('More extra_colours than n_colours')
+    if cmap is not None:
+        cmap = plt.get_cmap(cmap)
+        n_cmap = n_colours - len(colours)
+        colours.extend([x[:3] for x in cmap(np.linspace(0, 1, n_cmap))])
+    palette = np.round(np.array(colours) * 255).astype(np.uint8)
+
+    palette_im = Image.new('P', (1, 1))
+    palette_im.putpalette(palette.tobytes())
+    _PALETTE_CACHE.put(palette_key, palette_im)
+
+
+def _im_P256_auto(im_obj, palette_key=None):
+    '''
+    Converts an image object to "P" pallette mode. If it has 256 colours or
+    fewer this uses an exact palette, otherwise it is as :func:`_im_P256`
+    '''
+    tmp_im = im_obj.convert('RGB')
+    # this stops counting as soon as there are too many colours:
+    colours = tmp_im.getcolors(maxcolors=256)
+    if colours is None:
+        if palette_key is not None:
+            return _im_series_palette(tmp_im, palette_key)
+        return tmp_im.convert('P', palette=Image.ADAPTIVE, colors=256)
+    return _im_exact_palette(tmp_im, [x[1] for x in colours])
+
+
+def _im_exact_palette(rgb_im, colours):
+    '''
+    Converts an RGB image object to "P" pallette mode using a palette of
+    the given colours, which must include every colour in the image.
+    '''
+    rgb_data = np.asarray(rgb_im)
+    # pack each pixel into a single integer, and the same for the palette,
+    # then the palette index is found by a search of the sorted palette:
+    packed = rgb_data[..., 0].astype(np.uint32) << 16
+    packed |= rgb_data[..., 1].astype(np.uint32) << 8
+    packed |= rgb_data[..., 2]
+    palette = np.array([(r << 16) | (g << 8) | b for r, g, b in colours],
+                       dtype=np.uint32)
+    palette.sort()
+    indices = np.searchsorted(palette, packed).astype(np.uint8)
+
+    p_im = Image.fromarray(indices, 'P')
+    palette_rgb = np.stack([palette >> 16, palette >> 8, palette], axis=1)
+    p_im.putpalette((palette_rgb & 255).astype(np.uint8).tobytes())
+    return p_im
+
+
 def _im_PWEB(im_obj):
     'Converts an image to "P" pallette mode with stadnard web colors'
     tmp_im = im_obj.convert('RGB')
     return tmp_im.convert('P', palette=Image.WEB)
 
 
-def _im_trim(im_obj, border=0):
+def _im_trim(im_obj, border=0, tolerance=None, trim_key=None, trim_check=True):
     'Trims an image object using Python Image Library'
     if not isinstance(border, int):
         msg = 'Input border must be an int, but is "{}", type {} instead'
         raise ValueError(msg.format(border, type(border)))
 
     # get the bounding box for the trim:
-    bbox = _im_getbbox_for_trim(im_obj)
+    if trim_key is None:
+        bbox = _im_getbbox_for_trim(im_obj, tolerance=tolerance)
+    else:
+        bbox = _cached_getbbox_for_trim(im_obj, trim_key, tolerance=tolerance,
+                                        trim_check=trim_check)
     if border != 0 and bbox is not None:
         border_bbox = [-border, -border, border, border]
         # now apply that trim:
@@ -484,34 +1409,178 @@ def _im_trim(im_obj, border=0):
     return im_obj
 
 
-def _im_getbbox_for_trim(im_obj):
+def _im_getbbox_for_trim(im_obj, tolerance=None):
     '''
     works out the bounding box that defines the actual conent of the image
-    assuming that the top left pixel is the background colour
-    '''
-    # make a background using the colour in the top/left corner:
-    bg_col = im_obj.getpixel((1, 1))
-    backg = Image.new(im_obj.mode, im_obj.size, bg_col)
-    # do an image difference:
-    diff = ImageChops.difference(im_obj, backg)
-    # add it together
-    diff = ImageChops.add(diff, diff, 1.0, -100)
-    # and see what the bbox is of that...
-    bbox = diff.getbbox()
+    assuming that the top left pixel is the background colour.
 
-    if bbox is None:
-        # substitute all backgound color for alpha:
-        im_data = np.array(im_obj)
-        im_red, im_grn, im_blu, im_alp = im_data.T
-        bg_areas = (im_red == bg_col[0]) & (im_grn == bg_col[1]) & (im_blu == bg_col[2])
-        # now set that as zero
-        im_data[..., :][bg_areas.T] = (0, 0, 0, 0)
-        diff = Image.fromarray(im_data)
-        # and get the bounding box from that
-        bbox = diff.getbbox()
+    A pixel is background if none of its channels differ from the
+    background colour by more than tolerance. If the background colour is
+    fully transparent, then all fully transparent pixels are background,
+    whatever their colour. If tolerance is None, the background is worked
+    out as older versions did (see :func:`_im_trim_rule`).
+
+    This works on a single array of the image pixels, reducing a mask of
+    the content along the rows and columns, so no other full sized images
+    are created. Returns None if the image is entirely background.
+    '''
+    return _im_bbox_and_rule(im_obj, tolerance)[0]
+
+
+def _im_bbox_and_rule(im_obj, tolerance):
+    'returns the trim bounding box of an image, and the rule used to find it'
+    im_data = _im_array(im_obj)
+    bg_col = im_data[1, 1]
+    rule = _im_trim_rule(im_data, im_obj.mode, bg_col, tolerance)
+    content = _im_content(im_data, bg_col, rule)
+
+    content_rows = np.flatnonzero(content.any(axis=1))
+    if content_rows.size == 0:
+        return None, rule
+    content_cols = np.flatnonzero(content.any(axis=0))
 
+    bbox = (int(content_cols[0]), int(content_rows[0]),
+            int(content_cols[-1]) + 1, int(content_rows[-1]) + 1)
+    return bbox, rule
+
+
+def _cached_getbbox_for_trim(im_obj, trim_key, tolerance=None, trim_check=True):
+    '''
+    As :func:`_im_getbbox_for_trim`, but reusing the bounding box found for
+    a previous image with the same trim_key, size and mode.
+    '''
+    key = (trim_key, im_obj.size, im_obj.mode, tolerance)
+    cached = _TRIM_CACHE.get(key)
+    bbox = None
+    if cached is not None:
+        bbox, rule = cached
+        if trim_check and not _im_bbox_edges_ok(im_obj, bbox, rule):
+            bbox = None
+    if bbox is None:
+        bbox, rule = _im_bbox_and_rule(im_obj, tolerance)
+        if bbox is not None:
+            _TRIM_CACHE.put(key, (bbox, rule))
     return bbox
 
+
+def _im_bbox_edges_ok(im_obj, bbox, rule):
+    '''
+    Cheaply checks that a bounding box still fits the content of an image,
+    looking only at the rows/columns either side of each of its edges:
+    those just outside must be background, and those just inside must
+    contain some content. The rule is the one used to find the bounding box.
+    '''
+    width, height = im_obj.size
+    left, upper, right, lower = bbox
+    bg_col = _im_array(im_obj.crop((1, 1, 2, 2)))[0, 0]
+
+    # (box to check, should it contain content?)
+    checks = [((left, upper, left + 1, lower), True),
+              ((right - 1, upper, right, lower), True),
+              ((left, upper, right, upper + 1), True),
+              ((left, lower - 1, right, lower), True)]
+    if left > 0:
+        checks.append(((left - 1, 0, left, height), False))
+    if right < width:
+        checks.append(((right, 0, right + 1, height), False))
+    if upper > 0:
+        checks.append(((0, upper - 1, width, upper), False))
+    if lower < height:
+        checks.append(((0, lower, width, lower + 1), False))
+
+    for box, want_content in checks:
+        strip = _im_array(im_obj.crop(box))
+        has_content = _im_content(strip, bg_col, rule).any()
+        if has_content != want_content:
+            return False
+    return True
+
+
+def _im_array(im_obj):
+    'returns the pixels of an image as a (rows, columns, channels) array'
+    im_data = np.asarray(im_obj)
+    if im_data.ndim == 2:
+        # single band images (L, P etc.) as a single channel:
+        im_data = im_data[..., np.newaxis]
+    return im_data
+
+
+def _im_trim_rule(im_data, mode, bg_col, tolerance):
+    '''
+    returns the rule used to tell the content of an image array (from
+    :func:`_im_array`) from its background: a slice of the channels to
+    compare with the background colour, and the tolerance to compare them with.
+
+    If tolerance is None, this is what older versions (which used
+    ImageChops) did: channels that differ by more than 50 are content, but for
+    images with an alpha channel only the alpha channel is used, unless it
+    is the same as the background everywhere, when the colour has to match
+    exactly.
+    '''
+    has_alpha = mode in ('RGBA', 'LA', 'PA')
+    if tolerance is not None:
+        if has_alpha and bg_col[-1] == 0:
+            # transparent background, so only the alpha channel matters:
+            return slice(-1, None), tolerance
+        return slice(None), tolerance
+
+    if not has_alpha:
+        return slice(None), TRIM_DEFAULT_TOLERANCE
+    alpha = im_data[..., -1]
+    bg_alpha = int(bg_col[-1])
+    if ((alpha < bg_alpha - TRIM_DEFAULT_TOLERANCE) |
+            (alpha > bg_alpha + TRIM_DEFAULT_TOLERANCE)).any():
+        return slice(-1, None), TRIM_DEFAULT_TOLERANCE
+    if (alpha == bg_alpha).all():
+        # the alpha matches exactly (usually, it is opaque), so all of the
+        # channels can be compared at once:
+        return slice(None), 0
+    return slice(None, -1), 0
+
+
+def _im_content(im_data, bg_col, rule):
+    '''
+    returns a 2d boolean array, True where the pixels of an image array
+    (from :func:`_im_array`) are content rather than background, according
+    to a rule from :func:`_im_trim_rule`.
+    '''
+    chans, tolerance = rule
+    return _im_content_mask(im_data[..., chans], bg_col[chans], tolerance)
+
+
+def _im_content_mask(im_data, bg_col, tolerance=0):
+    '''
+    returns a 2d boolean array, which is True where the pixels of an image
+    array (rows, columns, channels) differ from bg_col by more than
+    tolerance in any channel.
+    '''
+    n_chan = im_data.shape[-1]
+    if (tolerance == 0 and n_chan == 4 and im_data.dtype == np.uint8 and
+            im_data.flags['C_CONTIGUOUS']):
+        # compare all four channels at once, as a single 32 bit integer:
+        as_int = im_data.view(np.uint32)[..., 0]
+        bg_int = np.ascontiguousarray(bg_col).view(np.uint32)[0]
+        return as_int != bg_int
+
+    content = None
+    for i_chan in range(n_chan):
+        chan = im_data[..., i_chan]
+        bg_val = bg_col[i_chan]
+        if tolerance == 0:
+            chan_diff = chan != bg_val
+        else:
+            # compare against the limits, rather than taking a difference,
+            # so there is no need for a signed copy of the data:
+            bg_val = int(bg_val)
+            chan_diff = chan < bg_val - tolerance
+            chan_diff |= chan > bg_val + tolerance
+        if content is None:
+            content = chan_diff
+        else:
+            content |= chan_diff
+    return content
+
+
 def _im_logos(im_obj, logo_files, logo_size, logo_padding, logo_poss):
     '''
     adds logo or logos to the corners of an image object (usually after an
@@ -545,8 +1614,8 @@ def _im_logos(im_obj, logo_files, logo_size, logo_padding, logo_poss):
             logo_file = logo_file[0]
         else:
             # multiple files get merged before adding:
-            logo_file = _logo_merge(logo_file, logo_size, logo_padding,
-                                    im_obj.getpixel((0, 0)))
+            logo_file = _cached_logo_merge(logo_file, logo_size, logo_padding,
+                                           im_obj.getpixel((0, 0)))
         im_obj = _im_logo(im_obj, logo_file, logo_size,
                           logo_padding, logo_pos)
 
@@ -565,7 +1634,7 @@ def _im_logo(im_obj, logo_file, logo_size, logo_padding, logo_pos):
 
     if isinstance(logo_file, str):
         # load in and resize the logo file image:
-        res_logo_obj = resize_logo(Image.open(logo_file), logo_size)
+        res_logo_obj = _cached_logo(logo_file, logo_size)
     else:
         # assume this is a pre-loaded/resized logo image:
         res_logo_obj = logo_file
@@ -687,7 +1756,7 @@ def _logo_merge(logo_list, logo_size, padding, bg_col):
         if logo_file is None:
             pass
         elif isinstance(logo_file, str):
-            im_list.append(resize_logo(Image.open(logo_file), logo_size))
+            im_list.append(_cached_logo(logo_file, logo_size))
         else:
             # going to assume that this is a pre-loaded image object
             # as not simple to do a clean for all PIL image formats
@@ -722,6 +1791,105 @@ def _logo_merge(logo_list, logo_size, padding, bg_col):
     return merged
 
 
+class _LRUCache(object):
+    '''
+    A small, thread safe, dictionary-like cache that holds up to max_size
+    items, discarding the least recently used when it is full.
+    '''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        'returns the cached item for the key, or None if not present'
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return None
+            # put it back, at the most recently used end:
+            self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        'adds an item to the cache'
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        'empties the cache'
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+_LOGO_CACHE = _LRUCache(LOGO_CACHE_SIZE)
+_TRIM_CACHE = _LRUCache(TRIM_CACHE_SIZE)
+_PALETTE_CACHE = _LRUCache(PALETTE_CACHE_SIZE)
+
+
+def clear_caches():
+    '''
+    Empties the caches used by the image post-processing, which are
+    kept for the lifetime of the process:
+
+    * loaded, resized and merged logo images
+    * trim bounding boxes, by trim_key
+    * image series palettes, by palette_key
+    '''
+    _LOGO_CACHE.clear()
+    _TRIM_CACHE.clear()
+    _PALETTE_CACHE.clear()
+
+
+def _logo_size_key(logo_size):
+    'converts a logo_size dict into something that can be a cache key'
+    return tuple(sorted(logo_size.items()))
+
+
+def _cached_logo(logo_file, logo_size):
+    '''
+    Returns the logo image from logo_file resized to logo_size, using the
+    logo cache so the file is only loaded and resized once (unless it
+    changes on disk). The returned image is shared so must not be modified.
+    '''
+    key = ('logo', logo_file, os.path.getmtime(logo_file),
+           _logo_size_key(logo_size))
+    res_logo_obj = _LOGO_CACHE.get(key)
+    if res_logo_obj is None:
+        logo_obj = Image.open(logo_file)
+        # read the pixels now, so the file is closed:
+        logo_obj.load()
+        res_logo_obj = resize_logo(logo_obj, logo_size)
+        _LOGO_CACHE.put(key, res_logo_obj)
+    return res_logo_obj
+
+
+def _cached_logo_merge(logo_list, logo_size, padding, bg_col):
+    '''
+    As :func:`_logo_merge`, but using the logo cache if all of the logos
+    in the list are files.
+    '''
+    if not all([isinstance(x, str) for x in logo_list]):
+        return _logo_merge(logo_list, logo_size, padding, bg_col)
+
+    key = ('merged', tuple(logo_list),
+           tuple([os.path.getmtime(x) for x in logo_list]),
+           _logo_size_key(logo_size), padding, bg_col)
+    merged = _LOGO_CACHE.get(key)
+    if merged is None:
+        merged = _logo_merge(logo_list, logo_size, padding, bg_col)
+        _LOGO_CACHE.put(key, merged)
+    return merged
+
+
 def _im_add_png_tags(im_obj, png_tags):
     'adds img_tags to an image object for later saving'
     for key, val in png_tags.items():
@@ -729,7 +1897,8 @@ def _im_add_png_tags(im_obj, png_tags):
     return im_obj
 
 
-def _im_pngsave_addmeta(im_obj, outfile, img_dpi=None, optimize=True, verbose=False):
+def _im_pngsave_addmeta(im_obj, outfile, img_dpi=None, png_profile=None,
+                        verbose=False):
     'saves an image object to a png file, adding metadata using the info tag.'
 
     # undocumented class
@@ -752,7 +1921,138 @@ def _im_pngsave_addmeta(im_obj, outfile, img_dpi=None, optimize=True, verbose=Fa
 
 
     # and save
-    im_obj.save(outfile, "PNG", dpi=img_dpi, optimize=optimize, pnginfo=meta)
+    im_obj.save(outfile, "PNG", dpi=img_dpi, pnginfo=meta,
+                **_png_save_opts(png_profile))
+
+
+def _png_save_opts(png_profile=None):
+    'returns the png encoder options for a png_profile (None for the default)'
+    if png_profile is None:
+        png_profile = _DEFAULT_PNG_PROFILE
+    try:
+        return PNG_PROFILES[png_profile]
+    except KeyError:
+        msg = 'Unknown png_profile "{}", should be one of {}'
+        raise ValueError(msg.format(png_profile, sorted(PNG_PROFILES)))
+
+
+def set_png_profile(png_profile):
+    '''
+    Sets the default png encoding profile, used by :func:`ImageMetaTag.savefig`
+    and :func:`ImageMetaTag.image_file_postproc` when they are not given a
+    png_profile. The profiles are:
+
+    * 'fast' - quick to encode, but larger files.
+    * 'balanced' - the standard zlib compression level.
+    * 'smallest' - the smallest files, but slowest to encode (the default).
+
+    Images saved with 'fast' can be shrunk later, when there is time to
+    spare, using :func:`ImageMetaTag.reoptimise_pngs`.
+    '''
+    global _DEFAULT_PNG_PROFILE
+    # check it is valid:
+    _png_save_opts(png_profile)
+    _DEFAULT_PNG_PROFILE = png_profile
+
+
+def reoptimise_pngs(filenames, png_profile='smallest', n_proc=4,
+                    verbose=False):
+    '''
+    Recompresses existing png files in place, keeping their metadata. This
+    is intended to shrink images that were saved quickly (with
+    png_profile='fast') once the time critical work is done.
+
+    The text chunks (the image tags), dpi, transparency, gamma and ICC colour
+    profile are kept. Any other ancillary chunks (such as sRGB or cHRM) are
+    not.
+
+    Arguments:
+
+    * filenames - a list of png files.
+
+    Options:
+
+    * png_profile - the png encoding profile to use, see \
+                    :func:`ImageMetaTag.set_png_profile`.
+    * n_proc - number of processes to use. If 1 (or None), the files are \
+               processed in series in this process.
+    * verbose - report the change in total file size.
+
+    A file is only replaced if the recompressed version is smaller, and it
+    is replaced in a single step, so readers never see a partial file.
+
+    Returns a list, in the same order as the filenames, containing None
+    for each file that was processed, or the exception raised by a file that
+    failed.
+    '''
+    # check it is valid, before starting any work:
+    _png_save_opts(png_profile)
+    jobs = [(x, png_profile) for x in filenames]
+
+    if n_proc is None or n_proc == 1:
+        results = [_reoptimise_png(job) for job in jobs]
+    else:
+        proc_pool = Pool(n_proc)
+        try:
+            results = proc_pool.map(_reoptimise_png, jobs, chunksize=8)
+            proc_pool.close()
+        except BaseException:
+            # don't leave the workers running (after a KeyboardInterrupt, for instance):
+            proc_pool.terminate()
+            raise
+        finally:
+            proc_pool.join()
+
+    if verbose:
+        size_before = sum([x[0] for x in results])
+        size_after = sum([x[1] for x in results])
+        msg = 'Recompressed {} files. Size: {}, to {} bytes'
+        print(msg.format(len(results), size_before, size_after))
+
+    return [x[2] for x in results]
+
+
+def _reoptimise_png(job):
+    '''
+    Recompresses a single png file for :func:`ImageMetaTag.reoptimise_pngs`,
+    returning the size before and after, and any error.
+    '''
+    filename, png_profile = job
+    tmp_file = '{}.imt_tmp.{}'.format(filename, os.getpid())
+    size_before = 0
+    try:
+        size_before = os.path.getsize(filename)
+        im_obj = Image.open(filename)
+        im_obj.load()
+        meta = PngImagePlugin.PngInfo()
+        for key, val in im_obj.text.items():
+            meta.add_text(key, val)
+        if 'gamma' in im_obj.info:
+            # there is no save option for the gamma, so write the chunk:
+            gamma = int(round(im_obj.info['gamma'] * 100000))
+            meta.add(b'gAMA', PngImagePlugin.o32(gamma))
+        save_opts = dict(_png_save_opts(png_profile))
+        for info_key in ('dpi', 'transparency', 'icc_profile'):
+            if info_key in im_obj.info:
+                save_opts[info_key] = im_obj.info[info_key]
+        im_obj.save(tmp_file, "PNG", pnginfo=meta, **save_opts)
+        size_after = os.path.getsize(tmp_file)
+        if size_after < size_before:
+            if PY3:
+                os.replace(tmp_file, filename)
+            else:
+                # os.rename replaces the file in one step, except on windows:
+                if os.path.isfile(filename) and os.name == 'nt':
+                    os.remove(filename)
+                os.rename(tmp_file, filename)
+        else:
+            size_after = size_before
+            os.remove(tmp_file)
+    except Exception as err:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+        return size_before, size_before, err
+    return size_before, size_after, None
 
 
 def _img_stong_resize(img_obj, size=None):
@@ -27,6 +27,7 @@ from datetime import datetime
 import matplotlib
 import numpy as np
 import matplotlib.pyplot as plt
+from PIL import Image, PngImagePlugin
 
 # for timings:
 DATE_START = datetime.now()
@@ -605,6 +606,535 @@ def test_compare_img_tags(img_tags1, name1, img_tags2, name2):
                 raise ValueError(msg.format(keys_diff))
 
 
+def get_feature_test_dir(webdir):
+    'returns the directory for the images made by the tests of individual features'
+    test_dir = os.path.join(webdir, 'feature_tests')
+    mkdir_p(test_dir)
+    return test_dir
+
+
+def get_feature_test_db(test_dir, name):
+    'returns the path to a new, empty, database file for a test of an individual feature'
+    db_file = os.path.join(test_dir, '{}.db'.format(name))
+    imt.db.rmfile(db_file)
+    return db_file
+
+
+def plot_feature_test_line():
+    'plots a simple line, for jobs in the feature tests'
+    plt.plot([1, 3, 2, 4], color='b')
+
+
+def test_agg_buffer(webdir):
+    '''
+    Tests that saving a figure with agg_buffer=True, which skips the png
+    encode/decode round trip, gives the same image as saving it normally.
+    '''
+    test_dir = get_feature_test_dir(webdir)
+    plt.plot([1, 3, 2, 4], color='b')
+    plt.title('agg_buffer test')
+    img_tags = {'test name': 'agg_buffer'}
+    outfiles = [os.path.join(test_dir, 'agg_buffer_{}.png'.format(x)) for x in ('off', 'on')]
+    for outfile, agg_buffer in zip(outfiles, [False, True]):
+        imt.savefig(outfile, do_trim=True, trim_border=5, img_tags=img_tags,
+                    keep_open=True, agg_buffer=agg_buffer,
+                    logo_file=LOGO_FILE, logo_width=LOGO_SIZE, logo_pos=0)
+        check_img_tags(outfile, img_tags)
+    plt.close()
+    img_arrays = [np.asarray(Image.open(x).convert('RGBA')) for x in outfiles]
+    if img_arrays[0].shape != img_arrays[1].shape or (img_arrays[0] != img_arrays[1]).any():
+        raise ValueError('savefig with agg_buffer=True differs from agg_buffer=False')
+    print('agg_buffer tests pass OK')
+
+
+def test_trim_size(webdir):
+    '''
+    Tests the size of a trimmed image, against a known figure: a black square
+    on a transparent background, inside a faint (alpha=0.1) border. By default,
+    the faint border is trimmed off, as it always has been, but is kept with
+    trim_tolerance=0.
+    '''
+    test_dir = get_feature_test_dir(webdir)
+    # expected sizes, from a 400x300 pixel figure:
+    expected = {None: (200, 150), 0: (320, 240)}
+    for tolerance, exp_size in expected.items():
+        fig = plt.figure(figsize=(4, 3))
+        fig.patch.set_alpha(0)
+        fig.patches.append(plt.Rectangle((0.25, 0.25), 0.5, 0.5, facecolor='k',
+                                         transform=fig.transFigure, figure=fig))
+        fig.patches.append(plt.Rectangle((0.1, 0.1), 0.8, 0.8, facecolor='k', alpha=0.1,
+                                         transform=fig.transFigure, figure=fig))
+        outfile = os.path.join(test_dir, 'trim_size_{}.png'.format(tolerance))
+        imt.savefig(outfile, dpi=100, do_trim=True, trim_border=0,
+                    trim_tolerance=tolerance)
+        img_size = Image.open(outfile).size
+        if img_size != exp_size:
+            msg = 'Trimmed image with trim_tolerance={} is {}, not the expected {}'
+            raise ValueError(msg.format(tolerance, img_size, exp_size))
+    print('trim size tests pass OK')
+
+
+def test_logo_cache(webdir):
+    '''
+    Tests that the cached logos are reloaded when the logo file changes on disk,
+    for single and merged logos.
+    '''
+    test_dir = get_feature_test_dir(webdir)
+    logo_file = os.path.join(test_dir, 'logo_cache_logo.png')
+    logo_img = Image.open(LOGO_FILE)
+    logo_img.load()
+    # the logo, then a different logo in the same file, then back again:
+    logos = [logo_img, logo_img.transpose(Image.FLIP_TOP_BOTTOM), logo_img]
+    logo_mtime = os.path.getmtime(LOGO_FILE)
+    for logo_opt in [logo_file, [logo_file, logo_file]]:
+        plot_feature_test_line()
+        img_arrays = []
+        for i_logo, logo in enumerate(logos):
+            logo.save(logo_file)
+            # make sure the change is seen, however coarse the file times are:
+            os.utime(logo_file, (logo_mtime + i_logo, logo_mtime + i_logo))
+            outfile = os.path.join(test_dir, 'logo_cache_{}.png'.format(i_logo))
+            imt.savefig(outfile, keep_open=True, logo_file=logo_opt,
+                        logo_width=LOGO_SIZE, logo_pos=0)
+            img_arrays.append(np.asarray(Image.open(outfile).convert('RGBA')))
+        plt.close()
+        if (img_arrays[0] == img_arrays[1]).all():
+            raise ValueError('Cached logo was not reloaded when the logo file changed')
+        if (img_arrays[0] != img_arrays[2]).any():
+            raise ValueError('Images with the same logo file differ')
+    print('logo cache tests pass OK')
+
+
+def plot_feature_test_square(width):
+    '''
+    plots a 400x300 pixel (at 100 dpi) figure, with a transparent background and
+    a black rectangle in the middle, width wide in figure coordinates
+    '''
+    fig = plt.figure(figsize=(4, 3))
+    fig.patch.set_alpha(0)
+    fig.patches.append(plt.Rectangle(((1 - width) / 2.0, (1 - width) / 2.0), width, width,
+                                     facecolor='k', transform=fig.transFigure, figure=fig))
+
+
+def test_trim_key(webdir):
+    '''
+    Tests that a series of images with the same trim_key reuse the trim bounding box,
+    which is worked out again (with trim_check) if the content of an image moves.
+    '''
+    test_dir = get_feature_test_dir(webdir)
+    # the last image in the series is bigger than the trim of the first:
+    series = [0.5, 0.5, 0.6]
+    for trim_check, exp_sizes in [(True, [(200, 150), (200, 150), (240, 180)]),
+                                  (False, [(200, 150), (200, 150), (200, 150)])]:
+        trim_key = 'trim_key test, trim_check={}'.format(trim_check)
+        for i_img, width in enumerate(series):
+            outfiles = [os.path.join(test_dir, 'trim_key_{}_{}.png'.format(i_img, x))
+                        for x in ('key', 'no_key')]
+            plot_feature_test_square(width)
+            for outfile, key in zip(outfiles, [trim_key, None]):
+                imt.savefig(outfile, dpi=100, keep_open=True, do_trim=True,
+                            trim_key=key, trim_check=trim_check)
+            plt.close()
+            img_arrays = [np.asarray(Image.open(x)) for x in outfiles]
+            if img_arrays[0].shape[1::-1] != exp_sizes[i_img]:
+                msg = 'Image {} with trim_check={} is {}, not the expected {}'
+                raise ValueError(msg.format(i_img, trim_check, img_arrays[0].shape[1::-1],
+                                            exp_sizes[i_img]))
+            if trim_check and (img_arrays[0].shape != img_arrays[1].shape or
+                               (img_arrays[0] != img_arrays[1]).any()):
+                msg = 'Image {} trimmed with a trim_key differs from one without'
+                raise ValueError(msg.format(i_img))
+    print('trim_key tests pass OK')
+
+
+def test_palette_key(webdir):
+    '''
+    Tests that a series of images with the same palette_key all use the same palette,
+    whether that comes from the first image or from set_series_palette.
+    '''
+    test_dir = get_feature_test_dir(webdir)
+    imt.set_series_palette('palette_key test, viridis', cmap='viridis')
+    # the palette expected from set_series_palette starts with white, black, then viridis:
+    viridis_0 = np.round(np.array(plt.get_cmap('viridis')(0)[:3]) * 255)
+    exp_start = [255, 255, 255, 0, 0, 0] + [int(x) for x in viridis_0]
+    for palette_key in ['palette_key test', 'palette_key test, viridis']:
+        palettes = []
+        for i_img in range(3):
+            rand_data = np.random.RandomState(i_img).rand(20, 20) * (i_img + 1)
+            plt.imshow(rand_data, cmap='viridis')
+            outfile = os.path.join(test_dir, 'palette_key_{}.png'.format(i_img))
+            imt.savefig(outfile, img_converter=2, palette_key=palette_key)
+            img = Image.open(outfile)
+            if img.mode != 'P':
+                raise ValueError('Image saved with a palette_key is mode {}, not P'.format(img.mode))
+            palettes.append(img.getpalette())
+        if palettes[1:] != palettes[:-1]:
+            raise ValueError('Images with palette_key "{}" have different palettes'.format(palette_key))
+        if palette_key.endswith('viridis') and palettes[0][:9] != exp_start:
+            raise ValueError('Images do not use the palette from set_series_palette')
+    print('palette_key tests pass OK')
+
+
+def test_reoptimise_pngs(webdir):
+    '''
+    Tests that reoptimise_pngs shrinks images saved with png_profile='fast', without
+    changing the image or losing the tags, transparency or gamma.
+    '''
+    test_dir = get_feature_test_dir(webdir)
+    img_tags = {'test name': 'reoptimise_pngs'}
+    tagged_file = os.path.join(test_dir, 'reoptimise_tagged.png')
+    plot_feature_test_line()
+    imt.savefig(tagged_file, img_tags=img_tags, png_profile='fast')
+    # a palette image with a transparent colour and a gamma chunk:
+    palette_file = os.path.join(test_dir, 'reoptimise_palette.png')
+    meta = PngImagePlugin.PngInfo()
+    meta.add(b'gAMA', PngImagePlugin.o32(45455))
+    pal_img = Image.fromarray(np.arange(64, dtype=np.uint8).reshape(8, 8).repeat(8, 0), 'P')
+    pal_img.putpalette(list(range(256)) * 3)
+    pal_img.save(palette_file, pnginfo=meta, transparency=0, compress_level=1)
+
+    outfiles = [tagged_file, palette_file]
+    img_before = []
+    for outfile in outfiles:
+        img_before.append(Image.open(outfile))
+        img_before[-1].load()
+    size_before = [os.path.getsize(x) for x in outfiles]
+    errors = imt.reoptimise_pngs(outfiles, n_proc=1)
+    if errors != [None, None]:
+        raise ValueError('reoptimise_pngs failed: {}'.format(errors))
+    img_after = [Image.open(x) for x in outfiles]
+    if os.path.getsize(tagged_file) >= size_before[0]:
+        raise ValueError('reoptimise_pngs did not shrink an image saved with the "fast" profile')
+    for outfile, before, after in zip(outfiles, img_before, img_after):
+        if (np.asarray(before) != np.asarray(after)).any():
+            raise ValueError('reoptimise_pngs changed the image {}'.format(outfile))
+    check_img_tags(tagged_file, img_tags)
+    for info_key in ('transparency', 'gamma'):
+        if img_after[1].info.get(info_key) != img_before[1].info[info_key]:
+            raise ValueError('reoptimise_pngs lost the {} of an image'.format(info_key))
+    print('reoptimise_pngs tests pass OK')
+
+
+def test_skip_unchanged(webdir):
+    '''
+    Tests that savefig with skip_unchanged skips an image that has not changed, and
+    updates the database entry and hash of one that has, written directly, with
+    db_sharded and with db_buffered.
+    '''
+    test_dir = get_feature_test_dir(webdir)
+    for db_mode in ['direct', 'sharded', 'buffered']:
+        db_sharded = db_mode == 'sharded'
+        db_buffered = db_mode == 'buffered'
+        db_file = get_feature_test_db(test_dir, 'skip_unchanged_{}'.format(db_mode))
+        db_img = 'skip_unchanged_{}.png'.format(db_mode)
+        outfile = os.path.join(test_dir, db_img)
+        imt.db.rmfile(outfile)
+        # the first image, the same again, then with changed data (twice):
+        series = [('a', b'1'), ('a', b'1'), ('b', b'2'), ('b', b'2')]
+        img_hashes = []
+        for i_img, (test_data, fingerprint) in enumerate(series):
+            img_tags = {'test name': 'skip_unchanged', 'test data': test_data}
+            if i_img > 0:
+                # an old file time shows whether the image is saved again:
+                os.utime(outfile, (0, 0))
+            plot_feature_test_line()
+            imt.savefig(outfile, img_tags=img_tags, db_file=db_file, db_sharded=db_sharded,
+                        db_buffered=db_buffered, skip_unchanged=True,
+                        data_fingerprint=fingerprint)
+            plt.close()
+            if db_sharded:
+                imt.db.consolidate_shards(db_file)
+            elif db_buffered:
+                imt.db.flush_db_writers()
+            skipped = os.path.getmtime(outfile) == 0
+            if skipped != (i_img in (1, 3)):
+                msg = 'Image {} (db_mode={}) was {}skipped by skip_unchanged'
+                raise ValueError(msg.format(i_img, db_mode, '' if skipped else 'not '))
+            if imt.db.read(db_file)[1][db_img] != img_tags:
+                msg = 'Image {} (db_mode={}) database entry was not updated'
+                raise ValueError(msg.format(i_img, db_mode))
+            img_hashes.append(imt.db.read_img_hash(db_file, db_img))
+        if None in img_hashes or img_hashes[0] == img_hashes[2]:
+            msg = 'Image hash (db_mode={}) was not updated: {}'
+            raise ValueError(msg.format(db_mode, img_hashes))
+    print('skip_unchanged tests pass OK')
+
+
+def test_postproc_queue(webdir):
+    '''
+    Tests that images saved through a PostprocQueue are all written, and tagged,
+    once the queue is flushed and that errors from the jobs are raised.
+    '''
+    test_dir = get_feature_test_dir(webdir)
+    img_tags = {'test name': 'postproc_queue'}
+    outfiles = []
+    with imt.PostprocQueue(n_workers=2, max_pending=2) as pp_queue:
+        for i_img in range(4):
+            plt.plot([1, 3, 2, i_img], color='b')
+            outfile = os.path.join(test_dir, 'postproc_queue_{}.png'.format(i_img))
+            imt.savefig(outfile, do_trim=True, trim_border=5, img_tags=img_tags,
+                        postproc_queue=pp_queue)
+            outfiles.append(outfile)
+        pp_queue.flush()
+        for outfile in outfiles:
+            check_img_tags(outfile, img_tags)
+
+    # a job that fails (the directory does not exist) is raised by flush:
+    pp_queue = imt.PostprocQueue(n_workers=1)
+    plt.plot([1, 3, 2, 4], color='b')
+    bad_file = os.path.join(test_dir, 'no_such_dir', 'postproc_queue_fail.png')
+    imt.savefig(bad_file, img_tags=img_tags, postproc_queue=pp_queue)
+    try:
+        pp_queue.flush()
+    except (IOError, OSError):
+        job_failed = True
+    else:
+        job_failed = False
+    # the error has been raised, so the queue closes cleanly:
+    pp_queue.close()
+    if not job_failed:
+        raise ValueError('PostprocQueue.flush did not raise the error from a failed job')
+    print('PostprocQueue tests pass OK')
+
+
+def test_savefig_many(webdir):
+    '''
+    Tests that savefig_many returns the failures of individual jobs, without
+    stopping the rest of the batch, and only writes the successful jobs to
+    the database.
+    '''
+    test_dir = get_feature_test_dir(webdir)
+    db_file = get_feature_test_db(test_dir, 'savefig_many')
+    jobs = []
+    for i_img in range(3):
+        if i_img == 1:
+            # this job fails, as the directory does not exist:
+            outfile = os.path.join(test_dir, 'no_such_dir', 'savefig_many_1.png')
+        else:
+            outfile = os.path.join(test_dir, 'savefig_many_{}.png'.format(i_img))
+        img_tags = {'test name': 'savefig_many', 'test number': str(i_img)}
+        jobs.append((plot_feature_test_line, outfile, img_tags, {'do_trim': True}))
+    errors = imt.savefig_many(jobs, db_file=db_file, n_proc=2)
+
+    if len(errors) != len(jobs):
+        raise ValueError('savefig_many did not return a result for each job')
+    if errors[0] is not None or errors[2] is not None:
+        raise ValueError('savefig_many jobs failed: {}'.format(errors))
+    if not isinstance(errors[1], (IOError, OSError)):
+        raise ValueError('savefig_many did not return the failure of a job')
+    db_imgs, db_img_tags = imt.db.read(db_file)
+    if sorted(db_imgs) != ['savefig_many_0.png', 'savefig_many_2.png']:
+        raise ValueError('savefig_many wrote the wrong images to the database: {}'.format(db_imgs))
+    for _, outfile, img_tags, _ in [jobs[0], jobs[2]]:
+        check_img_tags(outfile, img_tags)
+        if db_img_tags[os.path.basename(outfile)] != img_tags:
+            raise ValueError('savefig_many database tags differ for {}'.format(outfile))
+    print('savefig_many tests pass OK')
+
+
+def test_savefig_metrics(webdir):
+    '''
+    Tests that SavefigMetrics records every stage of savefig, for each image, when
+    the post-processing is done directly, or by a PostprocQueue of threads or processes.
+    '''
+    test_dir = get_feature_test_dir(webdir)
+    db_file = get_feature_test_db(test_dir, 'savefig_metrics')
+    exp_stages = ['render', 'decode', 'trim', 'quantise', 'encode', 'db']
+    n_imgs = 2
+    for queue_opt in [None, False, True]:
+        metrics = imt.SavefigMetrics()
+        if queue_opt is None:
+            pp_queue = None
+        else:
+            pp_queue = imt.PostprocQueue(n_workers=2, use_processes=queue_opt)
+        for i_img in range(n_imgs):
+            plot_feature_test_line()
+            outfile = os.path.join(test_dir, 'savefig_metrics_{}.png'.format(i_img))
+            img_tags = {'test name': 'savefig_metrics', 'test number': str(i_img)}
+            imt.savefig(outfile, img_tags=img_tags, db_file=db_file, db_replace=True,
+                        do_trim=True, img_converter=2, metrics=metrics,
+                        postproc_queue=pp_queue)
+        if pp_queue is not None:
+            pp_queue.close()
+        summary = metrics.summary()
+        for name in exp_stages + ['bytes_in', 'bytes_out']:
+            if name not in summary or summary[name]['count'] != n_imgs:
+                msg = 'SavefigMetrics (postproc_queue processes={}) recorded {} {} for {} images'
+                raise ValueError(msg.format(queue_opt, summary.get(name, {}).get('count', 0),
+                                            name, n_imgs))
+    print('SavefigMetrics tests pass OK')
+
+
+def test_db_writer(webdir):
+    '''
+    Tests that images written to a database through a DbWriter (directly, or by
+    savefig with db_buffered=True) can be read once they have been flushed.
+    '''
+    test_dir = get_feature_test_dir(webdir)
+    db_file = get_feature_test_db(test_dir, 'db_buffered')
+    all_tags = {}
+    for i_img in range(3):
+        plot_feature_test_line()
+        db_img = 'db_buffered_{}.png'.format(i_img)
+        all_tags[db_img] = {'test name': 'db_buffered', 'test number': str(i_img)}
+        imt.savefig(os.path.join(test_dir, db_img), img_tags=all_tags[db_img],
+                    db_file=db_file, db_buffered=True)
+    if imt.db.read(db_file)[0]:
+        raise ValueError('Buffered images were in the database before they were flushed')
+    imt.db.flush_db_writers()
+    if imt.db.read(db_file)[1] != all_tags:
+        raise ValueError('Buffered images were not in the database once flushed')
+
+    # a DbWriter commits when it has commit_rows images:
+    db_file = get_feature_test_db(test_dir, 'db_writer')
+    db_writer = imt.db.DbWriter(db_file, commit_rows=2)
+    n_read = []
+    for db_img in sorted(all_tags):
+        db_writer.write(db_img, all_tags[db_img])
+        n_read.append(len(imt.db.read(db_file)[0] or []))
+    db_writer.close()
+    n_read.append(len(imt.db.read(db_file)[0]))
+    if n_read != [0, 2, 2, 3]:
+        raise ValueError('DbWriter made {} images visible, not [0, 2, 2, 3]'.format(n_read))
+    print('DbWriter tests pass OK')
+
+
+def test_consolidate_shards(webdir):
+    '''
+    Tests that consolidate_shards moves all of the images from the shards of a database
+    into it, adding any new tags as columns (set to 'None' for the other images).
+    '''
+    test_dir = get_feature_test_dir(webdir)
+    db_file = get_feature_test_db(test_dir, 'consolidate')
+    for shard_file in imt.db.list_db_shards(db_file):
+        imt.db.rmfile(shard_file)
+    old_tags = {'test name': 'consolidate', 'test number': 'old'}
+    imt.db.write_img_to_dbfile(db_file, 'img_0.png', old_tags)
+    # two shards, as if from different processes, the second with an extra tag.
+    # img_0.png is already in the database, so is ignored:
+    shard_imgs = [{'img_0.png': {'test name': 'consolidate', 'test number': '0'},
+                   'img_1.png': {'test name': 'consolidate', 'test number': '1'}},
+                  {'img_2.png': {'test name': 'consolidate', 'test number': '2',
+                                 'test extra': 'extra'}}]
+    root, ext = os.path.splitext(db_file)
+    for i_shard, imgs in enumerate(shard_imgs):
+        shard_file = '{}.shard_test_{}{}'.format(root, i_shard, ext)
+        for db_img, img_tags in imgs.items():
+            imt.db.write_img_to_dbfile(shard_file, db_img, img_tags)
+    if len(imt.db.list_db_shards(db_file)) != len(shard_imgs):
+        raise ValueError('list_db_shards did not find the shards')
+
+    n_moved = imt.db.consolidate_shards(db_file, delete_shards=True)
+    if n_moved != 3:
+        raise ValueError('consolidate_shards moved {} images, not 3'.format(n_moved))
+    if imt.db.list_db_shards(db_file):
+        raise ValueError('consolidate_shards did not delete the shards')
+    db_img_tags = imt.db.read(db_file)[1]
+    exp_tags = {'img_0.png': dict(old_tags, **{'test extra': 'None'}),
+                'img_1.png': dict(shard_imgs[0]['img_1.png'], **{'test extra': 'None'}),
+                'img_2.png': shard_imgs[1]['img_2.png']}
+    if db_img_tags != exp_tags:
+        raise ValueError('consolidate_shards gave the wrong database: {}'.format(db_img_tags))
+    print('consolidate_shards tests pass OK')
+
+
+def test_db_config(webdir):
+    '''
+    Tests that set_db_config(journal_mode='WAL') puts new database files into WAL mode,
+    and that the sqlite defaults are used again once it is reset.
+    '''
+    test_dir = get_feature_test_dir(webdir)
+    img_tags = {'test name': 'db_config'}
+    journal_modes = {}
+    prev_config = imt.db.set_db_config(journal_mode='WAL', synchronous='NORMAL')
+    try:
+        if imt.db.get_db_config().journal_mode != 'WAL':
+            raise ValueError('get_db_config does not return the config from set_db_config')
+        wal_db_file = get_feature_test_db(test_dir, 'db_config_wal')
+        imt.db.write_img_to_dbfile(wal_db_file, 'img.png', img_tags)
+        imt.db.checkpoint(wal_db_file)
+        dbcn, dbcr = imt.db.open_db_file(wal_db_file)
+        journal_modes['WAL'] = dbcr.execute('PRAGMA journal_mode').fetchone()[0]
+        dbcn.close()
+    finally:
+        imt.db.set_db_config(prev_config)
+    db_file = get_feature_test_db(test_dir, 'db_config_default')
+    imt.db.write_img_to_dbfile(db_file, 'img.png', img_tags)
+    dbcn, dbcr = imt.db.open_db_file(db_file)
+    journal_modes['default'] = dbcr.execute('PRAGMA journal_mode').fetchone()[0]
+    dbcn.close()
+    if journal_modes != {'WAL': 'wal', 'default': 'delete'}:
+        raise ValueError('Database files have the wrong journal modes: {}'.format(journal_modes))
+    # WAL is kept by the database file, whatever the config:
+    if imt.db.read(wal_db_file)[1] != {'img.png': img_tags}:
+        raise ValueError('Error reading a database written in WAL mode')
+    print('DbConfig tests pass OK')
+
+
+def test_db_new_tags(webdir):
+    '''
+    Tests that when images with new tags are added to a database, the new tags are
+    set to 'None' for the images already in it.
+    '''
+    test_dir = get_feature_test_dir(webdir)
+    db_file = get_feature_test_db(test_dir, 'new_tags')
+    tags_0 = {'test name': 'new_tags', 'test number': '0'}
+    tags_1 = {'test name': 'new_tags', 'test number': '1', 'test new': 'new'}
+    tags_23 = {'test name': 'new_tags', 'test number': '2', 'test newer': 'newer'}
+    imt.db.write_img_to_dbfile(db_file, 'img_0.png', tags_0)
+    imt.db.write_img_to_dbfile(db_file, 'img_1.png', tags_1)
+    imt.db.write_imgs_to_dbfile(db_file, {'img_2.png': tags_23, 'img_3.png': tags_23})
+    exp_tags = {'img_0.png': dict(tags_0, **{'test new': 'None', 'test newer': 'None'}),
+                'img_1.png': dict(tags_1, **{'test newer': 'None'}),
+                'img_2.png': dict(tags_23, **{'test new': 'None'}),
+                'img_3.png': dict(tags_23, **{'test new': 'None'})}
+    db_img_tags = imt.db.read(db_file)[1]
+    if db_img_tags != exp_tags:
+        raise ValueError('Database with new tags added is wrong: {}'.format(db_img_tags))
+    print('new database tags tests pass OK')
+
+
+def test_select_operators(webdir):
+    '''
+    Tests selecting images from a database with the select operators: in, not in,
+    like, prefix and range.
+    '''
+    test_dir = get_feature_test_dir(webdir)
+    db_file = get_feature_test_db(test_dir, 'select_operators')
+    last_char = u'\U0010ffff'
+    img_infos = {}
+    for i_img, (model, lead, label) in enumerate([('global', '0', u'a' + last_char),
+                                                   ('regional', '12', u'a' + last_char + u'b'),
+                                                   ('test', '48', u'ab'),
+                                                   ('global', 'None', u'b')]):
+        img_infos['img_{}.png'.format(i_img)] = {'test name': 'select', 'test model': model,
+                                                 'test lead': lead, 'test plot': 'T+' + lead,
+                                                 'test label': label}
+    imt.db.write_imgs_to_dbfile(db_file, img_infos)
+
+    select_tests = [({'test model': {'in': ['global', 'regional']}}, [0, 1, 3]),
+                    ({'test model': {'not in': ['global']}}, [1, 2]),
+                    ({'test plot': {'like': 'T+1%'}}, [1]),
+                    ({'test label': {'prefix': u'a'}}, [0, 1, 2]),
+                    ({'test label': {'prefix': u'a' + last_char}}, [0, 1]),
+                    ({'test lead': {'range': (6, '48')}}, [1, 2]),
+                    # fields that are not numbers are treated as 0:
+                    ({'test lead': {'range': (None, 6)}}, [0, 3]),
+                    ({'test model': 'global', 'test lead': {'range': (0, 6)}}, [0, 3])]
+    for select_tags, exp_imgs in select_tests:
+        sel_imgs = imt.db.select_dbfile_by_tags(db_file, select_tags)[0]
+        if sorted(sel_imgs) != ['img_{}.png'.format(x) for x in exp_imgs]:
+            msg = 'Selecting {} gave {}, not images {}'
+            raise ValueError(msg.format(select_tags, sel_imgs, exp_imgs))
+    try:
+        imt.db.select_dbfile_by_tags(db_file, {'test lead': {'range': ('six', None)}})
+    except ValueError:
+        pass
+    else:
+        raise ValueError('Selecting with a range that is not numbers did not fail')
+    print('select operators tests pass OK')
+
+
 def __main__():
 
     # parse the arguments, straight fail if there's a problem.
@@ -635,7 +1165,7 @@ def __main__():
         colours = [('g', 'Plotted in Green')]
     else:
         n_random_data = 3
-        compress_levels = [0, 1, 2, 3]
+        compress_levels = [0, 1, 2, 3, 4]
         trims = [True, False]
         borders = [5, 10, 100]
         dpis = [72, 150]
@@ -817,17 +1347,59 @@ def __main__():
     tag_strings = []
     db_imgs, db_img_tags = imt.db.read(imt_db, tag_strings=tag_strings)
     # and this both filters out un-needed tags and uses the tag_strings
-    # list as a reference
-    tag_strings = []
+    # list as a reference. A TagStrings list keeps its own index of the
+    # strings, so can be reused between reads:
+    tag_strings = imt.db.TagStrings()
     db_imgs, db_img_tags = imt.db.read(imt_db, required_tags=required_tags,
                                        tag_strings=tag_strings)
+    # for large databases, the database can also be read as columns of codes,
+    # one column per tag, which index a list of the unique values of that tag:
+    col_imgs, col_tags = imt.db.read_columnar(imt_db, required_tags=required_tags)
+    for i_img, img in enumerate(col_imgs):
+        for tag_name, (codes, values) in col_tags.items():
+            if values[codes[i_img]] != db_img_tags[img][tag_name]:
+                raise ValueError('read_columnar does not match read')
+    # or streamed an image at a time, without holding it all in memory:
+    for img, img_info in imt.db.iter_rows(imt_db, required_tags=required_tags,
+                                          batch_size=3):
+        if img_info != db_img_tags[img]:
+            raise ValueError('iter_rows does not match read')
+    # selects by tag are quicker with an index on the tags; check it is used:
+    dbcn, dbcr = imt.db.open_db_file(imt_db)
+    index_name = imt.db.create_index(dbcr, required_tags[:2])
+    select_tags = {tag: db_img_tags[db_imgs[0]][tag] for tag in required_tags[:2]}
+    tag_usage = imt.db.select_tag_usage()
+    if not any([index_name in x for x in imt.db.explain_select(dbcr, select_tags)]):
+        raise ValueError('Index {} is not used to select by its tags'.format(index_name))
+    if imt.db.select_tag_usage() != tag_usage:
+        raise ValueError('explain_select was counted as a select, for auto_index')
+    imt.db.drop_index(dbcr, index_name=index_name)
+    dbcn.commit()
+    dbcn.close()
 
     # test deleting a single image from the db file, and then add it back in:
     del_img = db_imgs[0]
     del_tags = db_img_tags[del_img]
     imt.db.del_plots_from_dbfile(imt_db, del_img)
+    if del_img in imt.db.read(imt_db)[0]:
+        raise ValueError('Image {} was not deleted from the database'.format(del_img))
+    # deleting files that are not in the database does nothing:
+    imt.db.del_plots_from_dbfile(imt_db, [del_img, 'not_an_image.png'],
+                                 allow_retries=False, skip_warning=True)
     # now put it back in:
     imt.db.write_img_to_dbfile(imt_db, del_img, del_tags)
+
+    # split the database in two, and merge the halves back together:
+    merge_dbs = [imt_db.replace('.db', '_merge{}.db'.format(i)) for i in range(3)]
+    for merge_db in merge_dbs:
+        imt.db.rmfile(merge_db)
+    all_imgs, all_img_tags = imt.db.read(imt_db)
+    imt.db.write_imgs_to_dbfile(merge_dbs[1], dict([(x, all_img_tags[x]) for x in all_imgs[::2]]))
+    imt.db.write_imgs_to_dbfile(merge_dbs[2], dict([(x, all_img_tags[x]) for x in all_imgs[1::2]]))
+    imt.db.merge_db_files(merge_dbs[0], merge_dbs[1:], delete_add_db=True)
+    if imt.db.read(merge_dbs[0])[1] != all_img_tags:
+        raise ValueError('Merged database differs from the original')
+    imt.db.rmfile(merge_dbs[0])
     print('Database integrity checks/memory optimsations completed')
 
     # Now make the next type of web page.
@@ -1050,9 +1622,10 @@ def __main__():
         img_dict_multi.dict = {}
 
         # becasue we are going to do a lot of searches,
-        # we need to read the imt_db into memory for fast access:
+        # we need to read the imt_db into memory for fast access.
+        # Only selects are needed, so this can be a read only snapshot:
         print('reading database file: %s' % imt_db)
-        dbcn, dbcr = imt.db.read_db_file_to_mem(imt_db)
+        dbcn, dbcr = imt.db.read_db_file_to_mem(imt_db, read_only=True)
         print('db file read')
 
         # now assemble the ImageDict:
@@ -1282,6 +1855,23 @@ def __main__():
     else:
         raise ValueError('Testing failed in test_key_sorting')
 
+    # tests of individual features:
+    test_agg_buffer(webdir)
+    test_trim_size(webdir)
+    test_logo_cache(webdir)
+    test_trim_key(webdir)
+    test_palette_key(webdir)
+    test_reoptimise_pngs(webdir)
+    test_skip_unchanged(webdir)
+    test_postproc_queue(webdir)
+    test_savefig_many(webdir)
+    test_savefig_metrics(webdir)
+    test_db_writer(webdir)
+    test_consolidate_shards(webdir)
+    test_db_config(webdir)
+    test_db_new_tags(webdir)
+    test_select_operators(webdir)
+
     if not args.minimal:
 
         # now, finally, produce a large ImageDict:
@@ -1329,7 +1919,6 @@ def __main__():
                                                 if first_img:
                                                     bigdb_cn, bigdb_cr = imt.db.open_or_create_db_file(bigdb, img_info, restart_db=True)
                                                     first_img = False
-                                                imt.db.write_img_to_open_db(bigdb_cr, img_name, img_info)
                                                 i_count += 1
                                                 pcent_done = 100 * i_count / n_to_do_flt
                                                 if pcent_done > pcents[0]:
@@ -1344,6 +1933,8 @@ def __main__():
                                                     pcents.pop(0)
             print('  input dictionary complete, with %s elements' % len(biggus_dictus))
 
+            # and write it all to the database in one go:
+            imt.db.write_imgs_to_open_db(bigdb_cr, biggus_dictus)
             bigdb_cn.commit()
             bigdb_cn.close()
             print_simple_timer(date_start_bigdb, datetime.now(),
@@ -1434,7 +2025,8 @@ def __main__():
             imt.db.scan_dir_for_db(webdir, rebuild_db, restart_db=True,
                                    img_tag_req=required_tags,
                                    subdir_excl_list=['thumbnail', 'minimal'],
-                                   known_file_tags=None, verbose=False)
+                                   known_file_tags=None, verbose=False,
+                                   n_readers=2)
             # now load that db and test it:
             imgs_r, imgs_tags_r = imt.db.read(rebuild_db,
                                               required_tags=required_tags,